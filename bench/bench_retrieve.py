@@ -0,0 +1,125 @@
+import os
+import sys
+import asyncio
+import shutil
+import tempfile
+import time
+
+import aiohttp
+import click
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'espr'))
+import gefs_retrieve as gr
+from manifest import DownloadManifest
+from nomads_standin import NomadsStandIn
+
+
+def dir_size(path):
+    return sum(os.path.getsize(f'{root}/{n}') for root, _, files in os.walk(path) for n in files)
+
+def time_download(retr, links):
+    start = time.perf_counter()
+    asyncio.get_event_loop().run_until_complete(retr.download_links(links))
+    elapsed = time.perf_counter() - start
+    return len(links)/elapsed, dir_size(retr.download_dir)/1e6/elapsed
+
+def time_call(retr, download, links, stat, attempts=5):
+    """
+    Times download over links, re-running it on the links not yet complete
+    in a manifest whenever it raises (a 429, 503 or truncated response
+    takes down the paths that do not retry themselves), up to attempts
+    runs. Returns files/s and MB/s of the files fetched and the number of
+    failed runs.
+    """
+    manifest = DownloadManifest(retr.download_dir, retr.date_value, retr.hour_value, stat)
+    failures = 0
+    pending = links
+    start = time.perf_counter()
+    for _ in range(attempts):
+        try:
+            download(pending, manifest)
+            break
+        except (requests.exceptions.RequestException, aiohttp.ClientError, asyncio.TimeoutError):
+            failures += 1
+            pending = manifest.pending(pending)
+    elapsed = time.perf_counter() - start
+    fetched = len(links) - len(manifest.pending(links))
+    size = sum(os.path.getsize(n) for n in manifest.complete_files())
+    return fetched/elapsed, size/1e6/elapsed, failures
+
+def stat_links(retr, date, hour, stat):
+    retr.date_value = date
+    retr.hour_value = hour
+    retr.link_builder()
+    return {'ens': retr.ens_fhour_links, 'mean': retr.mean_fhour_links, 'sprd': retr.sprd_fhour_links}[stat]
+
+def compare(date, hour, stat, n_files, variable='PRMSL'):
+    """
+    Downloads the same links through the per-file session path and the
+    pooled, streaming path and returns files/s and MB/s for each.
+    """
+    results = {}
+    for pooled in [False, True]:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            retr = gr.GEFSRetrieve(variable, download_dir=tmp_dir, pooled=pooled)
+            links = stat_links(retr, date, hour, stat)
+            results['pooled' if pooled else 'per-file'] = time_download(retr, links[:n_files])
+        finally:
+            shutil.rmtree(tmp_dir)
+    return results
+
+STANDIN_PATHS = {
+    'sync': ({'pooled': False}, 'download_files'),
+    'async': ({'pooled': False}, 'download_files_async'),
+    'pooled': ({'pooled': True}, 'download_files_async'),
+    'idx sync': ({'backend': 'idx'}, 'download_files'),
+    'idx pooled': ({'backend': 'idx'}, 'download_files_async'),
+}
+
+def compare_standin(stat, n_files, variables=('PRMSL',), levels=None, **standin_kwargs):
+    """
+    Runs every retrieval path against a local NOMADS stand-in, so that
+    changes can be measured offline and under injected latency, throttling
+    or truncation, and returns files/s, MB/s and failed runs for each.
+    """
+    results = {}
+    with NomadsStandIn(**standin_kwargs) as standin:
+        date, hour = f'gefs.{standin.cycles[-1][:8]}/', f'{standin.cycles[-1][8:]}/'
+        for name, (kwargs, method) in STANDIN_PATHS.items():
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                retr = gr.GEFSRetrieve(list(variables), levels=levels, download_dir=tmp_dir, nomads_url=standin.url, **kwargs)
+                links = stat_links(retr, date, hour, stat)
+                results[name] = time_call(retr, getattr(retr, method), links[:n_files], stat)
+            finally:
+                shutil.rmtree(tmp_dir)
+        results['server'] = standin.stats
+    return results
+
+@click.command()
+@click.option("--date", default=None, help="Model run date, e.g. gefs.20210715/")
+@click.option("--hour", default='00/', help="Model run hour, e.g. 00/.")
+@click.option("--stat", default='mean', help="ens, mean, or sprd.")
+@click.option("-n", "--n-files", default=57, help="Number of links to fetch with each path.")
+@click.option("--standin", is_flag=True, help="Benchmark against a local NOMADS stand-in instead of NOMADS.")
+@click.option("--resolution", default=0.25, help="Stand-in grid spacing in degrees.")
+@click.option("--latency", default=0., help="Stand-in latency per request in seconds.")
+@click.option("--throttle-rate", default=0., help="Fraction of stand-in requests answered with 429.")
+@click.option("--max-concurrent", default=None, type=int, help="Stand-in requests in flight beyond this get 503.")
+@click.option("--truncate-rate", default=0., help="Fraction of stand-in responses cut short of their Content-Length.")
+def cli_main(date, hour, stat, n_files, standin, resolution, latency, throttle_rate, max_concurrent, truncate_rate):
+    if standin:
+        results = compare_standin(stat, n_files, resolution=resolution, latency=latency,
+            throttle_rate=throttle_rate, max_concurrent=max_concurrent, truncate_rate=truncate_rate)
+        print(f"server: {results.pop('server')}")
+        for name, (files_s, mb_s, failures) in results.items():
+            print(f'{name:>10}: {files_s:8.2f} files/s {mb_s:8.2f} MB/s {failures:3} failed runs')
+        return
+    assert date is not None, '--date is required unless --standin is set'
+    for name, (files_s, mb_s) in compare(date, hour, stat, n_files).items():
+        print(f'{name:>10}: {files_s:8.2f} files/s {mb_s:8.2f} MB/s')
+
+if __name__ == '__main__':
+    cli_main()
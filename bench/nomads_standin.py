@@ -0,0 +1,305 @@
+import re
+import gzip
+import time
+import random
+import struct
+import asyncio
+import hashlib
+import threading
+from functools import lru_cache
+from urllib.parse import unquote
+
+import numpy as np
+from aiohttp import web
+
+
+# (variable, .idx level, discipline, category, number, surface type, surface value)
+MESSAGES = [
+    ('PRMSL', 'mean sea level', 0, 3, 1, 101, 0),
+    ('PWAT', 'entire atmosphere (considered as a single layer)', 0, 1, 3, 200, 0),
+    ('TMP', '925 mb', 0, 0, 0, 100, 92500),
+    ('TMP', '850 mb', 0, 0, 0, 100, 85000),
+    ('UGRD', '10 m above ground', 0, 2, 2, 103, 10),
+    ('VGRD', '10 m above ground', 0, 2, 3, 103, 10),
+]
+
+def _signed(value, nbytes):
+    """GRIB2 sign-and-magnitude integer."""
+    magnitude = abs(int(value))
+    if value < 0:
+        magnitude |= 1 << (8*nbytes - 1)
+    return magnitude.to_bytes(nbytes, 'big')
+
+def grib2_message(values, lats, lons, run, fhour, discipline, category, number, surface, surface_value):
+    """
+    Encodes one simple-packed GRIB2 message on a regular lat/lon grid
+    (template 3.0, product template 4.0, data template 5.0, 16 bits).
+    """
+    nj, ni = values.shape
+    sec1 = struct.pack('>IBHHBBBHBBBBBBB', 21, 1, 7, 0, 2, 1, 1,
+        run.year, run.month, run.day, run.hour, 0, 0, 0, 1)
+    res = int(round(abs(lons[1] - lons[0])*1e6)) if ni > 1 else 0
+    sec3 = (struct.pack('>IBBIBBH', 72, 3, 0, ni*nj, 0, 0, 0)
+        + struct.pack('>BBIBIBIIIII', 6, 0, 0, 0, 0, 0, 0, ni, nj, 0, 0xFFFFFFFF)
+        + _signed(lats[0]*1e6, 4) + _signed(lons[0]*1e6, 4) + bytes([48])
+        + _signed(lats[-1]*1e6, 4) + _signed(lons[-1]*1e6, 4)
+        + struct.pack('>IIB', res, res, 0))
+    sec4 = (struct.pack('>IBHH', 34, 4, 0, 0)
+        + struct.pack('>BBBBBHBBI', category, number, 4, 0, 0, 0, 0, 1, fhour)
+        + struct.pack('>BB', surface, 0) + _signed(surface_value, 4)
+        + struct.pack('>BBI', 255, 0, 0))
+    ref = float(values.min())
+    span = float(values.max()) - ref
+    scale = int(np.ceil(np.log2(span/65535.))) if span > 0 else 0
+    packed = np.round((values.ravel() - ref)/2.**scale).astype('>u2').tobytes()
+    sec5 = struct.pack('>IBIHf', 21, 5, ni*nj, 0, ref) + _signed(scale, 2) + struct.pack('>HBB', 0, 16, 0)
+    sec6 = struct.pack('>IBB', 6, 6, 255)
+    sec7 = struct.pack('>IB', 5 + len(packed), 7) + packed
+    body = sec1 + sec3 + sec4 + sec5 + sec6 + sec7 + b'7777'
+    return b'GRIB' + bytes([0, 0, discipline, 2]) + struct.pack('>Q', 16 + len(body)) + body
+
+
+class NomadsStandIn:
+    """
+    Local stand-in for the parts of nomads.ncep.noaa.gov GEFSRetrieve uses.
+    Serves Apache-style directory listings (with ETag/304 support), the
+    filter_gefs_atmos_0p25s.pl grib_filter endpoint, and pgrb2s.0p25 files
+    plus .idx inventories (with Range support) made of synthetic GRIB2
+    messages. Latency, throttling and truncated responses can be injected.
+    The server runs on its own event loop in a background thread so that
+    synchronous (requests) and asynchronous clients can both be measured.
+
+    Parameters
+    ---------
+    cycles : list
+        Published cycles as YYYYMMDDHH strings.
+    resolution : float
+        Grid spacing in degrees of the synthetic global grid.
+    hour_end, freq : int
+        Lead times published for each cycle.
+    latency : float
+        Seconds added to every response.
+    throttle_rate : float
+        Fraction of data requests answered with 429.
+    max_concurrent : int
+        Data requests beyond this many in flight are answered with 503.
+    truncate_rate : float
+        Fraction of data responses cut short of their Content-Length.
+    compress : bool
+        If true, whole-file responses are gzip encoded for clients that
+        accept it, with Content-Length the size of the encoded body.
+    publish_interval : float
+        If set, lead time f of the newest cycle is only published
+        publish_interval*f/freq seconds after the server starts.
+    """
+    def __init__(self,
+        cycles=('2021071500', '2021071506'),
+        resolution: float=0.25,
+        hour_end: int=168,
+        freq: int=3,
+        latency: float=0.,
+        throttle_rate: float=0.,
+        max_concurrent: int=None,
+        truncate_rate: float=0.,
+        compress: bool=False,
+        publish_interval: float=0.,
+        seed: int=0):
+
+        self.cycles = sorted(cycles)
+        self.resolution = resolution
+        self.hour_end = hour_end
+        self.freq = freq
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.max_concurrent = max_concurrent
+        self.truncate_rate = truncate_rate
+        self.compress = compress
+        self.publish_interval = publish_interval
+        self.random = random.Random(seed)
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'throttled': 0, 'truncated': 0, 'not_modified': 0}
+        self.lats = np.arange(90, -90 - resolution/2, -resolution)
+        self.lons = np.arange(0, 360, resolution)
+        self.url = None
+
+    def __str__(self):
+        return f'NOMADS stand-in at {self.url}'
+
+    def start(self, port: int=0):
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            self.runner = web.AppRunner(self.app())
+            self.loop.run_until_complete(self.runner.setup())
+            site = web.TCPSite(self.runner, '127.0.0.1', port)
+            self.loop.run_until_complete(site.start())
+            self.url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+            self.start_time = time.time()
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def app(self):
+        app = web.Application()
+        prod = '/pub/data/nccf/com/gens/prod'
+        app.router.add_get(f'{prod}/', self.list_dates)
+        app.router.add_get(f'{prod}/{{date}}/', self.list_hours)
+        app.router.add_route('*', f'{prod}/{{date}}/{{hour}}/atmos/pgrb2sp25/{{filename}}', self.file)
+        app.router.add_get('/cgi-bin/filter_gefs_atmos_0p25s.pl', self.grib_filter)
+        return app
+
+    def published(self, date, hour, filename):
+        cycle = f"{date.replace('gefs.', '')}{hour}"
+        match = re.search(r'\.t(\d{2})z\.pgrb2s\.0p25\.f(\d{3})$', filename)
+        if cycle not in self.cycles or match is None or match.group(1) != hour:
+            return False
+        fhour = int(match.group(2))
+        if fhour > self.hour_end or fhour % self.freq:
+            return False
+        if self.publish_interval and cycle == self.cycles[-1]:
+            return time.time() - self.start_time >= self.publish_interval*fhour/self.freq
+        return True
+
+    def _listing(self, request, names):
+        page = '<html><body><a href="?C=N;O=D">Name</a>\n' + ''.join(f'<a href="{n}">{n}</a>\n' for n in names) + '</body></html>'
+        etag = f'"{hashlib.md5(page.encode()).hexdigest()}"'
+        if request.headers.get('If-None-Match') == etag:
+            self.stats['not_modified'] += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(text=page, content_type='text/html', headers={'ETag': etag})
+
+    async def list_dates(self, request):
+        return self._listing(request, sorted(set(f'gefs.{n[:8]}/' for n in self.cycles)))
+
+    async def list_hours(self, request):
+        date = request.match_info['date'].replace('gefs.', '')
+        return self._listing(request, sorted(f'{n[8:]}/' for n in self.cycles if n[:8] == date))
+
+    def _field(self, var, level, run, fhour, lats, lons):
+        seed = int(hashlib.md5(f'{var}{level}{run}{fhour}'.encode()).hexdigest()[:8], 16)
+        lat, lon = np.meshgrid(np.deg2rad(lats), np.deg2rad(lons), indexing='ij')
+        base = {'PRMSL': 101325., 'PWAT': 20., 'TMP': 280., 'UGRD': 0., 'VGRD': 0.}[var]
+        amplitude = {'PRMSL': 2000., 'PWAT': 15., 'TMP': 20., 'UGRD': 10., 'VGRD': 10.}[var]
+        phase = (seed % 360)/57.3 + fhour/24.
+        return (base + amplitude*np.cos(lat)*np.sin(2*lon + phase)).astype('float32')
+
+    @lru_cache(maxsize=64)
+    def _messages(self, filename, run_str, bounds=None):
+        run = np.datetime64(f'{run_str[:4]}-{run_str[4:6]}-{run_str[6:8]}T{run_str[8:]}').astype(object)
+        fhour = int(filename[-3:])
+        lats, lons = self.lats, self.lons
+        if bounds is not None:
+            bottom, top, left, right = bounds
+            lats = lats[(lats >= bottom) & (lats <= top)]
+            lons = lons[(lons >= left) & (lons <= right)]
+        messages = []
+        for var, level, discipline, category, number, surface, value in MESSAGES:
+            values = self._field(var, level, run_str, fhour, lats, lons)
+            messages.append((var, level, grib2_message(values, lats, lons, run, fhour, discipline, category, number, surface, value)))
+        return messages
+
+    def idx(self, messages, run_str, fhour):
+        lines, offset = [], 0
+        for num, (var, level, data) in enumerate(messages, 1):
+            forecast = 'anl' if fhour == 0 else f'{fhour} hour fcst'
+            lines.append(f'{num}:{offset}:d={run_str}:{var}:{level}:{forecast}:')
+            offset += len(data)
+        return '\n'.join(lines) + '\n'
+
+    async def _faults(self):
+        self.stats['requests'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.max_concurrent is not None and self.in_flight > self.max_concurrent:
+            self.stats['throttled'] += 1
+            return web.Response(status=503)
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            self.stats['throttled'] += 1
+            return web.Response(status=429)
+        return None
+
+    async def _send(self, request, body, status=200, headers=None):
+        headers = dict(headers or {})
+        if self.compress and status == 200 and 'gzip' in request.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = len(body)
+        response.content_type = 'application/octet-stream'
+        await response.prepare(request)
+        if self.truncate_rate and self.random.random() < self.truncate_rate:
+            self.stats['truncated'] += 1
+            await response.write(body[:len(body)//2])
+            request.transport.close()
+            return response
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+    async def file(self, request):
+        date, hour, filename = request.match_info['date'], request.match_info['hour'], request.match_info['filename']
+        name = filename[:-4] if filename.endswith('.idx') else filename
+        if not self.published(date, hour, name):
+            return web.Response(status=404)
+        self.in_flight += 1
+        try:
+            fault = await self._faults()
+            if fault is not None:
+                return fault
+            if request.method == 'HEAD':
+                return web.Response(status=200)
+            run_str = f"{date.replace('gefs.', '')}{hour}"
+            messages = self._messages(name, run_str)
+            if filename.endswith('.idx'):
+                return web.Response(text=self.idx(messages, run_str, int(name[-3:])))
+            body = b''.join(n[2] for n in messages)
+            match = re.match(r'bytes=(\d+)-(\d*)$', request.headers.get('Range', ''))
+            if match is None:
+                return await self._send(request, body)
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(body) - 1
+            return await self._send(request, body[start:end+1], status=206,
+                headers={'Content-Range': f'bytes {start}-{end}/{len(body)}'})
+        finally:
+            self.in_flight -= 1
+
+    async def grib_filter(self, request):
+        query = {unquote(k).replace('\\', ''): v for k, v in request.query.items()}
+        date, hour = [n for n in query.get('dir', '').split('/') if n][:2]
+        filename = query.get('file', '')
+        if not self.published(date, hour, filename):
+            return web.Response(status=404, text='data file is not present')
+        self.in_flight += 1
+        try:
+            fault = await self._faults()
+            if fault is not None:
+                return fault
+            variables = set(k[4:] for k in query if k.startswith('var_'))
+            levels = set(k[4:].replace('_', ' ') for k in query if k.startswith('lev_'))
+            bounds = None
+            if 'subregion' in query:
+                bounds = tuple(float(query[n]) for n in ['bottomlat', 'toplat', 'leftlon', 'rightlon'])
+            run_str = f"{date.replace('gefs.', '')}{hour}"
+            messages = self._messages(filename, run_str, bounds)
+            body = b''.join(data for var, level, data in messages
+                if var in variables and (not levels or level in levels))
+            return await self._send(request, body)
+        finally:
+            self.in_flight -= 1
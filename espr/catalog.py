@@ -0,0 +1,157 @@
+import os
+import re
+import sqlite3
+import logging
+from datetime import datetime
+
+import numpy as np
+import click
+
+import utils as ut
+
+
+STATS = ('mean', 'sprd', 'ens')
+DATE_RE = re.compile(r'^(\d{8})(\d{2})?$')
+FHOUR_RE = re.compile(r'^f(\d{3})$')
+
+def parse_filename(name: str):
+    """
+    Variable, stat, date and fhour of a v12 reforecast file name, e.g.
+    slp_mean_2005071500_f024.nc -> ('slp', 'mean', 2005-07-15, 24).
+    Variable and fhour are None when not in the name; returns None when
+    the name has no stat or date.
+    """
+    tokens = re.split(r'[_.]', name)
+    stat = next((n for n in tokens if n in STATS), None)
+    date = next((DATE_RE.match(n).group(1) for n in tokens if DATE_RE.match(n)), None)
+    if stat is None or date is None:
+        return None
+    fhour = next((int(FHOUR_RE.match(n).group(1)) for n in tokens if FHOUR_RE.match(n)), None)
+    variable = '_'.join(tokens[:tokens.index(stat)]) or None
+    return variable, stat, datetime.strptime(date, '%Y%m%d').date(), fhour
+
+
+class ReforecastCatalog:
+    """
+    SQLite catalog of a v12 reforecast directory, one row per file with
+    its variable, stat, date, day of year (utils.day_of_year) and fhour,
+    indexed on stat and day of year. Finding the files within a window of
+    days is then an indexed query instead of listing the whole archive
+    and substring matching every name against every date. Build or
+    refresh it after the archive changes with the cli below.
+
+    Parameters
+    ---------
+    path : str
+        The reforecast directory.
+    db_path : str
+        Location of the catalog, default <path>/catalog.sqlite.
+    """
+    def __init__(self, path: str, db_path: str=None):
+        self.path = path
+        self.db_path = db_path or f'{path}/catalog.sqlite'
+
+    def __str__(self):
+        return f'Reforecast catalog {self.db_path}'
+
+    def exists(self) -> bool:
+        return os.path.exists(self.db_path)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY, variable TEXT, stat TEXT NOT NULL,
+            date TEXT NOT NULL, year INTEGER NOT NULL, doy INTEGER NOT NULL, fhour INTEGER)''')
+        conn.execute('CREATE INDEX IF NOT EXISTS files_stat_doy ON files (stat, doy, year)')
+        conn.execute('CREATE INDEX IF NOT EXISTS files_variable_stat_doy ON files (variable, stat, doy)')
+        return conn
+
+    def refresh(self):
+        """
+        Adds files new to the directory and drops files no longer in it.
+        Returns (added, removed).
+        """
+        on_disk = {n.name for n in os.scandir(self.path) if n.is_file()}
+        with self.connect() as conn:
+            cataloged = {n for (n,) in conn.execute('SELECT name FROM files')}
+            rows = []
+            for name in sorted(on_disk - cataloged):
+                parsed = parse_filename(name)
+                if parsed is None:
+                    continue
+                variable, stat, date, fhour = parsed
+                doy = int(ut.day_of_year(np.datetime64(date, 'D')))
+                rows.append((name, variable, stat, date.isoformat(), date.year, doy, fhour))
+            conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            removed = cataloged - on_disk
+            conn.executemany('DELETE FROM files WHERE name = ?', [(n,) for n in removed])
+        conn.close()
+        logging.info(f'{self} refreshed, {len(rows)} added, {len(removed)} removed')
+        return len(rows), len(removed)
+
+    def build(self):
+        """Rebuilds the catalog from scratch."""
+        if self.exists():
+            os.remove(self.db_path)
+        return self.refresh()
+
+    def files(self, stat: str, days, years=(2000, 2019), variable=None, fhour: int=None) -> list:
+        """
+        Full paths of the files of stat on any of days (utils.day_of_year)
+        within years (inclusive), optionally of a variable (or any of a
+        list of names it is filed under) and of fhour, which also matches
+        files without a lead time in their name as they hold every one.
+        """
+        days = [int(n) for n in np.unique(days)]
+        query = f'SELECT name FROM files WHERE stat = ? AND doy IN ({",".join("?" * len(days))}) AND year BETWEEN ? AND ?'
+        args = [stat, *days, *years]
+        if variable is not None:
+            variables = [variable] if isinstance(variable, str) else list(variable)
+            query += f' AND variable IN ({",".join("?" * len(variables))})'
+            args += variables
+        if fhour is not None:
+            query += ' AND (fhour = ? OR fhour IS NULL)'
+            args.append(fhour)
+        conn = self.connect()
+        try:
+            names = [n for (n,) in conn.execute(query + ' ORDER BY date, name', args)]
+        finally:
+            conn.close()
+        return [f'{self.path}/{n}' for n in names]
+
+    def __len__(self):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        finally:
+            conn.close()
+
+
+@click.command()
+@click.option(
+    "-p",
+    "--path",
+    required=True,
+    help="The v12 reforecast directory."
+)
+@click.option(
+    "--db",
+    default=None,
+    help="Catalog location, default <path>/catalog.sqlite."
+)
+@click.option(
+    "-r",
+    "--rebuild",
+    default='n',
+    help="Rebuild the catalog from scratch instead of refreshing it."
+)
+def cli_main(path: str, db: str, rebuild: str):
+    catalog = ReforecastCatalog(path, db)
+    if ut.str_to_bool(rebuild):
+        added, removed = catalog.build()
+    else:
+        added, removed = catalog.refresh()
+    print(f'{catalog}: {len(catalog)} files, {added} added, {removed} removed')
+
+if __name__ == '__main__':
+    cli_main()
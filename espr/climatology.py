@@ -0,0 +1,148 @@
+import os
+import glob
+import json
+import hashlib
+import logging
+
+import numpy as np
+import xarray as xr
+
+import utils as ut
+from rechunk import store_path
+from transforms import AnalogClimatology
+
+
+class ClimatologyCache:
+    """
+    On-disk cache of MClimate windows, stored as one slab per day of year
+    (every reforecast year of that day) keyed by variable, stat, region,
+    forecast hour and the reforecast files it came from. A window is
+    assembled from the slabs of its days, so the four cycles of a day
+    reuse the same slabs and moving the window on by a day reads one new
+    day of year from the reforecast rather than all of them. Slabs are
+    evicted least recently used first once the cache exceeds its budget.
+
+    Parameters
+    ---------
+    cache_dir : str
+        Where slabs are kept, e.g. data_store/cache/climatology.
+    budget : float
+        Size in bytes above which least recently used slabs are removed.
+    """
+    def __init__(self, cache_dir: str, budget: float=5e9):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __str__(self):
+        return f'Climatology cache {self.cache_dir}'
+
+    def source_files(self, mcli, stat: str, days, subset_fhour: bool=False) -> list:
+        if mcli.v12:
+            return mcli.subset_time(stat, days, mcli.fhour if subset_fhour else None)
+        data_path = mcli.set_data_path(stat)
+        return glob.glob(data_path) + glob.glob(store_path(data_path))
+
+    def slab_key(self, mcli, stat: str, days, subset_fhour: bool=False) -> str:
+        """Hash of everything a slab depends on besides its day of year."""
+        sources = [[os.path.basename(n), os.path.getsize(n), os.path.getmtime(n)] for n in sorted(self.source_files(mcli, stat, days, subset_fhour))]
+        signature = [mcli.variable, stat, repr(mcli.region), mcli.fhour if subset_fhour else None, sources]
+        return hashlib.sha1(json.dumps(signature).encode()).hexdigest()[:10]
+
+    def slab_path(self, mcli, stat: str, doy: int, subset_fhour: bool=False) -> str:
+        days = [doy] if mcli.v12 else None
+        return f'{self.cache_dir}/{mcli.variable}_{stat}_{doy:03}_{self.slab_key(mcli, stat, days, subset_fhour)}.nc'
+
+    def write_slab(self, data, path: str):
+        data = data.copy()
+        for name in data.variables:
+            data[name].encoding = {}
+        data.to_netcdf(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+
+    def generate(self, mcli, stat: str, days, subset_fhour: bool=False):
+        # generate renames tmp925/tmp850 to tmp, so restore it for the next call
+        variable = mcli.variable
+        data = mcli.generate(stat, load=True, subset_fhour=subset_fhour, days=days)
+        mcli.variable = variable
+        return data
+
+    def fill(self, mcli, stat: str, missing: dict, subset_fhour: bool=False):
+        """
+        Generates the slabs of missing ({day of year: path}). Single
+        reforecast files are read once for all missing days and split by
+        day; v12 files are already per date so each day is generated on
+        its own.
+        """
+        if mcli.v12:
+            for doy, path in missing.items():
+                self.write_slab(self.generate(mcli, stat, [doy], subset_fhour), path)
+            return
+        data = self.generate(mcli, stat, list(missing), subset_fhour)
+        doys = ut.day_of_year(data.time.values)
+        for doy, path in missing.items():
+            self.write_slab(data.isel(time=np.nonzero(doys == doy)[0]), path)
+
+    def window(self, mcli, stat: str='mean', subset_fhour: bool=False):
+        """
+        The MClimate of stat over mcli's window, generating only the days
+        of year not already cached.
+        """
+        paths = {int(n): self.slab_path(mcli, stat, int(n), subset_fhour) for n in np.unique(mcli.window_days())}
+        missing = {n: p for n, p in paths.items() if not os.path.exists(p)}
+        if missing:
+            logging.info(f'{self}: generating {len(missing)} of {len(paths)} days for {mcli.variable} {stat}')
+            self.fill(mcli, stat, missing, subset_fhour)
+        slabs = []
+        for path in paths.values():
+            os.utime(path)
+            with xr.open_dataset(path) as slab:
+                slabs.append(slab.load())
+        dim = 'date' if mcli.v12 else 'time'
+        window = xr.concat(slabs, dim=dim)
+        if dim in window.coords:
+            window = window.sortby(dim)
+        window.attrs['climatology_key'] = hashlib.sha1(json.dumps(sorted(os.path.basename(n) for n in paths.values())).encode()).hexdigest()[:10]
+        self.evict(keep=paths.values())
+        return window
+
+    def analogs(self, mc_mean, mc_std, name: str='Pressure'):
+        """
+        The AnalogClimatology of mc_mean[name] and mc_std[name], windows
+        from this cache (possibly subset), loaded if it was already built
+        for the same slabs and grid and otherwise built and saved for the
+        next cycle.
+        """
+        return self._derived(AnalogClimatology, 'analogs', [mc_mean, mc_std], name,
+            lambda: AnalogClimatology.from_dataarrays(mc_mean[name], mc_std[name]))
+
+    def _derived(self, cls, kind: str, windows: list, name: str, build):
+        keys = [n.attrs.get('climatology_key') for n in windows]
+        if None in keys:
+            return build()
+        data = windows[0]
+        grid = hashlib.sha1(b''.join(data[n].values.tobytes() for n in data[name].dims if n != 'time' and n in data.coords)).hexdigest()[:10]
+        path = f'{self.cache_dir}/{name}_{"_".join(keys)}_{grid}.{kind}.nc'
+        if os.path.exists(path):
+            os.utime(path)
+            return cls.load(path)
+        derived = build()
+        derived.save(path)
+        return derived
+
+    def size(self) -> int:
+        return sum(os.path.getsize(n) for n in glob.glob(f'{self.cache_dir}/*.nc'))
+
+    def evict(self, keep=()):
+        """Removes least recently used slabs, other than keep, until the cache is within budget."""
+        keep = set(keep)
+        slabs = sorted(glob.glob(f'{self.cache_dir}/*.nc'), key=os.path.getmtime)
+        total = sum(os.path.getsize(n) for n in slabs)
+        for path in slabs:
+            if total <= self.budget:
+                break
+            if path in keep:
+                continue
+            total -= os.path.getsize(path)
+            os.remove(path)
+            logging.info(f'{self}: evicted {os.path.basename(path)}')
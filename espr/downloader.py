@@ -0,0 +1,221 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+import aiohttp
+from async_retrying import retry
+
+import utils
+import grib_idx
+
+
+class PooledDownloader:
+    """
+    Streaming download engine sharing one aiohttp session.
+    A single ClientSession (and its TCPConnector) is kept open for the
+    lifetime of a retrieval so connections to NOMADS are reused with
+    keep-alive instead of a new TLS handshake per file. Response bodies
+    are streamed to disk in chunks rather than buffered in memory.
+
+    Use as an async context manager:
+
+        async with PooledDownloader(download_dir) as dl:
+            await dl.fetch_all(links)
+
+    Parameters
+    ---------
+    download_dir : string
+        Directory the files are written to.
+    limit : int
+        Maximum number of open connections in the pool. Default is 10.
+    limit_per_host : int
+        Maximum number of open connections to a single host. Default is 10.
+    chunk_size : int
+        Size in bytes of each streamed chunk written to disk.
+    timeout : int
+        Socket read timeout in seconds for a single request.
+    keepalive_timeout : int
+        How long in seconds an idle connection is kept in the pool.
+    min_size : int
+        Responses smaller than this many bytes are treated as failed
+        and retried. Default is 100.
+    manifest : DownloadManifest
+        If set, each completed file is recorded in the manifest with
+        its size and sha256 checksum.
+    limiter : utils.AdaptiveLimiter
+        Concurrency limiter every request attempt (including retries)
+        passes through. Default is a fixed limit of limit_per_host.
+    """
+    def __init__(self,
+        download_dir: str,
+        limit: int=10,
+        limit_per_host: int=10,
+        chunk_size: int=2**16,
+        timeout: int=60,
+        keepalive_timeout: int=30,
+        min_size: int=100,
+        manifest=None,
+        limiter=None):
+
+        self.download_dir = download_dir
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.keepalive_timeout = keepalive_timeout
+        self.min_size = min_size
+        self.manifest = manifest
+        if limiter is None:
+            limiter = utils.AdaptiveLimiter(limit_per_host, minimum=limit_per_host, maximum=limit_per_host)
+        self.limiter = limiter
+        self.session = None
+        self.reset_stats()
+
+    def __str__(self):
+        return f'Pooled downloader ({self.limit_per_host} per host) to {self.download_dir}'
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=max(self.limit, self.limiter.maximum),
+            limit_per_host=max(self.limit_per_host, self.limiter.maximum),
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=300)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+            trust_env=True)
+        return self
+
+    async def __aexit__(self, *_):
+        await self.session.close()
+        self.session = None
+
+    def reset_stats(self):
+        self.stats = {'files': 0, 'bytes': 0, 'elapsed': 0.}
+
+    def throughput(self):
+        """Returns (files/s, MB/s) for everything fetched since the last reset."""
+        elapsed = max(self.stats['elapsed'], 1e-9)
+        return self.stats['files']/elapsed, self.stats['bytes']/1e6/elapsed
+
+    async def _stream(self, resp, f, checksum):
+        size = 0
+        async for chunk in resp.content.iter_chunked(self.chunk_size):
+            f.write(chunk)
+            checksum.update(chunk)
+            size += len(chunk)
+        return size
+
+    async def _finish(self, link, filename, size, checksum, manifest=None, **extra):
+        out_path = f'{self.download_dir}/{filename}'
+        part_path = f'{out_path}.part'
+        if size < self.min_size:
+            os.remove(part_path)
+            logging.warning(f'{filename} less than {self.min_size} bytes, rerunning')
+            await asyncio.sleep(1)
+            raise aiohttp.ClientPayloadError(f'{filename} returned {size} bytes')
+        os.replace(part_path, out_path)
+        if manifest is None:
+            manifest = self.manifest
+        if manifest is not None:
+            manifest.record(filename, link, size, checksum.hexdigest(), **extra)
+        self.stats['files'] += 1
+        self.stats['bytes'] += size
+        logging.info(f'{filename} downloaded')
+        return size
+
+    @retry(attempts=20)
+    async def fetch(self, link, filename=None, manifest=None):
+        """
+        Streams one link to download_dir, returning the number of bytes written.
+        Data is written to a .part file which is only renamed into place once
+        the response has been fully read, so an interrupted transfer never
+        leaves a truncated file under the final name. manifest overrides
+        the downloader's manifest for this file.
+        """
+        if filename is None:
+            filename = utils.link_filename(link)
+        checksum = hashlib.sha256()
+        async with self.limiter.slot():
+            async with self.session.get(link, raise_for_status=True) as resp:
+                with open(f'{self.download_dir}/{filename}.part', mode='wb') as f:
+                    size = await self._stream(resp, f, checksum)
+        return await self._finish(link, filename, size, checksum, manifest)
+
+    async def fetch_text(self, url):
+        async with self.limiter.slot():
+            async with self.session.get(url, raise_for_status=True) as resp:
+                return await resp.text()
+
+    @retry(attempts=20)
+    async def fetch_idx(self, link, variables, levels=None, filename=None, manifest=None, **extra):
+        """
+        Byte-range retrieval of a GRIB2 file. Reads link's .idx inventory,
+        selects the messages for variables (and levels), merges adjacent
+        messages into single ranges and fetches only those bytes with
+        HTTP Range requests, concatenating them into one GRIB2 file.
+        """
+        if filename is None:
+            filename = utils.link_filename(link)
+        messages = grib_idx.parse_idx(await self.fetch_text(f'{link}.idx'))
+        selected = grib_idx.select_messages(messages, variables, levels)
+        if not selected:
+            raise ValueError(f'no messages for {variables} {levels or ""} in {filename}.idx')
+        size = 0
+        checksum = hashlib.sha256()
+        with open(f'{self.download_dir}/{filename}.part', mode='wb') as f:
+            for start, end in grib_idx.byte_ranges(selected):
+                headers = {'Range': grib_idx.range_header(start, end)}
+                async with self.limiter.slot():
+                    async with self.session.get(link, headers=headers, raise_for_status=True) as resp:
+                        if resp.status != 206:
+                            raise aiohttp.ClientPayloadError(f'range request for {filename} returned {resp.status}')
+                        size += await self._stream(resp, f, checksum)
+        return await self._finish(link, filename, size, checksum, manifest, **extra)
+
+    @retry(attempts=20)
+    async def probe(self, url):
+        """
+        True if url exists. Uses a HEAD request, falling back to a
+        zero-length range GET when the server does not allow HEAD.
+        A throttle response (429/503) or timeout is not an answer: it is
+        raised inside the limiter slot, so the limiter backs off, and the
+        probe is retried, raising once attempts run out rather than
+        reporting a throttled file as unpublished.
+        """
+        try:
+            async with self.limiter.slot():
+                async with self.session.head(url, allow_redirects=True) as resp:
+                    if resp.status in (429, 503):
+                        resp.raise_for_status()
+                    if resp.status != 405:
+                        return resp.status < 400
+                async with self.session.get(url, headers={'Range': 'bytes=0-0'}) as resp:
+                    if resp.status in (429, 503):
+                        resp.raise_for_status()
+                    return resp.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            if utils.is_throttle(exc):
+                raise
+            return False
+
+    async def probe_all(self, urls):
+        """Probes every url concurrently through the limiter, returning a dict of url to bool."""
+        found = await asyncio.gather(*[self.probe(url) for url in urls])
+        return dict(zip(urls, found))
+
+    async def fetch_all(self, links, fetch=None):
+        """
+        Fetches every link through the shared session, with concurrency
+        governed by the limiter, and logs throughput. fetch is the
+        coroutine function used per link, default self.fetch.
+        """
+        fetch = fetch or self.fetch
+        start = time.perf_counter()
+        sizes = await asyncio.gather(*[fetch(link) for link in links])
+        self.stats['elapsed'] += time.perf_counter() - start
+        files_s, mb_s = self.throughput()
+        logging.info(f'{len(links)} files fetched, {files_s:.2f} files/s, {mb_s:.2f} MB/s, {self.limiter}')
+        return sizes
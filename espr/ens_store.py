@@ -0,0 +1,164 @@
+import os
+import re
+import logging
+import threading
+
+import numpy as np
+import xarray as xr
+import dask.array as da
+import cfgrib
+
+
+MEMBER_RE = re.compile(r'^ge[cp](\d{2})\.t\d{2}z\.pgrb2s\.0p25\.f(\d{3})$')
+# names decode_fields gives GRIB variables at grib_filter levels; isobaric
+# levels take the short name plus the level, e.g. (TMP, 850_mb) -> t850
+FIELD_NAMES = {
+    ('PRMSL', 'mean_sea_level'): 'prmsl',
+    ('PWAT', 'entire_atmosphere_(considered_as_a_single_layer)'): 'pwat',
+    ('TCDC', 'entire_atmosphere'): 'tcc',
+    ('APCP', 'surface'): 'tp',
+    ('CAPE', 'surface'): 'cape',
+    ('TMP', '2_m_above_ground'): 't2m',
+    ('DPT', '2_m_above_ground'): 'd2m',
+    ('RH', '2_m_above_ground'): 'r2',
+    ('UGRD', '10_m_above_ground'): 'u10',
+    ('VGRD', '10_m_above_ground'): 'v10',
+}
+ISOBARIC_NAMES = {'TMP': 't', 'RH': 'r', 'UGRD': 'u', 'VGRD': 'v'}
+ISOBARIC_RE = re.compile(r'^(\d+)_mb$')
+
+def member_fhour(filename: str):
+    """Member number and lead time of an ensemble file, e.g. gep05...f012 -> (5, 12)."""
+    match = MEMBER_RE.match(filename)
+    assert match is not None, f'{filename} is not a GEFS ensemble member file'
+    return int(match.group(1)), int(match.group(2))
+
+def field_names(variables, levels):
+    """
+    Store variable names of the configured GRIB variables and levels, as
+    decode_fields names their fields. Combinations missing from
+    FIELD_NAMES, and every level when levels is None, are left out.
+    """
+    names = set()
+    for variable in variables:
+        for level in levels or []:
+            match = ISOBARIC_RE.match(level)
+            if match is not None and variable in ISOBARIC_NAMES:
+                names.add(f'{ISOBARIC_NAMES[variable]}{match.group(1)}')
+            elif (variable, level) in FIELD_NAMES:
+                names.add(FIELD_NAMES[(variable, level)])
+    return sorted(names)
+
+def decode_fields(path: str, latitude_bounds=None, longitude_bounds=None):
+    """
+    Decodes every message of a GRIB2 file into 2d float32 fields keyed by
+    cfgrib short name, with the level appended for isobaric fields
+    (t850, t925). Returns (fields, latitudes, longitudes), subset to the
+    bounds if given.
+    """
+    fields = {}
+    for ds in cfgrib.open_datasets(path, backend_kwargs=dict(indexpath='')):
+        if latitude_bounds is not None:
+            ds = ds.sel(latitude=slice(max(latitude_bounds), min(latitude_bounds)),
+                longitude=slice(min(longitude_bounds), max(longitude_bounds)))
+        for name, variable in ds.data_vars.items():
+            if 'isobaricInhPa' in variable.dims:
+                for level in variable.isobaricInhPa.values:
+                    fields[f'{name}{int(level)}'] = variable.sel(isobaricInhPa=level).values.astype('float32')
+            elif 'isobaricInhPa' in variable.coords:
+                fields[f'{name}{int(variable.isobaricInhPa)}'] = variable.values.astype('float32')
+            else:
+                fields[name] = variable.values.astype('float32')
+        latitudes, longitudes = ds.latitude.values, ds.longitude.values
+    return fields, latitudes, longitudes
+
+
+class EnsembleStore:
+    """
+    Consolidated zarr store for the ens stat of one GEFS cycle.
+    Rather than leaving one small GRIB file per member and lead time in
+    the download directory, each file is decoded as soon as it lands and
+    written into a member x fhour x lat x lon array per variable, after
+    which the GRIB file is deleted and the manifest entry marked ingested.
+    Each (member, fhour) is its own chunk, so files landing concurrently
+    write to separate chunks, and reading the ensemble is a single
+    open of the store.
+
+    Parameters
+    ---------
+    manifest : DownloadManifest
+        The cycle's ens manifest; the store lives at manifest.store_path.
+    members : list
+        Member names in store order, e.g. gec00, gep01, ... gep30.
+    fhours : list
+        Lead times in store order.
+    names : list
+        Variables the store is created with, from the retrieval's
+        variables and levels (see field_names) rather than whichever file
+        is ingested first. A field outside them is added to the store
+        when a file carrying it is ingested.
+    """
+    def __init__(self, manifest, members, fhours, names=()):
+        self.manifest = manifest
+        self.path = manifest.store_path
+        self.members = list(members)
+        self.fhours = list(fhours)
+        self.names = list(names)
+        self.stored = None
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return f'Ensemble store {self.path}'
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _empty(self, names, latitudes, longitudes):
+        shape = (len(self.members), len(self.fhours), len(latitudes), len(longitudes))
+        chunks = (1, 1, len(latitudes), len(longitudes))
+        return xr.Dataset(
+            {n: (('member', 'fhour', 'lat', 'lon'), da.full(shape, np.nan, chunks=chunks, dtype='float32')) for n in sorted(names)},
+            coords={'member': self.members, 'fhour': self.fhours, 'lat': latitudes, 'lon': longitudes},
+            attrs={'cycle': self.manifest.cycle})
+
+    def create(self, names, latitudes, longitudes):
+        """Writes the store metadata and coordinates with every chunk empty."""
+        self._empty(names, latitudes, longitudes).to_zarr(self.path, mode='w', compute=False)
+        self.stored = set(names)
+        logging.info(f'{self} created, {len(names)} variables, shape {(len(self.members), len(self.fhours), len(latitudes), len(longitudes))}')
+
+    def add_variables(self, names, latitudes, longitudes):
+        """Adds empty variables to an existing store."""
+        self._empty(names, latitudes, longitudes).drop_vars(['member', 'fhour', 'lat', 'lon']).to_zarr(self.path, mode='a', compute=False)
+        self.stored |= set(names)
+        logging.info(f'{self}: added {sorted(names)}')
+
+    def stored_names(self) -> set:
+        if self.stored is None:
+            with xr.open_zarr(self.path) as ds:
+                self.stored = set(ds.data_vars)
+        return self.stored
+
+    def ingest(self, filename: str):
+        """
+        Decodes filename into its (member, fhour) chunk, marks it ingested
+        in the manifest and removes the GRIB file.
+        """
+        path = self.manifest.file_path(filename)
+        bounds = self.manifest.entries.get(filename, {})
+        fields, latitudes, longitudes = decode_fields(path, bounds.get('latitude_bounds'), bounds.get('longitude_bounds'))
+        with self.lock:
+            if not self.exists():
+                self.create(set(self.names) | set(fields), latitudes, longitudes)
+            elif set(fields) - self.stored_names():
+                self.add_variables(set(fields) - self.stored_names(), latitudes, longitudes)
+        member, fhour = member_fhour(filename)
+        m, f = member, self.fhours.index(fhour)
+        ds = xr.Dataset({n: (('member', 'fhour', 'lat', 'lon'), v[None, None]) for n, v in fields.items()})
+        ds.to_zarr(self.path, region={'member': slice(m, m+1), 'fhour': slice(f, f+1)})
+        self.manifest.mark_ingested(filename)
+        os.remove(path)
+        logging.info(f'{filename} ingested')
+
+    def open(self):
+        return xr.open_zarr(self.path)
@@ -4,6 +4,59 @@ import xarray.ufuncs as xu
 import utils as ut
 import os
 import glob
+import json
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import eccodes
+from manifest import DownloadManifest
+from region import Region
+
+def _open_grib(path, key_filter, index_dir=None):
+    """
+    Opens one GRIB file with cfgrib, using the shared index cache in
+    index_dir if given so the file is only scanned once across opens.
+    """
+    if index_dir is None:
+        return xr.open_dataset(path, engine='cfgrib', backend_kwargs=dict(filter_by_keys=key_filter, indexpath=''))
+    with ut.grib_index_lock(path, index_dir):
+        return xr.open_dataset(path, engine='cfgrib', backend_kwargs=dict(filter_by_keys=key_filter, indexpath=ut.grib_indexpath(path, index_dir)))
+
+def _decode_file(path, key_filter, region=None, index_dir=None):
+    """
+    Decodes the messages of one GRIB file matching key_filter, within
+    region if given, into plain arrays. Runs in a worker process, so only
+    numpy arrays are returned.
+    """
+    with _open_grib(path, key_filter, index_dir) as full:
+        ds = full if region is None else region.isel(full, 'latitude', 'longitude')
+        return {
+            'values': {n: ds[n].values.astype('float32') for n in ds.data_vars},
+            'attrs': {n: ds[n].attrs for n in ds.data_vars},
+            'dataset_attrs': ds.attrs,
+            'latitude': ds.latitude.values,
+            'longitude': ds.longitude.values,
+            'time': ds.time.values,
+            'step': ds.step.values,
+            'valid_time': ds.valid_time.values,
+            'coords': {n: ds[n].values for n in ds.coords if ds[n].ndim == 0 and n not in ['time', 'step', 'valid_time']},
+        }
+
+def _message_matches(gid, key_filter):
+    for key, value in key_filter.items():
+        try:
+            if eccodes.codes_get(gid, key) != value:
+                return False
+        except eccodes.KeyValueNotFoundError:
+            return False
+    return True
+
+def _message_time(gid):
+    """Reference time and step of a GRIB message, as cfgrib reports them."""
+    date, hour = str(eccodes.codes_get(gid, 'dataDate')), eccodes.codes_get(gid, 'dataTime')
+    time = np.datetime64(f'{date[:4]}-{date[4:6]}-{date[6:]}T{hour//100:02}:{hour%100:02}', 'ns')
+    step = np.timedelta64(int(eccodes.codes_get(gid, 'endStep')), 'h').astype('timedelta64[ns]')
+    return time, step
 
 class ForecastArray:
     """
@@ -35,10 +88,41 @@ class ForecastArray:
         The length of the period which the forecast xarray will be 
         centered around (e.g. +-10 days about forecast date).
         Default is 10.
+    cache : bool
+        If true (default), the decoded forecast is kept in one netcdf
+        file per cycle, variable and stat under data_store/cache and
+        read from there while the source files are unchanged.
+    decoder : str
+        cfgrib (default) opens each file lazily with cfgrib and
+        concatenates them along time. process
+        decodes each file in a process pool and fills one preallocated
+        (fhour, lat, lon) array per variable. eccodes iterates the
+        messages in process and writes matching values straight into
+        that array, building coordinates once from the first message.
+    workers : int
+        Worker processes for the process decoder, default os.cpu_count().
+    region : Region
+        If given, only the region's lead time files are read and every
+        decoder subsets to its bounds by index as files are decoded,
+        e.g. Region.from_config('slp').
+    index_cache : bool
+        If true (default), cfgrib indexes are kept in data_store/cache/cfgrib
+        keyed by file path, size and mtime, so mean, sprd and every
+        variable reuse one scan of each file. They are removed when the
+        cycle is pruned from the download directory.
         
     """
 
-    def __init__(self, stat: str, variable: str, paths: dict=None, group: bool=False):
+    def __init__(self, 
+        stat: str, 
+        variable: str, 
+        paths: dict=None, 
+        group: bool=False, 
+        cache: bool=True, 
+        decoder: str='cfgrib',
+        workers: int=None,
+        region: Region=None,
+        index_cache: bool=True):
         self.variable = self.convert_variable(variable)
         if stat == 'mean':
             stat = 'geavg'
@@ -47,6 +131,12 @@ class ForecastArray:
         else:
             raise ValueError('Stat must be mean or sprd/std')
         self.stat = stat
+        self.cache = cache
+        assert decoder in self._decoder_list(), f'decoder must be one of {self._decoder_list()}'
+        self.decoder = decoder
+        self.workers = workers
+        self.region = region
+        self.index_cache = index_cache
         if paths == None:
             self.paths = ut.load_paths()
         else:
@@ -57,28 +147,34 @@ class ForecastArray:
     def convert_variable(self, variable):
         if variable in ['slp','psl','prmsl']:
             self.in_var = 'prmsl'
-            self.key_filter = {'typeOfLevel':'meanSea'}
         elif variable in ['precip','pwat']:
             self.in_var = 'pwat'
-            self.key_filter = {'typeOfLevel':'unknown', 'level': 0}
         elif variable in ['temp','tmp','tmp850','tmp925']:
             self.short_name = 't'
             if '925' in variable:
-                self.key_filter = {'typeOfLevel':'isobaricInhPa','level': 925, 'shortName': 't'}
                 self.in_var = 'tmp925'
             elif '850' in variable:
-                self.key_filter = {'typeOfLevel':'isobaricInhPa','level': 850, 'shortName': 't'}
                 self.in_var = 'tmp850'
             else:
                 raise Exception('Temperature level must be indicated (925 or 850)')
         elif variable in ['wnd', 'wind', 'sfc_wind', '10m_wnd', 'u10', 'v10']:
             self.in_var = 'wnd'
-            self.key_filter = {'typeOfLevel': 'heightAboveGround', 'level': 10}
+        self.key_filter = self._variable_registry()[self.in_var]
         return self.in_var
     
     def _var_list(self):
         return ['prmsl','pwat','tmp','wnd']
 
+    def _variable_registry(self):
+        """GRIB key filters of every variable load_all extracts, by in_var."""
+        return {
+            'prmsl': {'typeOfLevel':'meanSea', 'shortName': 'prmsl'},
+            'pwat': {'typeOfLevel':'unknown', 'level': 0, 'shortName': 'pwat'},
+            'tmp850': {'typeOfLevel':'isobaricInhPa','level': 850, 'shortName': 't'},
+            'tmp925': {'typeOfLevel':'isobaricInhPa','level': 925, 'shortName': 't'},
+            'wnd': {'typeOfLevel': 'heightAboveGround', 'level': 10},
+        }
+
     def _map(self, data):
         if self.in_var == 'prmsl':
             data = data.rename({'prmsl':'Pressure'})
@@ -88,6 +184,9 @@ class ForecastArray:
 
     def _stat_list(self):
         return ['sprd', 'mean']
+
+    def _decoder_list(self):
+        return ['cfgrib', 'process', 'eccodes']
     
     def _get_var(self, data):
         if self.in_var == 'wnd':
@@ -105,9 +204,7 @@ class ForecastArray:
         return subset_variable
         
     def _subset_latlon(self, data, lats, lons):
-        data = data.where(np.logical_and(data.lon>=np.min(lons), data.lon<=np.max(lons)), drop=True)
-        data = data.where(np.logical_and(data.lat>=np.min(lats), data.lat<=np.max(lats)), drop=True)
-        return data
+        return Region(lats, lons).isel(data)
         
     def _rename_latlon(self, forecast):
         try:
@@ -116,24 +213,301 @@ class ForecastArray:
             forecast = forecast.rename({'latitude':'lat','longitude':'lon'})
         return forecast
 
+    def _manifest_stat(self):
+        return {'geavg': 'mean', 'gespr': 'sprd'}[self.stat]
+
+    def file_list(self):
+        """
+        Complete files for the newest cycle in the download manifest.
+        Falls back to globbing data_store if no manifest has been written.
+        Lead times outside the region are left out.
+        """
+        manifest = DownloadManifest.latest(self.paths["data_store"], self._manifest_stat())
+        if manifest is not None:
+            self.manifest = manifest
+            flist = [n for n in manifest.complete_files() if self.stat in os.path.basename(n)]
+        else:
+            flist = [n for n in glob.glob(f'{self.paths["data_store"]}/*') if self.stat in n and '.idx' not in n]
+        if self.region is not None:
+            flist = [n for n in flist if self.region.includes_file(n)]
+        return flist
+
+    def cache_path(self):
+        cycle = self.manifest.cycle if getattr(self, 'manifest', None) is not None else 'latest'
+        return f'{self.paths["data_store"]}/cache/{cycle}_{self.in_var}_{self._manifest_stat()}.nc'
+
+    def source_signature(self, flist):
+        """Region and the name, size and mtime of every source file; the cache is stale if any changes."""
+        return json.dumps([repr(self.region)] + [[os.path.basename(n), os.path.getsize(n), os.path.getmtime(n)] for n in sorted(flist)])
+
+    def read_cache(self, flist):
+        """The cached forecast for flist, or None if there is none or it is stale."""
+        try:
+            with xr.open_dataset(self.cache_path()) as cached:
+                if cached.attrs.get('sources') != self.source_signature(flist):
+                    return None
+                return cached.load()
+        except (FileNotFoundError, OSError):
+            return None
+
+    def write_cache(self, data, flist):
+        """
+        Writes data to cache_path with one chunk per lead time, replacing
+        the caches of older cycles for this variable and stat.
+        """
+        path = self.cache_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for old in glob.glob(f'{os.path.dirname(path)}/*_{self.in_var}_{self._manifest_stat()}.nc'):
+            if old != path:
+                os.remove(old)
+        data = data.copy()
+        data.attrs['sources'] = self.source_signature(flist)
+        encoding = {}
+        for name in data.variables:
+            data[name].encoding = {}
+            if name in data.data_vars and data[name].ndim == 3:
+                encoding[name] = {'chunksizes': (1,) + data[name].shape[1:]}
+        data.to_netcdf(f'{path}.tmp', encoding=encoding)
+        os.replace(f'{path}.tmp', path)
+
+    def _assemble(self, decoded):
+        """
+        Builds the forecast Dataset from per-file decode results, in file
+        order, copying each field into one preallocated array per variable.
+        """
+        first = decoded[0]
+        shape = (len(decoded), len(first['latitude']), len(first['longitude']))
+        buffers = {n: np.empty(shape, dtype='float32') for n in first['values']}
+        for i, result in enumerate(decoded):
+            for name, values in result['values'].items():
+                buffers[name][i] = values
+        return self._build_dataset(buffers, 
+            np.array([n['time'] for n in decoded]), 
+            np.array([n['step'] for n in decoded]), 
+            first['latitude'], 
+            first['longitude'], 
+            first['coords'], 
+            first['attrs'], 
+            first['dataset_attrs'])
+
+    def _build_dataset(self, buffers, time, step, latitude, longitude, coords, attrs, dataset_attrs):
+        coords = dict(coords, 
+            time=time, 
+            step=('time', step), 
+            valid_time=('time', time + step), 
+            latitude=latitude, 
+            longitude=longitude)
+        return xr.Dataset({n: (('time', 'latitude', 'longitude'), buffers[n], attrs.get(n, {})) for n in buffers}, 
+            coords=coords, attrs=dataset_attrs)
+
+    def decode_eccodes(self, flist):
+        """
+        Decodes flist by iterating GRIB messages with eccodes. Only header
+        keys are read for messages that do not match key_filter; matching
+        values go directly into a float32 (fhour, lat, lon) buffer per
+        variable, and the Dataset is built once at the end. The buffer
+        only covers the region, whose index slices are found once.
+        """
+        buffers, coords, time, step, latitude, longitude = self._scan_messages(flist, {self.in_var: self.key_filter})
+        if not buffers[self.in_var]:
+            raise FileNotFoundError('sprd files likely not in download folder, please check!')
+        return self._build_dataset(buffers[self.in_var], time, step, latitude, longitude, coords[self.in_var], {}, {})
+
+    def _scan_messages(self, flist, key_filters):
+        """
+        One eccodes pass over every message of flist, matching each against
+        key_filters ({name: key_filter}). Returns the buffers
+        {name: {cfVarName: array}} and level coordinates {name: coords},
+        along with the time, step, latitude and longitude coordinates.
+        """
+        buffers = {n: {} for n in key_filters}
+        coords = {n: {} for n in key_filters}
+        latitude = longitude = None
+        time = np.full(len(flist), np.datetime64('NaT'), dtype='datetime64[ns]')
+        step = np.full(len(flist), np.timedelta64('NaT'), dtype='timedelta64[ns]')
+        for i, path in enumerate(flist):
+            with open(path, 'rb') as f:
+                while True:
+                    gid = eccodes.codes_grib_new_from_file(f)
+                    if gid is None:
+                        break
+                    try:
+                        matched = [n for n in key_filters if _message_matches(gid, key_filters[n])]
+                        if not matched:
+                            continue
+                        if latitude is None:
+                            latitude = np.linspace(eccodes.codes_get(gid, 'latitudeOfFirstGridPointInDegrees'), 
+                                eccodes.codes_get(gid, 'latitudeOfLastGridPointInDegrees'), eccodes.codes_get(gid, 'Nj'))
+                            longitude = np.linspace(eccodes.codes_get(gid, 'longitudeOfFirstGridPointInDegrees'), 
+                                eccodes.codes_get(gid, 'longitudeOfLastGridPointInDegrees'), eccodes.codes_get(gid, 'Ni'))
+                            grid = (len(latitude), len(longitude))
+                            lat_slice = self.region.lat_slice(latitude) if self.region is not None else slice(None)
+                            lon_slice = self.region.lon_slice(longitude) if self.region is not None else slice(None)
+                            latitude, longitude = latitude[lat_slice], longitude[lon_slice]
+                        values = eccodes.codes_get_values(gid).reshape(grid)[lat_slice, lon_slice]
+                        cf_name = eccodes.codes_get(gid, 'cfVarName')
+                        for name in matched:
+                            if cf_name not in buffers[name]:
+                                buffers[name][cf_name] = np.full((len(flist), len(latitude), len(longitude)), np.nan, dtype='float32')
+                                coords[name][eccodes.codes_get(gid, 'typeOfLevel')] = float(eccodes.codes_get(gid, 'level'))
+                            buffers[name][cf_name][i] = values
+                        time[i], step[i] = _message_time(gid)
+                    finally:
+                        eccodes.codes_release(gid)
+        return buffers, coords, time, step, latitude, longitude
+
+    def load_all(self):
+        """
+        Loads every variable in the registry from a single pass over this
+        stat's files, so each file is opened and scanned once however many
+        variables are needed. Returns {in_var: DataArray}; wnd is the 10 m
+        wind speed, and variables missing from the files are left out.
+        """
+        registry = self._variable_registry()
+        flist = self.file_list()
+        if not flist:
+            raise FileNotFoundError(f'no {self._manifest_stat()} ({self.stat}) files in {self.paths["data_store"]}, please check the download folder!')
+        buffers, coords, time, step, latitude, longitude = self._scan_messages(flist, registry)
+        self.grouped = {}
+        for name in registry:
+            if not buffers[name]:
+                continue
+            data = self._rename_latlon(self._build_dataset(buffers[name], time, step, latitude, longitude, coords[name], {}, {}))
+            if name == 'wnd':
+                fields = [data[n] for n in data.data_vars]
+                self.grouped[name] = np.sqrt(fields[0]**2 + fields[1]**2).rename('wnd')
+            else:
+                field = data[list(data.data_vars)[0]]
+                self.grouped[name] = field.rename({'prmsl': 'Pressure', 'pwat': 'Precipitable_water'}.get(field.name, field.name))
+        self.date = str(time[0]).partition('T')[0]
+        return self.grouped
+
+    def decode_process(self, flist):
+        """Decodes flist in a process pool, one file per task."""
+        with ProcessPoolExecutor(max_workers=self.workers or os.cpu_count()) as pool:
+            decoded = list(pool.map(_decode_file, flist, 
+                [self.key_filter]*len(flist), 
+                [self.region]*len(flist), 
+                [self.index_dir()]*len(flist)))
+        if not decoded:
+            raise FileNotFoundError('sprd files likely not in download folder, please check!')
+        return self._assemble(decoded)
+
+    def index_dir(self):
+        """Shared cfgrib index directory, or None if indexes are not cached."""
+        return ut.grib_index_dir(self.paths["data_store"]) if self.index_cache else None
+
+    def decode(self, flist):
+        """
+        Decodes flist with the configured decoder. cfgrib opens each file
+        lazily through the index cache, subsets it to the region and
+        concatenates along time before loading.
+        """
+        if self.decoder == 'process':
+            return self.decode_process(flist)
+        if self.decoder == 'eccodes':
+            return self.decode_eccodes(flist)
+        if not flist:
+            raise FileNotFoundError('sprd files likely not in download folder, please check!')
+        try:
+            datasets = [_open_grib(path, self.key_filter, self.index_dir()) for path in flist]
+            if self.region is not None:
+                datasets = [self.region.isel(n, 'latitude', 'longitude') for n in datasets]
+            return xr.concat(datasets, dim='time').compute()
+        except OSError:
+            raise FileNotFoundError('sprd files likely not in download folder, please check!')
+
+    def load_lead_time(self, path):
+        """One lead time file as a (lat, lon) Dataset carrying its step and valid_time."""
+        buffers, coords, time, step, latitude, longitude = self._scan_messages([path], {self.in_var: self.key_filter})
+        if not buffers[self.in_var]:
+            raise FileNotFoundError(f'no {self.in_var} messages in {path}')
+        data = self._build_dataset(buffers[self.in_var], time, step, latitude, longitude, coords[self.in_var], {}, {})
+        return self._map(self._rename_latlon(data)).isel(time=0)
+
+    def _stream_fhours(self, retrieval, fhours=None):
+        """fhours, by default every lead time retrieval downloads, within the region."""
+        if fhours is None:
+            fhours = np.arange(0, retrieval.hour_end+1, retrieval.freq)
+        return [int(n) for n in fhours if self.region is None or self.region.includes_fhour(n)]
+
+    def _lead_time_files(self, manifest, fhours):
+        return [f'{self.stat}.t{manifest.cycle[-2:]}z.pgrb2s.0p25.f{n:03}' for n in fhours]
+
+    def iter_forecast(self, retrieval, fhours=None, poll_interval: float=10., timeout: float=3*3600):
+        """
+        Yields retrieval's cycle one lead time at a time, in lead time order,
+        as soon as each file is complete in that cycle's download manifest,
+        so work can start before the cycle has finished downloading and
+        only one lead time is held in memory. The cycle is retrieval's
+        date_value and hour_value rather than the newest manifest on disk,
+        which until the new cycle's first file lands is the previous one.
+        fhours defaults to the lead times retrieval downloads (hour_end
+        every freq hours) within the region.
+        """
+        self.manifest = retrieval.manifest(self._manifest_stat())
+        for filename in self._lead_time_files(self.manifest, self._stream_fhours(retrieval, fhours)):
+            waited = 0.
+            while not self.manifest.is_complete(filename):
+                if waited > timeout:
+                    raise TimeoutError(f'{filename} not complete after {timeout}s')
+                time.sleep(poll_interval)
+                waited += poll_interval
+                self.manifest.load()
+            yield self.load_lead_time(self.manifest.file_path(filename))
+
+    async def aiter_forecast(self, retrieval=None, monitor=None, fhours=None, poll_interval: float=10., timeout: float=3*3600):
+        """
+        Async iter_forecast. Given a LeadTimeMonitor, each lead time of this
+        stat is yielded as its LeadTimeReady event arrives; otherwise
+        retrieval's manifest is polled without blocking the event loop.
+        Files are decoded in a worker thread so downloads keep running
+        meanwhile.
+        """
+        assert retrieval is not None or monitor is not None, 'retrieval or monitor must be given to set the cycle'
+        loop = asyncio.get_event_loop()
+        if monitor is not None:
+            async for event in monitor.events():
+                if event.stat != self._manifest_stat():
+                    continue
+                if fhours is not None and event.fhour not in fhours:
+                    continue
+                if self.region is not None and not self.region.includes_fhour(event.fhour):
+                    continue
+                for path in event.paths:
+                    if self.stat in os.path.basename(path):
+                        yield await loop.run_in_executor(None, self.load_lead_time, path)
+            return
+        self.manifest = retrieval.manifest(self._manifest_stat())
+        for filename in self._lead_time_files(self.manifest, self._stream_fhours(retrieval, fhours)):
+            waited = 0.
+            while not self.manifest.is_complete(filename):
+                if waited > timeout:
+                    raise TimeoutError(f'{filename} not complete after {timeout}s')
+                await asyncio.sleep(poll_interval)
+                waited += poll_interval
+                self.manifest.load()
+            yield await loop.run_in_executor(None, self.load_lead_time, self.manifest.file_path(filename))
+
     def load_forecast(self, subset_lat=None, subset_lon=None):
         try:
-            flist = [n for n in glob.glob(f'{self.paths["data_store"]}/*') if self.stat in n and '.idx' not in n]
-            try:
-                new_gefs = xr.open_mfdataset(flist,
-                engine='cfgrib',
-                combine='nested',
-                concat_dim='time',
-                chunks={'lat':5,'lon':5},
-                backend_kwargs=dict(filter_by_keys=self.key_filter,indexpath='')
-                ).compute()
-            except OSError:
-                raise FileNotFoundError('sprd files likely not in download folder, please check!')
+            flist = self.file_list()
+            new_gefs = self.read_cache(flist) if self.cache else None
+            if new_gefs is None:
+                new_gefs = self._rename_latlon(self.decode(flist))
+                if self.cache:
+                    self.write_cache(new_gefs, flist)
         except KeyError:
             import cfgrib
             new_gefs = cfgrib.open_datasets(f'{self.paths["data_store"]}gefs_mean_000.grib2')
+            new_gefs = self._rename_latlon(new_gefs)
         subset_gefs = self._get_var(new_gefs)
-        subset_gefs = self._rename_latlon(new_gefs)
+        subset_gefs = new_gefs
+        if subset_lat is None and subset_lon is None and getattr(self, 'manifest', None) is not None:
+            # files fetched by .idx byte range cover the full globe
+            bounds = self.manifest.bounds()
+            if bounds is not None:
+                subset_lat, subset_lon = bounds
         if subset_lat is not None and subset_lon is not None:
             subset_gefs = self._subset_latlon(subset_gefs, subset_lat, subset_lon)
         else:
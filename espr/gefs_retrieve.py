@@ -5,12 +5,11 @@ from datetime import datetime
 from time import sleep
 import logging
 from typing import Tuple
+from urllib.parse import quote
 import numpy as np
 import sys
 import requests
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-from bs4 import BeautifulSoup
+from listing import DirectoryListing
 import asyncio
 from async_retrying import retry
 import utils 
@@ -20,6 +19,13 @@ from datetime import datetime
 import glob
 import cfgrib
 import time
+import hashlib
+from functools import partial
+from downloader import PooledDownloader
+import grib_idx
+from monitor import LeadTimeMonitor
+from manifest import DownloadManifest, file_checksum, cycle_key
+from ens_store import EnsembleStore, field_names
 
 class GEFSRetrieve:
     """
@@ -31,10 +37,15 @@ class GEFSRetrieve:
 
     Parameters
     ---------
-    variable : string
-        The variable of interest. Can be slp, pwat, tmp925, tmp850,
-        or wnd (surface) currently. Other short names will be 
-        accepted for the most part.
+    variable : string or list
+        The variable(s) of interest as GRIB short names, e.g. PRMSL or
+        ['PRMSL', 'PWAT', 'TMP']. All variables are requested together
+        in one query per file.
+    levels : list
+        grib_filter level names to restrict the variables to, e.g.
+        ['mean_sea_level', '850_mb']. Default None requests all levels.
+        Variables and levels are combined as in the grib_filter, so only
+        combinations present in the file are returned.
     store : bool
         If data is to be stored or only temporarily downloaded.
         If true, store_path must be set.
@@ -49,9 +60,49 @@ class GEFSRetrieve:
         What frequency of lead time will be downloaded. Default is 3hr.
     hour_end : int
         Which hour to end the return at. Default is 168 (7 days).
+    pooled : bool
+        If true (default), async downloads share one keep-alive session
+        and stream to disk through PooledDownloader. If false, the
+        original one-session-per-file path is used.
+    limit_per_host : int
+        Connection limit per host for the pooled downloader.
+    resume : bool
+        If true (default), files already recorded as complete in the
+        cycle's manifest are kept and skipped. If false, the download
+        directory is cleared on construction as before.
+    keep_cycles : int
+        Number of cycles per stat kept in the download directory after
+        a successful download; older manifests and files are removed.
+    event_driven : bool
+        If true and monitor is set, the asyncio LeadTimeMonitor is used:
+        each lead time is downloaded as soon as it is published instead
+        of polling directory listings for a complete cycle.
+    nomads_url : str
+        Base url of the NOMADS host, e.g. to point at a mirror or the
+        local stand-in server in bench/nomads_standin.py.
+    adaptive : bool
+        If true (default), pooled downloads use an AIMD AdaptiveLimiter
+        starting at 10 concurrent requests that grows while NOMADS is
+        healthy and backs off on 429/503, timeouts and latency spikes.
+        If false, a fixed limit of 10 is used.
+    max_concurrency : int
+        Upper bound for the adaptive limit.
+    min_complete : float
+        Fraction of a cycle's files that must be published for it to be
+        picked by select_cycle. Default is 1.0 (the whole cycle).
+    backend : str
+        filter (default) requests subset files from the NOMADS grib_filter
+        CGI. idx reads each pgrb2s.0p25 file's .idx inventory and fetches
+        only the requested messages with HTTP Range requests; the
+        latitude/longitude bounds are then applied locally on load.
+    ens_store : bool
+        If true (default), each ens file is decoded into the cycle's
+        consolidated member x fhour x lat x lon zarr store as soon as it
+        lands and the GRIB file is removed; see EnsembleStore.
     """
     def __init__(self, 
-        variable: str, 
+        variable, 
+        levels: list=None,
         monitor: bool=False, 
         monitor_interval: int=30, 
         latitude_bounds: Tuple=(60,20), 
@@ -62,10 +113,29 @@ class GEFSRetrieve:
         download_dir: str='../tmp',
         force_hour_value=None,
         force_day_value=None,
-        non_async=False):
+        non_async=False,
+        pooled: bool=True,
+        limit_per_host: int=10,
+        resume: bool=True,
+        keep_cycles: int=2,
+        backend: str='filter',
+        event_driven: bool=False,
+        min_complete: float=1.0,
+        adaptive: bool=True,
+        max_concurrency: int=32,
+        nomads_url: str='https://nomads.ncep.noaa.gov',
+        ens_store: bool=True):
 
-        self.variable = variable.upper()
-        assert self.variable in self.variable_store(), f'must be one of {self.variable_store()}'
+        if isinstance(variable, str):
+            variable = [variable]
+        self.variables = [n.upper() for n in variable]
+        for var in self.variables:
+            assert var in self.variable_store(), f'must be one of {self.variable_store()}'
+        if levels is not None:
+            for level in levels:
+                assert level in self.level_store(), f'level must be one of {self.level_store()}'
+        self.levels = levels
+        self.variable = ', '.join(self.variables)
         self.monitor = monitor
         self.monitor_interval = monitor_interval
         self.latitude_bounds = latitude_bounds
@@ -73,8 +143,22 @@ class GEFSRetrieve:
         self.freq = freq
         self.hour_end = hour_end
         self.sem = 10
+        self.pooled = pooled
+        self.limit_per_host = limit_per_host
         self.download = download
         self.download_dir = download_dir
+        self.resume = resume
+        self.keep_cycles = keep_cycles
+        assert backend in self.backend_store(), f'backend must be one of {self.backend_store()}'
+        self.backend = backend
+        self.event_driven = event_driven
+        self.min_complete = min_complete
+        self.adaptive = adaptive
+        self.max_concurrency = max_concurrency
+        self.limiter = None
+        self.nomads_url = nomads_url.rstrip('/')
+        self.ens_store = ens_store
+        self.listing = DirectoryListing()
         self.async_flag = non_async
         self.force_hour = False
         self.force_day = False
@@ -86,7 +170,8 @@ class GEFSRetrieve:
             self.day_value_force = force_day_value
         try:
             tmp_dir_contents = os.listdir(self.download_dir)
-            self.clear_files_from_download_dir('*')
+            if not self.resume:
+                self.clear_files_from_download_dir('*')
         except FileNotFoundError:
             os.mkdir(self.download_dir)
         
@@ -99,13 +184,50 @@ class GEFSRetrieve:
         'PRMSL', 'PWAT', 'RH', 'SHTFL', 'SNOD', 'SOILW', 'TCDC', 'TMAX', 
         'TMIN', 'TMP', 'TSOIL', 'UGRD', 'ULWRF', 'USWRF', 'VGRD', 'WEASD']
 
+    def level_store(self):
+        return ['mean_sea_level', 'surface', '2_m_above_ground', '10_m_above_ground', 
+        '1000_mb', '925_mb', '850_mb', '700_mb', '500_mb', '250_mb', 
+        'entire_atmosphere_(considered_as_a_single_layer)', 'entire_atmosphere']
+
+    @classmethod
+    def product_store(cls):
+        """GRIB variables and levels making up each ForecastArray variable."""
+        return {
+            'slp': (['PRMSL'], ['mean_sea_level']),
+            'pwat': (['PWAT'], ['entire_atmosphere_(considered_as_a_single_layer)']),
+            'tmp850': (['TMP'], ['850_mb']),
+            'tmp925': (['TMP'], ['925_mb']),
+            'wnd': (['UGRD', 'VGRD'], ['10_m_above_ground']),
+        }
+
+    @classmethod
+    def from_products(cls, products, **kwargs):
+        """
+        Builds one retrieval covering several ForecastArray variables,
+        e.g. GEFSRetrieve.from_products(['slp', 'pwat', 'tmp850', 'tmp925', 'wnd']).
+        """
+        variables, levels = [], []
+        for product in products:
+            product_vars, product_levels = cls.product_store()[product]
+            variables += [n for n in product_vars if n not in variables]
+            levels += [n for n in product_levels if n not in levels]
+        return cls(variables, levels=levels, **kwargs)
+
+    def backend_store(self):
+        return ['filter', 'idx']
+
+    def filter_level(self, level):
+        """grib_filter escapes parentheses in level names, e.g. ( -> \\( -> %5C%28."""
+        return quote(level.replace('(', '\\(').replace(')', '\\)'))
+
     def build_query_dict(self):
         self.query_dict = {
             'latitude_min': f'bottomlat={min(self.latitude_bounds)}&',
             'latitude_max': f'toplat={max(self.latitude_bounds)}&',
             'longitude_min': f'leftlon={min(self.longitude_bounds)}&',
             'longitude_max': f'rightlon={max(self.longitude_bounds)}&',
-            'var': f'var_{self.variable}=on&',
+            'var': ''.join([f'var_{n}=on&' for n in self.variables]),
+            'lev': ''.join([f'lev_{self.filter_level(n)}=on&' for n in self.levels or []]),
         }
 
     def build_ensemble_dict(self):
@@ -121,29 +243,16 @@ class GEFSRetrieve:
         new_dir = [n for n in ftpdir_list if str(new_dir_int) in n][0]
         return new_dir
 
-    def most_recent_links(self, stat):
-        assert stat in ['ens', 'mean', 'sprd'], 'stat must be ens, mean, or sprd'
-        base_url = 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gens/prod/'
-        atmos_pgrb = 'atmos/pgrb2sp25/'
-        date_base_set = set()
-        level, changes_date_in, _ = self.request_to_bs4(base_url, date_base_set)
-        modelhour_base_set = set()
-        if changes_date_in:
-            self.date_value = max(changes_date_in)
-            level, changes_model_hour_in, _ = self.request_to_bs4(level, modelhour_base_set)  
-            if changes_model_hour_in: 
-                self.hour_value = max(changes_model_hour_in)
-                self.link_builder()
-        file_exists = utils.req_status_bool(self.mean_fhour_links[-1])    # def _convert_stat(self):
-        if file_exists:
-            pass
-        elif changes_model_hour_in == '18/':
-            self.hour_value = '12/'
-            self.link_builder()
-        elif changes_model_hour_in == '00/':
-            self.date_value = sorted(changes_date_in)[-2]
-            self.hour_value = '18/'
-            self.link_builder()
+    def most_recent_links(self, stats):
+        """
+        Picks one cycle published for every stat in stats and downloads
+        each stat from it, so e.g. the mean and spread always come from
+        the same cycle. If a download fails, every stat is fetched again
+        from the previous cycle.
+        """
+        stats = [stats] if isinstance(stats, str) else list(stats)
+        assert all(n in ['ens', 'mean', 'sprd'] for n in stats), 'stat must be ens, mean, or sprd'
+        self.select_cycle(stats)
         if self.force_hour:
             self.hour_value = self.hour_value_force
             self.link_builder()
@@ -151,44 +260,128 @@ class GEFSRetrieve:
             self.date_value = self.day_value_force
             self.link_builder()
         if self.download:
-            if stat == 'ens':
-                links = self.ens_fhour_links
-            elif stat == 'mean':
-                links = self.mean_fhour_links
-            elif stat == 'sprd':
-                links = self.sprd_fhour_links
             try:
-                if self.async_flag:
-                    self.download_files(links)
-                else:
-                    self.download_files_async(links)
-            except requests.exceptions.HTTPError:
-                self.clear_files_from_download_dir(stat) 
-                if self.hour_value == '00/':
-                    self.date_value = sorted(changes_date_in)[-2]
-                    self.hour_value = '18/'
-                    self.link_builder()
-                else:
-                    self.hour_value = f"{int(self.hour_value.strip('/'))-6}/"
-                    self.link_builder()
-                if stat == 'ens':
-                    links = self.ens_fhour_links
-                elif stat == 'mean':
-                    links = self.mean_fhour_links
-                elif stat == 'sprd':
-                    links = self.sprd_fhour_links
-                    if self.async_flag:
-                        self.download_files(links)
-                    else:
-                        self.download_files_async(links)
+                for stat in stats:
+                    self.download_stat(stat)
+            # requests raises for the sync downloads, aiohttp for the pooled and async ones
+            except (requests.exceptions.HTTPError, aiohttp.ClientResponseError):
+                self.previous_cycle()
+                for stat in stats:
+                    self.download_stat(stat)
+
+    def candidate_cycles(self, n: int=4):
+        """The newest n (date_value, hour_value) cycles listed on NOMADS, oldest first."""
+        base_url = f'{self.nomads_url}/pub/data/nccf/com/gens/prod/'
+        dates = sorted(n for n in self.listing.links(base_url) if re.match(r'^gefs\.\d{8}/$', n))
+        cycles = []
+        for date in dates[-2:]:
+            hours = self.listing.links(f'{base_url}{date}')
+            cycles += [(date, hour) for hour in hours if re.match(r'^\d{2}/$', hour)]
+        return sorted(cycles)[-n:]
+
+    async def cycle_completeness(self, cycles, stats):
+        """
+        Probes the .idx of every lead time, member and stat of each cycle in
+        one concurrent batch. Returns {cycle: {file name: published}}.
+        """
+        urls = {cycle: {n: self.file_url(f'{n}.idx', *cycle) for stat in stats for n in self.stat_filenames(stat, cycle[1])} for cycle in cycles}
+        async with self.downloader() as dl:
+            found = await dl.probe_all([url for files in urls.values() for url in files.values()])
+        return {cycle: {n: found[url] for n, url in files.items()} for cycle, files in urls.items()}
+
+    def select_cycle(self, stats, min_complete=None):
+        """
+        Sets date_value and hour_value to the newest candidate cycle whose
+        published fraction of files for stats is at least min_complete,
+        falling back to the most complete candidate.
+        """
+        min_complete = self.min_complete if min_complete is None else min_complete
+        self.cycles = self.candidate_cycles()
+        completeness = asyncio.get_event_loop().run_until_complete(self.cycle_completeness(self.cycles, stats))
+        fractions = {cycle: np.mean(list(files.values())) for cycle, files in completeness.items()}
+        for cycle in sorted(fractions, reverse=True):
+            logging.info(f'{"".join(cycle)} {fractions[cycle]:.0%} published')
+        complete = [cycle for cycle in fractions if fractions[cycle] >= min_complete]
+        if complete:
+            cycle = max(complete)
+        else:
+            cycle = max(fractions, key=lambda n: (fractions[n], n))
+            logging.warning(f'no cycle {min_complete:.0%} published, using {"".join(cycle)}')
+        self.date_value, self.hour_value = cycle
+        self.link_builder()
+        self.completeness = completeness[cycle]
+        return cycle
+
+    def previous_cycle(self):
+        """Steps date_value and hour_value back to the cycle before the current one."""
+        cycles = [n for n in self.cycles if n < (self.date_value, self.hour_value)]
+        if not cycles:
+            raise ValueError(f'no candidate cycle before {self.date_value}{self.hour_value}, candidates are {["".join(n) for n in self.cycles]}')
+        self.date_value, self.hour_value = cycles[-1]
+        self.link_builder()
+
+    def idx_extra(self):
+        """Manifest fields telling ForecastArray to subset a full-domain file."""
+        return dict(backend='idx', 
+            latitude_bounds=list(self.latitude_bounds), 
+            longitude_bounds=list(self.longitude_bounds))
+
+    def stat_links(self, stat):
+        if stat == 'ens':
+            return self.ens_fhour_links
+        elif stat == 'mean':
+            return self.mean_fhour_links
+        elif stat == 'sprd':
+            return self.sprd_fhour_links
+
+    def cycle_dir(self):
+        """
+        Where the current cycle's files are written, download_dir/YYYYMMDDHH,
+        so cycles of the same hour on different days do not overwrite each
+        other's files (see DownloadManifest.file_path).
+        """
+        path = f'{self.download_dir}/{cycle_key(self.date_value, self.hour_value)}'
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def manifest(self, stat):
+        return DownloadManifest(self.download_dir, self.date_value, self.hour_value, stat)
+
+    def ensemble_store(self, manifest=None):
+        """The EnsembleStore files of manifest are ingested into, or None if they are kept as GRIB."""
+        if manifest is None or manifest.stat != 'ens' or not self.ens_store:
+            return None
+        self.build_ensemble_dict()
+        return EnsembleStore(manifest, 
+            members=list(self.ensemble_dict['ensembles'].values()), 
+            fhours=list(np.arange(0,self.hour_end+1,self.freq)),
+            names=field_names(self.variables, self.levels))
+
+    def download_stat(self, stat):
+        """
+        Downloads the files of the current cycle for stat that are not
+        already complete in its manifest, then prunes older cycles.
+        """
+        manifest = self.manifest(stat)
+        links = self.stat_links(stat)
+        pending = manifest.pending(links)
+        logging.info(f'{manifest}: {len(links)-len(pending)} of {len(links)} files complete, fetching {len(pending)}')
+        if pending:
+            if self.async_flag:
+                self.download_files(pending, manifest)
+            else:
+                self.download_files_async(pending, manifest)
+        DownloadManifest.prune(self.download_dir, stat, keep=self.keep_cycles)
 
     def clear_files_from_download_dir(self,stat):
-        for f in glob.glob(f'{self.download_dir}/*{stat}*'):
-            os.remove(f)
+        for f in glob.glob(f'{self.download_dir}/*{stat}*') + glob.glob(f'{self.download_dir}/*/*{stat}*'):
+            if os.path.isfile(f):
+                os.remove(f)
 
-    def most_recent_monitor(self, stat: str):
-        assert stat in ['ens', 'mean', 'sprd'], 'stat must be ens, mean, or sprd'
-        base_url = 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gens/prod/'
+    def most_recent_monitor(self, stats):
+        stats = [stats] if isinstance(stats, str) else list(stats)
+        assert all(n in ['ens', 'mean', 'sprd'] for n in stats), 'stat must be ens, mean, or sprd'
+        base_url = f'{self.nomads_url}/pub/data/nccf/com/gens/prod/'
         atmos_pgrb = 'atmos/pgrb2sp25/'
         date_base_set = set()
         model_hour_base_set = set()
@@ -204,50 +397,21 @@ class GEFSRetrieve:
                     new_change = changes_current - changes_prev
                     if new_change:
                         changes_date = sorted([n for n in [changes_date_in, changes_date_out] if n][0] )
-                        self.hour_value = changes_model_hour[-1]
-                        self.date_value = changes_date[-1]
-                        self.link_builder()
-                        file_exists = utils.req_status_bool(self.mean_fhour_links[-1])
-                        if file_exists:
-                            pass
-                        else:
-                            if changes_model_hour == '00/':
-                                self.date_value = sorted(changes_date)[-2]
-                                self.hour_value = '18/'
-                                self.link_builder()
-                            else:
-                                self.hour_value = f'{int(changes_model_hour[-2].split("/")[0])-6:02}/'
-                                self.link_builder()
+                        self.select_cycle(stats)
                         if self.download:
-                            if stat == 'ens':
-                                links = self.ens_fhour_links
-                            elif stat == 'mean':
-                                links = self.mean_fhour_links
-                            elif stat == 'sprd':
-                                links = self.sprd_fhour_links
-                            self.download_files_async(links)
+                            for stat in stats:
+                                self.download_stat(stat)
                     else:
                         pass
             changes_prev = changes_current
             sleep(self.monitor_interval)
 
     def request_to_bs4(self, url, in_set):
-        try:
-            session = requests.Session()
-            retry = Retry(connect=5, backoff_factor=0.5)
-            adapter = HTTPAdapter(max_retries=retry)
-            session.mount('http://', adapter)
-            session.mount('https://', adapter)
-            page = session.get(url).text
-        except ConnectionError:
-            time.sleep(5)
-            page = requests.get(url).text
-        soup = BeautifulSoup(page, 'html.parser')
-        links = set([a['href'] for a in soup.find_all('a',href=True)])
+        links = self.listing.links(url)
         try:
             most_recent = max(links)
         except ValueError:
-            print('error in response, no links present')
+            raise ValueError(f'error in response, no links present at {url}')
         recursion_url = f'{url}{most_recent}'
         changes_in = links - in_set
         changes_out = in_set - links
@@ -256,13 +420,30 @@ class GEFSRetrieve:
     def link_builder(self):
         self.build_query_dict()
         self.build_ensemble_dict()
-        base_link = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gefs_atmos_0p25s.pl?'
+        base_link = f'{self.nomads_url}/cgi-bin/filter_gefs_atmos_0p25s.pl?'
         base_query = f"{base_link}{''.join([f'{self.query_dict[n]}' for n in self.query_dict])}subregion=&"
         date_link = f'dir=%2F{self.date_value.strip("/")}%2F{self.hour_value.strip("/")}%2Fatmos%2Fpgrb2sp25&'
-        new_link = base_query + date_link
-        self.ens_fhour_links = [f"{new_link}file={self.ensemble_dict['ensembles'][m]}.t{self.hour_value.strip('/')}z.pgrb2s.0p25.f{n:03}" for n in np.arange(0,self.hour_end+1,self.freq) for m in self.ensemble_dict['ensembles']]
-        self.mean_fhour_links = [f"{new_link}file={self.ensemble_dict['mean']}.t{self.hour_value.strip('/')}z.pgrb2s.0p25.f{n:03}" for n in np.arange(0,self.hour_end+1,self.freq)]
-        self.sprd_fhour_links = [f"{new_link}file={self.ensemble_dict['sprd']}.t{self.hour_value.strip('/')}z.pgrb2s.0p25.f{n:03}" for n in np.arange(0,self.hour_end+1,self.freq)]
+        new_link = base_query + date_link + 'file='
+        if self.backend == 'idx':
+            new_link = self.file_url('')
+        self.ens_fhour_links = [f"{new_link}{n}" for n in self.stat_filenames('ens')]
+        self.mean_fhour_links = [f"{new_link}{n}" for n in self.stat_filenames('mean')]
+        self.sprd_fhour_links = [f"{new_link}{n}" for n in self.stat_filenames('sprd')]
+
+    def stat_filenames(self, stat, hour_value=None):
+        """pgrb2s.0p25 file names of a cycle for stat, ordered by lead time."""
+        self.build_ensemble_dict()
+        hour = (hour_value or self.hour_value).strip('/')
+        fhours = np.arange(0,self.hour_end+1,self.freq)
+        if stat == 'ens':
+            return [f"{self.ensemble_dict['ensembles'][m]}.t{hour}z.pgrb2s.0p25.f{n:03}" for n in fhours for m in self.ensemble_dict['ensembles']]
+        return [f"{self.ensemble_dict[stat]}.t{hour}z.pgrb2s.0p25.f{n:03}" for n in fhours]
+
+    def file_url(self, filename, date_value=None, hour_value=None):
+        """Direct url of a published pgrb2s.0p25 file (or its .idx)."""
+        date = (date_value or self.date_value).strip('/')
+        hour = (hour_value or self.hour_value).strip('/')
+        return f'{self.nomads_url}/pub/data/nccf/com/gens/prod/{date}/{hour}/atmos/pgrb2sp25/{filename}'
     
     @retry(attempts=20)
     async def download_link(self, link):
@@ -274,17 +455,66 @@ class GEFSRetrieve:
                             logging.warning(f'{link.split("=")[-1]} less than 100kb, rerunning')
                             await asyncio.sleep(1)
                             content = await resp.read()       
-                        with open(f'{self.download_dir}/{link.split("=")[-1]}', mode='+wb') as f:
+                        with open(f'{self.cycle_dir()}/{link.split("=")[-1]}', mode='+wb') as f:
                             f.write(content)
                             logging.info(f'{link.split("=")[-1]} downloaded')
 
-                        
+    def concurrency_limiter(self):
+        """
+        The retrieval's limiter, kept across downloaders so the limit
+        learned in one batch carries into the next.
+        """
+        if self.limiter is None:
+            if self.adaptive:
+                self.limiter = utils.AdaptiveLimiter(self.sem, maximum=self.max_concurrency)
+            else:
+                self.limiter = utils.AdaptiveLimiter(self.sem, minimum=self.sem, maximum=self.sem)
+        return self.limiter
+
+    def downloader(self, manifest=None):
+        return PooledDownloader(self.cycle_dir(), 
+            limit=self.sem, 
+            limit_per_host=self.limit_per_host,
+            manifest=manifest,
+            limiter=self.concurrency_limiter())
+
+    def fetch_function(self, dl, manifest=None):
+        """
+        The per-link coroutine function of dl for this retrieval's backend.
+        ens files are ingested into the ensemble store in a worker thread
+        once fetched, so decoding overlaps with the remaining downloads.
+        """
+        if self.backend == 'idx':
+            fetch = partial(dl.fetch_idx, variables=self.variables, levels=self.levels, manifest=manifest, **self.idx_extra())
+        else:
+            fetch = partial(dl.fetch, manifest=manifest)
+        store = self.ensemble_store(manifest)
+        if store is None:
+            return fetch
+
+        async def fetch_and_ingest(link):
+            size = await fetch(link)
+            await asyncio.get_event_loop().run_in_executor(None, store.ingest, utils.link_filename(link))
+            return size
+        return fetch_and_ingest
 
-    async def download_links(self, links):
-        coro = [self.download_link(link) for link in links]
-        await utils.gather_with_concurrency(self.sem, *coro)
+    async def download_links(self, links, manifest=None):
+        if self.pooled or self.backend == 'idx':
+            async with self.downloader() as dl:
+                await dl.fetch_all(links, fetch=self.fetch_function(dl, manifest))
+        else:
+            coro = [self.download_link(link) for link in links]
+            await utils.gather_with_concurrency(self.sem, *coro)
+            if manifest is not None:
+                for link in links:
+                    path = f'{self.cycle_dir()}/{utils.link_filename(link)}'
+                    manifest.record(utils.link_filename(link), link, os.path.getsize(path), file_checksum(path))
+            store = self.ensemble_store(manifest)
+            if store is not None:
+                for link in links:
+                    store.ingest(utils.link_filename(link))
 
-    def download_files(self, links):
+    def download_files(self, links, manifest=None):
         logging.info(f'normal download begun, info:\n \
             variable: {self.variable}\n \
             date: {self.date_value}\n \
@@ -294,15 +524,63 @@ class GEFSRetrieve:
             hour frequency: {self.freq}\n \
             end hour: {self.hour_end}\n \
             directory: {self.download_dir}')   
+        store = self.ensemble_store(manifest)
         for link in links:  
-            with requests.get(link, stream=True) as r:
+            filename = utils.link_filename(link)
+            if self.backend == 'idx':
+                self.download_file_idx(link, manifest)
+                if store is not None:
+                    store.ingest(filename)
+                continue
+            # Content-Length counts the bytes on the wire, so ask for them
+            # unencoded and compare against the raw count, not the decoded file
+            with requests.get(link, headers={'Accept-Encoding': 'identity'}, stream=True) as r:
                 r.raise_for_status()
-                with open(f'{self.download_dir}/{link.split("=")[-1]}', mode='+wb') as f:
+                with open(f'{self.cycle_dir()}/{filename}', mode='+wb') as f:
                     for chunk in r.iter_content(chunk_size=8192): 
                                     f.write(chunk)
-                    logging.info(f'{link.split("=")[-1]} downloaded')
+                expected = r.headers.get('Content-Length')
+                if expected is not None and r.raw.tell() != int(expected):
+                    raise requests.exceptions.ChunkedEncodingError(f'{filename} truncated')
+                logging.info(f'{filename} downloaded')
+            if manifest is not None:
+                path = f'{self.cycle_dir()}/{filename}'
+                manifest.record(filename, link, os.path.getsize(path), file_checksum(path))
+            if store is not None:
+                store.ingest(filename)
+        
+    def download_file_idx(self, link, manifest=None):
+        """
+        Synchronous byte-range retrieval of link's selected messages, with
+        the same checks as PooledDownloader.fetch_idx: an empty selection
+        and a range request answered with anything but 206 raise, and the
+        file is only moved into place once every range is written.
+        """
+        filename = utils.link_filename(link)
+        idx = requests.get(f'{link}.idx')
+        idx.raise_for_status()
+        selected = grib_idx.select_messages(grib_idx.parse_idx(idx.text), self.variables, self.levels)
+        if not selected:
+            raise ValueError(f'no messages for {self.variables} {self.levels or ""} in {filename}.idx')
+        checksum = hashlib.sha256()
+        size = 0
+        with open(f'{self.cycle_dir()}/{filename}.part', mode='wb') as f:
+            for start, end in grib_idx.byte_ranges(selected):
+                with requests.get(link, headers={'Range': grib_idx.range_header(start, end)}, stream=True) as r:
+                    r.raise_for_status()
+                    # a server ignoring Range would send the whole file for every range
+                    if r.status_code != 206:
+                        raise requests.exceptions.RequestException(f'range request for {filename} returned {r.status_code}')
+                    for chunk in r.iter_content(chunk_size=8192):
+                        f.write(chunk)
+                        checksum.update(chunk)
+                        size += len(chunk)
+        os.replace(f'{self.cycle_dir()}/{filename}.part', f'{self.cycle_dir()}/{filename}')
+        logging.info(f'{filename} downloaded')
+        if manifest is not None:
+            manifest.record(filename, link, size, checksum.hexdigest(), **self.idx_extra())
         
-    def download_files_async(self, links):
+    def download_files_async(self, links, manifest=None):
         logging.info(f'async download begun, info:\n \
             variable: {self.variable}\n \
             date: {self.date_value}\n \
@@ -313,13 +591,53 @@ class GEFSRetrieve:
             end hour: {self.hour_end}\n \
             directory: {self.download_dir}')
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(self.download_links(links))
+        loop.run_until_complete(self.download_links(links, manifest))
+
+    def newest_cycle(self):
+        """Sets date_value and hour_value to the newest cycle directory on NOMADS."""
+        base_url = f'{self.nomads_url}/pub/data/nccf/com/gens/prod/'
+        level, changes_date_in, _ = self.request_to_bs4(base_url, set())
+        self.date_value = max(changes_date_in)
+        _, changes_model_hour_in, _ = self.request_to_bs4(level, set())
+        self.hour_value = max(changes_model_hour_in)
+        if self.force_hour:
+            self.hour_value = self.hour_value_force
+        if self.force_day:
+            self.date_value = self.day_value_force
+        self.link_builder()
+        return self.date_value, self.hour_value
+
+    async def monitor_lead_times(self, stats, callback=None):
+        """
+        Ingests the newest cycle lead time by lead time, calling callback
+        with a LeadTimeReady event as each one completes.
+        """
+        self.newest_cycle()
+        lead_time_monitor = LeadTimeMonitor(self, stats, poll_interval=self.monitor_interval)
+        if callback is not None:
+            lead_time_monitor.subscribe(callback)
+        await lead_time_monitor.run()
+        for stat in stats:
+            DownloadManifest.prune(self.download_dir, stat, keep=self.keep_cycles)
+        return lead_time_monitor
 
-    def run(self, stat):
-        if self.monitor:
-            self.most_recent_monitor(stat)
+    async def most_recent_event_monitor(self, stats, callback=None):
+        stats = [stats] if isinstance(stats, str) else list(stats)
+        cycle = None
+        while True:
+            if self.newest_cycle() != cycle:
+                cycle = (self.date_value, self.hour_value)
+                await self.monitor_lead_times(stats, callback)
+            await asyncio.sleep(self.monitor_interval)
+
+    def run(self, stats):
+        """Retrieves stats, a stat or list of stats that are taken from the same cycle."""
+        if self.monitor and self.event_driven:
+            asyncio.get_event_loop().run_until_complete(self.most_recent_event_monitor(stats))
+        elif self.monitor:
+            self.most_recent_monitor(stats)
         else:
-            self.most_recent_links(stat)
+            self.most_recent_links(stats)
 
 @click.command()
 @click.option(
@@ -332,7 +650,7 @@ class GEFSRetrieve:
     "-s",
     "--stat",
     default='mean',
-    help="The files to watch for, ens, mean, or sprd."
+    help="The files to watch for, ens, mean, or sprd, or a comma separated list taken from the same cycle, e.g. mean,sprd."
 )
 @click.option(
     "-d",
@@ -345,11 +663,31 @@ class GEFSRetrieve:
     default='~/',
     help="Where files will be downloaded."
 )
-def cli_main(monitor: str, stat: str, download: str, dir: str):
+@click.option(
+    "-v",
+    "--variable",
+    default='PRMSL',
+    help="The variable(s) to retrieve, comma separated, e.g. PRMSL,PWAT."
+)
+@click.option(
+    "-b",
+    "--backend",
+    default='filter',
+    help="filter (grib_filter CGI) or idx (.idx byte ranges)."
+)
+@click.option(
+    "-e",
+    "--event",
+    default='n',
+    help="With --monitor, download each lead time as soon as it is published."
+)
+def cli_main(monitor: str, stat: str, download: str, dir: str, variable: str, backend: str, event: str):
     monitor = utils.str_to_bool(monitor)
     download = utils.str_to_bool(download)
-    assert stat in ['ens', 'mean', 'sprd'], 'stat must be ens, mean, or sprd'
-    retr = GEFSRetrieve(download_dir=dir, download=download, monitor=monitor)
+    event = utils.str_to_bool(event)
+    stat = stat.split(',')
+    assert all(n in ['ens', 'mean', 'sprd'] for n in stat), 'stat must be ens, mean, or sprd'
+    retr = GEFSRetrieve(variable.split(','), download_dir=dir, download=download, monitor=monitor, backend=backend, event_driven=event)
     retr.run(stat)
 
 if __name__ == '__main__':
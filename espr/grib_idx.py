@@ -0,0 +1,55 @@
+def parse_idx(text: str):
+    """
+    Parses a wgrib2-style .idx inventory into a list of message dicts.
+    Each line looks like
+        1:0:d=2021071512:PRMSL:mean sea level:anl:ENS=mean
+    and the returned dicts hold the message number, byte offset, variable,
+    level and forecast strings, plus the inclusive end byte of the message
+    (None for the final message, which runs to the end of the file).
+    """
+    messages = []
+    for line in text.strip().splitlines():
+        fields = line.split(':')
+        if len(fields) < 6:
+            continue
+        messages.append({
+            'num': fields[0],
+            'offset': int(fields[1]),
+            'date': fields[2],
+            'var': fields[3],
+            'level': fields[4],
+            'forecast': fields[5],
+        })
+    for message, following in zip(messages, messages[1:] + [None]):
+        message['end'] = following['offset'] - 1 if following is not None else None
+    return messages
+
+def level_to_idx(level: str) -> str:
+    """Converts a grib_filter level key (850_mb) to its .idx form (850 mb)."""
+    return level.replace('_', ' ')
+
+def select_messages(messages, variables, levels=None):
+    """
+    Messages whose variable is in variables and, if levels is given,
+    whose level is one of levels (grib_filter or .idx spelling).
+    """
+    variables = set(n.upper() for n in variables)
+    if levels is not None:
+        levels = set(level_to_idx(n) for n in levels)
+    return [n for n in messages if n['var'] in variables and (levels is None or n['level'] in levels)]
+
+def byte_ranges(messages):
+    """
+    Merges the byte spans of the selected messages into as few inclusive
+    (start, end) ranges as possible; an end of None means end of file.
+    """
+    ranges = []
+    for message in sorted(messages, key=lambda n: n['offset']):
+        if ranges and ranges[-1][1] is not None and ranges[-1][1] + 1 == message['offset']:
+            ranges[-1] = (ranges[-1][0], message['end'])
+        else:
+            ranges.append((message['offset'], message['end']))
+    return ranges
+
+def range_header(start: int, end=None) -> str:
+    return f'bytes={start}-{"" if end is None else end}'
@@ -0,0 +1,76 @@
+import re
+import time
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+
+HREF_RE = re.compile(r'''<a\s[^>]*?href\s*=\s*["']([^"']+)["']''', re.IGNORECASE)
+
+def extract_hrefs(page: str) -> set:
+    """Collects the href of every anchor in a directory listing page."""
+    return set(HREF_RE.findall(page))
+
+
+class DirectoryListing:
+    """
+    Cached reader for NOMADS directory listings.
+    One requests.Session with retries is kept for every listing request.
+    The ETag and Last-Modified of each url are remembered and sent back as
+    If-None-Match / If-Modified-Since, so when a listing has not changed
+    the server answers 304 with no body and the cached links are reused.
+    Links are pulled out of the page with a regex instead of a full HTML
+    parse.
+
+    Parameters
+    ---------
+    retries : int
+        Connection retries for the session.
+    backoff_factor : float
+        Backoff factor between retries.
+    timeout : int
+        Request timeout in seconds.
+    """
+    def __init__(self, retries: int=5, backoff_factor: float=0.5, timeout: int=30):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(max_retries=Retry(connect=retries, backoff_factor=backoff_factor))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.cache = {}
+        self.stats = {'requests': 0, 'not_modified': 0}
+
+    def __str__(self):
+        return f'Directory listing cache ({len(self.cache)} urls)'
+
+    def _conditional_headers(self, url):
+        headers = {}
+        if url in self.cache:
+            if self.cache[url]['etag']:
+                headers['If-None-Match'] = self.cache[url]['etag']
+            if self.cache[url]['last_modified']:
+                headers['If-Modified-Since'] = self.cache[url]['last_modified']
+        return headers
+
+    def links(self, url) -> set:
+        """The set of hrefs on url, fetched only if the listing changed."""
+        try:
+            resp = self.session.get(url, headers=self._conditional_headers(url), timeout=self.timeout)
+        except requests.exceptions.ConnectionError:
+            time.sleep(5)
+            resp = self.session.get(url, headers=self._conditional_headers(url), timeout=self.timeout)
+        self.stats['requests'] += 1
+        if resp.status_code == 304 and url in self.cache:
+            self.stats['not_modified'] += 1
+            return set(self.cache[url]['links'])
+        resp.raise_for_status()
+        links = extract_hrefs(resp.text)
+        self.cache[url] = {
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'links': links,
+        }
+        logging.debug(f'listing {url} changed, {len(links)} links')
+        return set(links)
@@ -0,0 +1,176 @@
+import os
+import re
+import glob
+import json
+import hashlib
+import shutil
+import time
+
+import utils
+
+
+def cycle_key(date_value: str, hour_value: str) -> str:
+    """Converts NOMADS directory names (gefs.20210715/, 12/) to 2021071512."""
+    return f"{re.sub(r'[^0-9]', '', date_value)}{hour_value.strip('/')}"
+
+def file_checksum(path: str, chunk_size: int=2**20) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DownloadManifest:
+    """
+    Per-cycle, per-stat record of downloaded GEFS files.
+    Each completed file is recorded with its source url, size in bytes,
+    completion status and sha256 checksum. The manifest is an append-only
+    JSON lines file in the download directory, so recording a file is a
+    single small write and a crash mid-retrieval loses nothing that was
+    already recorded. The files themselves live in a directory per cycle,
+    download_dir/YYYYMMDDHH, as NOMADS names them by hour but not date.
+    A restarted retrieval only fetches the links that are not complete,
+    and ForecastArray reads its file list from here.
+
+    Parameters
+    ---------
+    download_dir : string
+        Directory the files and manifest live in.
+    date_value : string
+        NOMADS date directory of the cycle, e.g. gefs.20210715/.
+    hour_value : string
+        NOMADS hour directory of the cycle, e.g. 12/.
+    stat : string
+        ens, mean, or sprd.
+    """
+    def __init__(self, download_dir: str, date_value: str, hour_value: str, stat: str):
+        self.download_dir = download_dir
+        self.cycle = cycle_key(date_value, hour_value)
+        self.stat = stat
+        self.path = f'{download_dir}/manifest_{self.cycle}_{stat}.jsonl'
+        self.cycle_dir = f'{download_dir}/{self.cycle}'
+        self.store_path = f'{download_dir}/{stat}_{self.cycle}.zarr'
+        self.entries = {}
+        self.load()
+
+    def __str__(self):
+        return f'Manifest for {self.cycle} {self.stat}'
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a torn final line from a crash mid-write
+                        continue
+                    self.entries[entry['file']] = entry
+        except FileNotFoundError:
+            pass
+        return self
+
+    def record(self, filename: str, url: str, size: int, checksum: str, complete: bool=True, **extra):
+        entry = dict(file=filename, url=url, size=size, checksum=checksum, complete=complete, time=time.time(), **extra)
+        self.entries[filename] = entry
+        with open(self.path, mode='a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def mark_ingested(self, filename: str):
+        entry = dict(self.entries[filename], ingested=True, time=time.time())
+        self.entries[filename] = entry
+        with open(self.path, mode='a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return entry
+
+    def file_path(self, filename: str) -> str:
+        return f'{self.cycle_dir}/{filename}'
+
+    def is_complete(self, filename: str, verify: bool=False) -> bool:
+        """
+        True if filename is recorded as complete and the file on disk still
+        matches the recorded size (and checksum, if verify is set).
+        Ingested files are complete while the store exists.
+        """
+        entry = self.entries.get(filename)
+        if entry is None or not entry['complete']:
+            return False
+        if entry.get('ingested'):
+            return os.path.exists(self.store_path)
+        path = self.file_path(filename)
+        try:
+            if os.path.getsize(path) != entry['size']:
+                return False
+        except FileNotFoundError:
+            return False
+        if verify:
+            return file_checksum(path) == entry['checksum']
+        return True
+
+    def pending(self, links, verify: bool=False):
+        """Returns the links that still need to be fetched."""
+        return [n for n in links if not self.is_complete(utils.link_filename(n), verify=verify)]
+
+    def complete_files(self, verify: bool=False):
+        """Full paths of every complete file still on disk, sorted by file name."""
+        return [self.file_path(n) for n in sorted(self.entries) if not self.entries[n].get('ingested') and self.is_complete(n, verify=verify)]
+
+    def ingested_files(self):
+        return sorted(n for n in self.entries if self.entries[n].get('ingested'))
+
+    def bounds(self):
+        """
+        (latitude_bounds, longitude_bounds) recorded for full-domain files
+        that still need subsetting on load, or None.
+        """
+        for entry in self.entries.values():
+            if 'latitude_bounds' in entry:
+                return entry['latitude_bounds'], entry['longitude_bounds']
+        return None
+
+    @classmethod
+    def cycles(cls, download_dir: str, stat: str):
+        """Sorted list of cycle keys with a manifest for stat."""
+        paths = glob.glob(f'{download_dir}/manifest_*_{stat}.jsonl')
+        return sorted(os.path.basename(n).split('_')[1] for n in paths)
+
+    @classmethod
+    def from_cycle(cls, download_dir: str, cycle: str, stat: str):
+        return cls(download_dir, cycle[:-2], cycle[-2:], stat)
+
+    @classmethod
+    def latest(cls, download_dir: str, stat: str):
+        """The manifest of the newest cycle for stat, or None if there is none."""
+        cycles = cls.cycles(download_dir, stat)
+        if not cycles:
+            return None
+        return cls.from_cycle(download_dir, cycles[-1], stat)
+
+    @classmethod
+    def prune(cls, download_dir: str, stat: str, keep: int=2):
+        """
+        Removes manifests for all but the newest keep cycles of stat, along
+        with their files, their cached cfgrib indexes and their
+        consolidated store, and the cycle's directory once no other stat
+        has files in it.
+        """
+        cycles = cls.cycles(download_dir, stat)
+        removed = []
+        for cycle in cycles[:-keep] if keep > 0 else cycles:
+            old = cls.from_cycle(download_dir, cycle, stat)
+            for filename in old.entries:
+                if os.path.exists(old.file_path(filename)):
+                    os.remove(old.file_path(filename))
+                    removed.append(filename)
+            utils.evict_grib_indexes(utils.grib_index_dir(download_dir), [old.file_path(n) for n in old.entries])
+            if os.path.exists(old.store_path):
+                shutil.rmtree(old.store_path)
+            os.remove(old.path)
+            if os.path.isdir(old.cycle_dir) and not os.listdir(old.cycle_dir):
+                os.rmdir(old.cycle_dir)
+        return removed
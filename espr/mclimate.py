@@ -5,11 +5,90 @@ import xarray.ufuncs as xu
 
 import datetime
 import os
+import logging
 import utils as ut
 
 import typing
 from dask.distributed import Client
 import dateutil.parser as dparser
+from region import Region
+from catalog import ReforecastCatalog
+from rechunk import store_path
+
+# names a variable is filed under in a v12 reforecast directory, as
+# catalog.parse_filename reads them: the short name or the AWS prefix
+V12_VARIABLES = {
+    'slp': ['slp', 'pres_msl'],
+    'pwat': ['pwat', 'pwat_eatm'],
+    'tmp925': ['tmp', 'tmp_pres'],
+    'tmp850': ['tmp', 'tmp_pres'],
+    'tmp': ['tmp', 'tmp_pres'],
+    'wnd': ['wnd', 'ugrd_hgt', 'vgrd_hgt'],
+    'tcc': ['tcc', 'tcdc_eatm'],
+    'dswrf': ['dswrf', 'dswrf_sfc'],
+}
+
+class DayOfYearIndex:
+    """
+    Index from day of year to the integer time positions of a reforecast
+    file, in CSR layout: the positions of day d are
+    positions[indptr[d]:indptr[d+1]]. It is saved next to the file as
+    <file>.doy.npz along with the file's size and mtime, so selecting a
+    window of days is a lookup plus one isel, without building date
+    strings or masking the whole cube.
+
+    Parameters
+    ---------
+    indptr : numpy.ndarray
+        Offsets into positions for each of the 366 days, length 367.
+    positions : numpy.ndarray
+        Time positions sorted by day of year.
+    """
+    def __init__(self, indptr, positions):
+        self.indptr = indptr
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    @classmethod
+    def from_times(cls, times):
+        doy = ut.day_of_year(times)
+        order = np.argsort(doy, kind='stable')
+        indptr = np.zeros(367, dtype='int64')
+        indptr[1:] = np.cumsum(np.bincount(doy, minlength=366))
+        return cls(indptr, order.astype('int64'))
+
+    @staticmethod
+    def index_path(data_path: str) -> str:
+        return f'{data_path}.doy.npz'
+
+    @classmethod
+    def for_file(cls, data_path: str, times):
+        """
+        The saved index of data_path if it matches the file's size and
+        mtime, otherwise one built from times (and saved when possible).
+        """
+        if not os.path.isfile(data_path):
+            return cls.from_times(times)
+        stat = os.stat(data_path)
+        try:
+            saved = np.load(cls.index_path(data_path))
+            if saved['size'] == stat.st_size and saved['mtime'] == stat.st_mtime_ns:
+                return cls(saved['indptr'], saved['positions'])
+        except (FileNotFoundError, OSError, KeyError, ValueError):
+            pass
+        index = cls.from_times(times)
+        try:
+            with open(cls.index_path(data_path), 'wb') as f:
+                np.savez(f, indptr=index.indptr, positions=index.positions, size=stat.st_size, mtime=stat.st_mtime_ns)
+        except OSError:
+            logging.warning(f'could not save day of year index for {data_path}')
+        return index
+
+    def select(self, days):
+        """Sorted time positions falling on any of days."""
+        return np.sort(np.concatenate([self.positions[self.indptr[d]:self.indptr[d+1]] for d in np.unique(days)]))
 
 class MClimate:
     """
@@ -45,6 +124,14 @@ class MClimate:
         Whether or not the data is from the v12 reforecast. The v12
         reforecast is structured with individual files for each date
         as opposed to one large netcdf due to its storage on AWS.
+    region : Region
+        If given, every reforecast file is subset to the region by index
+        as it is opened (and to its forecast hours), so only the domain
+        of interest is read.
+    catalog_path : str
+        For v12, the ReforecastCatalog database of path, default
+        <path>/catalog.sqlite. It is not built here, as the reforecast
+        directory may be read only; build it with the catalog cli.
     """
     def __init__(self,
                 date, 
@@ -53,7 +140,9 @@ class MClimate:
                 fhour: int = 24, 
                 percentage: float = 10,
                 period: int = 10,
-                v12: bool = False):
+                v12: bool = False,
+                region: Region = None,
+                catalog_path: str = None):
         if isinstance(date, datetime.date) or isinstance(date, datetime.datetime):
             self.date = date
         else:
@@ -71,6 +160,8 @@ class MClimate:
         self.path = path
         self.period = period
         self.v12 = v12
+        self.region = region
+        self.catalog_path = catalog_path
 
     def var_list(self) -> list:
         return ['slp','pwat','tmp925','tmp850','wnd', 'tcc', 'dswrf']
@@ -104,34 +195,48 @@ class MClimate:
         if self.date.month in son:
             return 'son'
 
-    def subset_time(self):
+    def window_days(self):
+        '''
+        Days of year (see utils.day_of_year) within period days either side of
+        the date, wrapping across the new year.
         '''
-        Subsets the date range to within 21 days +- the valid date.
-        This method is ~ 3x faster than using an xr.concat method which
-        loops through the date_range variable to select valid dates.
-        Returns the subset Dataset.
+        d64 = np.datetime64(self.date,'D')
+        return ut.day_of_year(np.arange(d64-self.period,d64+self.period+1))
+
+    def catalog(self):
+        '''
+        The ReforecastCatalog of path at catalog_path; build and refresh it
+        with the catalog cli when files are added.
+        '''
+        catalog = ReforecastCatalog(self.path, self.catalog_path)
+        if not catalog.exists():
+            raise FileNotFoundError(f'{catalog} not found, build it with python catalog.py -p {self.path}'
+                + (f' --db {self.catalog_path}' if self.catalog_path else ''))
+        return catalog
+
+    def subset_time(self, stat: str='mean', days=None, fhour: int=None):
+        '''
+        Subsets the date range to within period days +- the valid date.
+        For v12 returns the reforecast files of the variable and stat in
+        the window, from the catalog; otherwise returns the window's days
+        of year, which retrieve_from_xr looks up in each file's
+        DayOfYearIndex.
         Parameters
         ---------
-        ds : xarray.dataset
-            The dataset to subset the time range upon.
+        stat : str
+            The stat (mean, sprd) of the v12 files.
+        days : list
+            Days of year to use instead of the window's.
+        fhour : int
+            For v12, only files of this lead time (or of every lead time).
         '''
-        d64 = np.datetime64(self.date,'D')
-        date_range = ut.replace_year(np.arange(d64-self.period,d64+self.period+1), 2012)
-        days = date_range - date_range.astype('datetime64[M]') + 1
-        months = date_range.astype('datetime64[M]').astype(int) % 12 + 1
-        years = np.arange(2000,2020).astype(str)
-        centered_date_str = np.char.add(np.array([n.zfill(2) for n in months.astype(int).astype(str)]).T,
-                                            np.array([n.zfill(2) for n in days.astype(int).astype(str)]).T)
-        if self.v12:
-            full_date_list = np.array([n+m for n in years for m in centered_date_str]).T
-            stat_list = [n for n in os.listdir(self.path) if self.stat in n]
-            subset_stat_list = [n for n in stat_list if any(m in n for m in full_date_list)]
-            subset_mean_list_full_path = [f'{self.path}/{n}' for n in subset_stat_list]
-            return subset_mean_list_full_path
-        else:
-            return centered_date_str
+        if days is None:
+            days = self.window_days()
+        if not self.v12:
+            return days
+        return self.catalog().files(stat, days, variable=V12_VARIABLES.get(self.variable, self.variable), fhour=fhour)
     
-    def set_data_path(self, stat: str, custom: typing.Optional[str] = None):
+    def set_data_path(self, stat: str, custom: typing.Optional[str] = None, days=None, fhour: int=None):
         '''
         Generates the path for variables. Default is 
         <variable>_<stat>_<date_string> where <variable> is
@@ -143,9 +248,13 @@ class MClimate:
             The stat (mean, sprd).
         custom: str
             If custom path desired, enter path here (fstrings included).
+        days : list
+            For v12, days of year to use instead of the window's.
+        fhour : int
+            For v12, the lead time of the files, if subsetting to one.
         '''
         if self.v12:
-            return self.subset_time()
+            return self.subset_time(stat, days, fhour)
         if custom is not None:
             return custom
         else:
@@ -154,17 +263,32 @@ class MClimate:
             else:
                 return f'{self.path}/{self.variable}_{stat}_{self.date_string()}_high.nc'
     
+    def _subset_region(self, ds):
+        return self.region.isel_fhour(self.region.isel(ds))
+
     def open_xr_dataset(self, data_path: str, arg_dict: dict):
+        '''
+        Opens the reforecast at data_path, preferring its time-contiguous
+        zarr store (see rechunk.py) when one has been written.
+        '''
         if self.v12:
+            if self.region is not None:
+                arg_dict['preprocess'] = self._subset_region
             ds = xr.open_mfdataset(data_path, **arg_dict)
             return ds
         else:
-            return xr.open_dataset(data_path)
+            if os.path.exists(store_path(data_path)):
+                ds = xr.open_zarr(store_path(data_path), consolidated=True)
+            else:
+                ds = xr.open_dataset(data_path)
+            if self.region is not None:
+                ds = self._subset_region(ds)
+            return ds
    
-    def retrieve_from_xr(self, stat: str='mean', subset_fhour: bool=False):
+    def retrieve_from_xr(self, stat: str='mean', subset_fhour: bool=False, days=None):
         arg_dict = {}
         assert stat in ['mean','sprd'], 'stat must be mean or sprd'
-        data_path = self.set_data_path(stat)
+        data_path = self.set_data_path(stat, days=days, fhour=self.fhour if subset_fhour else None)
         if self.v12:
             arg_dict['combine'] = 'nested'
             arg_dict['concat_dim']='date'
@@ -196,13 +320,10 @@ class MClimate:
         if self.v12:
             pass
         else:
-            date_ = self.subset_time()
-            months =  ds.time.values.astype('datetime64[M]').astype(int) % 12 + 1
-            days = (ds.time.values.astype('datetime64[D]') - ds.time.values.astype('datetime64[M]')).astype(int) + 1
-            ds_timestr = np.char.add(np.array([n.zfill(2) for n in months.astype(int).astype(str)]).T,
-                                            np.array([n.zfill(2) for n in days.astype(int).astype(str)]).T)
+            index = DayOfYearIndex.for_file(data_path, ds.time.values)
+            ds = ds.isel(time=index.select(self.subset_time(stat, days)))
+            ds_timestr = [n[5:7] + n[8:10] for n in np.datetime_as_string(ds.time.values, unit='D')]
             ds = ds.assign_coords(timestr=('time', ds_timestr))
-            ds = ds.where(ds.timestr.isin(date_),drop=True)
         # if self.fhour:
         #     ds = ds.drop(['intTime', 'intValidTime', 'fhour'])
         # else:
@@ -211,7 +332,7 @@ class MClimate:
         #     ds = xu.sqrt(ds[[n for n in ds.data_vars][0]]**2+ds[[n for n in ds.data_vars][1]]**2)
         return ds
 
-    def generate(self,stat: str='mean', load: bool=False, subset_fhour: bool=False):
+    def generate(self,stat: str='mean', load: bool=False, subset_fhour: bool=False, days=None):
         '''
         Generates the model climatology given the forecast hour specified.
         Parameters
@@ -223,9 +344,12 @@ class MClimate:
         load : bool
             If true, will load xarray into memory. Only use if there is 
             sufficient memory to handle the netcdf.
+        days : list
+            Days of year (see utils.day_of_year) to generate instead of
+            the window about the date.
         '''
         self.stat = stat
-        xarr = self.retrieve_from_xr(self.stat, subset_fhour)
+        xarr = self.retrieve_from_xr(self.stat, subset_fhour, days)
         if load:
             return xarr.load()
         else:   
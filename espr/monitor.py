@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import random
+import re
+from collections import namedtuple, defaultdict
+
+import utils
+
+
+LeadTimeReady = namedtuple('LeadTimeReady', ['cycle', 'stat', 'fhour', 'paths'])
+
+def link_fhour(link) -> int:
+    """Lead time in hours from a pgrb2s.0p25 file name, e.g. ...f003 -> 3."""
+    return int(re.search(r'\.f(\d{3})$', utils.link_filename(link)).group(1))
+
+
+class LeadTimeMonitor:
+    """
+    Event-driven ingest of one GEFS cycle as its lead times publish.
+    Rather than waiting for the whole cycle, each ensemble member (or the
+    mean/spread) is watched as a chain of lead times: the .idx of the next
+    lead time is probed with a HEAD request, backing off while it is
+    missing, and each file is downloaded the moment it appears. Once every
+    file of a lead time and stat is complete a LeadTimeReady event is
+    emitted to subscribers and to the events() iterator. Its paths are the
+    lead time's GRIB files, or the cycle's zarr store for ens files
+    ingested into an EnsembleStore.
+
+    Parameters
+    ---------
+    retrieval : GEFSRetrieve
+        Retrieval with date_value and hour_value set; its backend,
+        variables and manifest are used for downloads.
+    stats : list
+        The stats to watch, any of ens, mean, or sprd.
+    poll_interval : float
+        Initial wait in seconds before re-probing a missing file.
+    max_interval : float
+        Cap in seconds on the backoff between probes.
+    timeout : float
+        Seconds after which a lead time that has not appeared is given up on.
+    """
+    def __init__(self,
+        retrieval,
+        stats=('mean', 'sprd'),
+        poll_interval: float=10,
+        max_interval: float=120,
+        timeout: float=3*3600):
+
+        self.retrieval = retrieval
+        self.stats = list(stats)
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.timeout = timeout
+        self.subscribers = []
+        self.queue = asyncio.Queue()
+
+    def __str__(self):
+        return f'Lead time monitor for {self.retrieval.date_value}{self.retrieval.hour_value} {self.stats}'
+
+    def subscribe(self, callback):
+        """Registers a function or coroutine function called with each LeadTimeReady."""
+        self.subscribers.append(callback)
+        return callback
+
+    async def events(self):
+        """Async iterator over LeadTimeReady events until the cycle is done."""
+        while True:
+            event = await self.queue.get()
+            if event is None:
+                return
+            yield event
+
+    async def emit(self, event):
+        logging.info(f'lead time ready: {event.stat} f{event.fhour:03} ({event.cycle})')
+        self.queue.put_nowait(event)
+        for callback in self.subscribers:
+            result = callback(event)
+            if asyncio.iscoroutine(result):
+                await result
+
+    def availability_url(self, link):
+        """The published file's .idx, which NOMADS writes once the GRIB is complete."""
+        return self.retrieval.file_url(f'{utils.link_filename(link)}.idx')
+
+    async def available(self, dl, link):
+        return await dl.probe(self.availability_url(link))
+
+    async def wait_for(self, dl, link):
+        interval = self.poll_interval
+        waited = 0.
+        while not await self.available(dl, link):
+            if waited > self.timeout:
+                raise asyncio.TimeoutError(f'{utils.link_filename(link)} not published after {self.timeout}s')
+            sleep = interval*random.uniform(0.8, 1.2)
+            await asyncio.sleep(sleep)
+            waited += sleep
+            interval = min(interval*1.5, self.max_interval)
+
+    def ready_paths(self, manifest, stat, fhour):
+        """
+        Where the lead time's data is once it is ready: the GRIB files of
+        its links, or, when they are ingested into an EnsembleStore (which
+        deletes each GRIB once written), the store, to be read at fhour.
+        """
+        if self.retrieval.ensemble_store(manifest) is not None:
+            return [manifest.store_path]
+        return sorted(manifest.file_path(utils.link_filename(n)) for n in self._fhour_links[stat][fhour])
+
+    async def _fetch(self, dl, fetch, manifest, stat, link, remaining):
+        await fetch(link)
+        fhour = link_fhour(link)
+        remaining[fhour].discard(link)
+        if not remaining[fhour]:
+            await self.emit(LeadTimeReady(manifest.cycle, stat, fhour, self.ready_paths(manifest, stat, fhour)))
+
+    async def _watch_chain(self, dl, fetch, manifest, stat, chain, remaining, downloads):
+        for link in chain:
+            await self.wait_for(dl, link)
+            downloads.append(asyncio.ensure_future(self._fetch(dl, fetch, manifest, stat, link, remaining)))
+
+    async def watch_stat(self, dl, stat):
+        manifest = self.retrieval.manifest(stat)
+        fetch = self.retrieval.fetch_function(dl, manifest)
+        links = self.retrieval.stat_links(stat)
+        self._fhour_links[stat] = defaultdict(list)
+        for link in links:
+            self._fhour_links[stat][link_fhour(link)].append(link)
+        pending = manifest.pending(links)
+        remaining = defaultdict(set)
+        for link in pending:
+            remaining[link_fhour(link)].add(link)
+        for fhour in sorted(self._fhour_links[stat]):
+            if not remaining[fhour]:
+                await self.emit(LeadTimeReady(manifest.cycle, stat, fhour, self.ready_paths(manifest, stat, fhour)))
+        chains = defaultdict(list)
+        for link in pending:
+            chains[re.sub(r'\.f\d{3}$', '', utils.link_filename(link))].append(link)
+        downloads = []
+        await asyncio.gather(*[self._watch_chain(dl, fetch, manifest, stat, sorted(chain, key=link_fhour), remaining, downloads) for chain in chains.values()])
+        await asyncio.gather(*downloads)
+
+    async def run(self):
+        """Watches and downloads every stat of the cycle, returning when all are complete."""
+        self._fhour_links = {}
+        try:
+            async with self.retrieval.downloader() as dl:
+                await asyncio.gather(*[self.watch_stat(dl, stat) for stat in self.stats])
+        finally:
+            self.queue.put_nowait(None)
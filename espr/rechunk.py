@@ -0,0 +1,90 @@
+import os
+import shutil
+import logging
+
+import xarray as xr
+import click
+
+import utils as ut
+
+
+def store_path(data_path: str) -> str:
+    """The rechunked store of a reforecast file, e.g. slp_mean_jja_high.nc -> slp_mean_jja_high.zarr."""
+    return f'{os.path.splitext(data_path)[0]}.zarr'
+
+def tile_chunks(ds, tile: int=64) -> dict:
+    """
+    Chunk sizes with the whole time axis, one fhour (and pressure level)
+    and tile x tile gridpoints per chunk.
+    """
+    chunks = {}
+    for dim, size in ds.sizes.items():
+        if dim == 'time':
+            chunks[dim] = size
+        elif dim in ['lat', 'lon', 'latitude', 'longitude']:
+            chunks[dim] = min(tile, size)
+        else:
+            chunks[dim] = 1
+    return chunks
+
+def rechunk(data_path: str, tile: int=64, overwrite: bool=False) -> str:
+    """
+    Rewrites a seasonal reforecast netcdf as a zarr store laid out as
+    (time full x fhour x lat/lon tile), so ranking along time or masking
+    a gridpoint reads the complete time series of a tile in one chunk
+    instead of gathering it from the netcdf's default layout. Chunks are
+    written with zarr's default compressor. MClimate.open_xr_dataset
+    opens the store instead of the netcdf whenever it exists.
+    Returns the store path.
+    Parameters
+    ---------
+    data_path : str
+        The reforecast netcdf, e.g. <path>/slp_mean_jja_high.nc.
+    tile : int
+        Gridpoints along each of lat and lon in a chunk.
+    overwrite : bool
+        Rewrite the store if it already exists.
+    """
+    path = store_path(data_path)
+    if os.path.exists(path):
+        if not overwrite:
+            logging.info(f'{path} exists, skipping')
+            return path
+        shutil.rmtree(path)
+    ds = xr.open_dataset(data_path)
+    chunks = tile_chunks(ds, tile)
+    ds = ds.chunk(chunks)
+    encoding = {n: {'chunks': tuple(chunks[d] for d in ds[n].dims)} for n in ds.data_vars}
+    for n in ds.data_vars:
+        ds[n].encoding = {}
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    ds.to_zarr(tmp_path, mode='w', encoding=encoding, consolidated=True)
+    ds.close()
+    os.replace(tmp_path, path)
+    logging.info(f'{data_path} rechunked to {path} with chunks {chunks}')
+    return path
+
+
+@click.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option(
+    "-t",
+    "--tile",
+    default=64,
+    help="Gridpoints along each of lat and lon in a chunk."
+)
+@click.option(
+    "-o",
+    "--overwrite",
+    default='n',
+    help="Rewrite stores that already exist."
+)
+def cli_main(paths, tile: int, overwrite: str):
+    overwrite = ut.str_to_bool(overwrite)
+    for data_path in paths:
+        print(rechunk(data_path, tile, overwrite))
+
+if __name__ == '__main__':
+    cli_main()
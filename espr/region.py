@@ -0,0 +1,96 @@
+import os
+import re
+
+import numpy as np
+
+import utils as ut
+
+
+class Region:
+    """
+    Domain of interest for forecasts, reforecasts and outputs.
+    Bounds are turned into integer index slices against each dataset's
+    own coordinates, so subsetting happens with isel when data is opened
+    (or as it is decoded) and only the configured domain is read, instead
+    of masking the full grid with where(drop=True) afterwards. Works with
+    ascending or descending latitudes and 0-360 or -180-180 longitudes.
+
+    Parameters
+    ---------
+    latitude_bounds : tuple or list
+        Latitude bounds in either order, e.g. (20, 65).
+    longitude_bounds : tuple or list
+        Longitude bounds in degrees east, e.g. (180, 310).
+    fhours : tuple
+        Optional (begin, end, step) of forecast hours to keep, in hours.
+    """
+    def __init__(self, latitude_bounds, longitude_bounds, fhours=None):
+        self.latitude_bounds = (min(latitude_bounds), max(latitude_bounds))
+        self.longitude_bounds = (min(longitude_bounds), max(longitude_bounds))
+        self.fhours = tuple(fhours) if fhours is not None else None
+
+    def __str__(self):
+        return f'Region lat {self.latitude_bounds} lon {self.longitude_bounds} fhours {self.fhours}'
+
+    def __repr__(self):
+        return f'Region({self.latitude_bounds}, {self.longitude_bounds}, fhours={self.fhours})'
+
+    @classmethod
+    def from_config(cls, variable: str, dir: str=None):
+        """Builds the region configured for variable in config.json."""
+        config = ut.load_config(dir or os.path.dirname(os.path.abspath(__file__)))[variable]
+        fhours = None
+        if 'forecast_hours' in config:
+            fhours = (config['forecast_hours']['begin'], config['forecast_hours']['end'], config['forecast_hours']['step'])
+        return cls((config['latitude']['lower'], config['latitude']['upper']),
+            (config['longitude']['start'], config['longitude']['end']),
+            fhours)
+
+    @staticmethod
+    def _index_slice(values, lower, upper):
+        inside = np.nonzero((values >= lower) & (values <= upper))[0]
+        if len(inside) == 0:
+            return slice(0, 0)
+        return slice(int(inside[0]), int(inside[-1]) + 1)
+
+    def lat_slice(self, latitudes):
+        return self._index_slice(np.asarray(latitudes), *self.latitude_bounds)
+
+    def lon_slice(self, longitudes):
+        longitudes = np.asarray(longitudes)
+        lower, upper = self.longitude_bounds
+        if longitudes.min() < 0 and upper > 180:
+            lower, upper = (lower + 180) % 360 - 180, (upper + 180) % 360 - 180
+        return self._index_slice(longitudes, lower, upper)
+
+    def fhour_values(self):
+        if self.fhours is None:
+            return None
+        begin, end, step = self.fhours
+        return np.arange(begin, end + 1, step)
+
+    def includes_fhour(self, fhour) -> bool:
+        return self.fhours is None or int(fhour) in self.fhour_values()
+
+    def includes_file(self, path: str) -> bool:
+        """Whether a pgrb2s.0p25 file's lead time (its .fNNN suffix) is in the region."""
+        match = re.search(r'\.f(\d{3})$', path)
+        return match is None or self.includes_fhour(int(match.group(1)))
+
+    def isel(self, data, lat: str='lat', lon: str='lon'):
+        """Subsets data to the region's latitudes and longitudes by index."""
+        indexers = {}
+        if lat in data.dims:
+            indexers[lat] = self.lat_slice(data[lat].values)
+        if lon in data.dims:
+            indexers[lon] = self.lon_slice(data[lon].values)
+        return data.isel(indexers)
+
+    def isel_fhour(self, data, dim: str='fhour'):
+        """Subsets data to the region's forecast hours; dim may be integer hours or timedeltas."""
+        if self.fhours is None or dim not in data.dims:
+            return data
+        hours = data[dim].values
+        if np.issubdtype(hours.dtype, np.timedelta64):
+            hours = hours / np.timedelta64(1, 'h')
+        return data.isel({dim: np.nonzero(np.isin(hours, self.fhour_values()))[0]})
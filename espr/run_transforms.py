@@ -7,9 +7,11 @@ import farray as fa
 import mclimate as mc
 import transforms
 import utils as ut
+from region import Region
+from climatology import ClimatologyCache
+from tiling import run_tiled
 from datetime import datetime
 import os
-import bottleneck
 import logging
 import sys
 from pytz import timezone
@@ -33,11 +35,11 @@ def pull_gefs_files(date=None,hour=None):
     non_async=True,
     force_hour_value=hour,
     force_day_value=date)
-    _ = [retr.run(n) for n in stat]
+    retr.run(stat)
 
-def run_fcsts(paths):
-    forecast_mean = fa.ForecastArray('mean', 'slp', paths=paths)
-    forecast_sprd = fa.ForecastArray('sprd', 'slp', paths=paths)
+def run_fcsts(paths, region=None):
+    forecast_mean = fa.ForecastArray('mean', 'slp', paths=paths, region=region)
+    forecast_sprd = fa.ForecastArray('sprd', 'slp', paths=paths, region=region)
     fmean = forecast_mean.load_forecast()
     fmean['time'] = fmean['valid_time']
     fsprd = forecast_sprd.load_forecast()
@@ -46,8 +48,10 @@ def run_fcsts(paths):
     fsprd = fsprd.sortby('valid_time')
     return fmean, fsprd
 
-def run_mcli():
-    mcli = mc.MClimate(datetime.today().strftime('%Y-%m-%d'), '/home/taylorm/espr/reforecast', 'slp')
+def run_mcli(region=None, cache=None):
+    mcli = mc.MClimate(datetime.today().strftime('%Y-%m-%d'), '/home/taylorm/espr/reforecast', 'slp', region=region)
+    if cache is not None:
+        return cache.window(mcli, 'mean'), cache.window(mcli, 'sprd')
     mc_mean = mcli.generate(stat='mean')
     mc_std = mcli.generate(stat='sprd')
     return mc_mean, mc_std
@@ -66,12 +70,6 @@ def align_fmean_fsprd(fmean, fsprd, mc_mean):
     fsprd = fsprd.where(fsprd['lat'].isin(mc_mean['lat']),drop=True)
     return fmean, fsprd
 
-def combine_fcast_and_mcli(fcast, mcli):
-    big_ds = xr.concat([mcli['Pressure'].drop('timestr'),fcast['Pressure'].expand_dims('time')],dim='time')
-    percentile = bottleneck.rankdata(big_ds,axis=0)/len(big_ds['time'])
-    return percentile
-
-
 @click.command()
 @click.option(
     "-d",
@@ -85,7 +83,33 @@ def combine_fcast_and_mcli(fcast, mcli):
     default='n',
     help="Choose model hour run, if not the current model. Default is n (None)."
 )
-def main(date, hour):
+@click.option(
+    "-t",
+    "--tile",
+    default=0,
+    help="Gridpoints per tile side for the HSA chain. Default is 0 (largest that fits the memory budget)."
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=None,
+    type=int,
+    help="Worker processes for the HSA chain. Default is one per cpu."
+)
+@click.option(
+    "-m",
+    "--memory-budget",
+    default=2e9,
+    type=float,
+    help="Bytes each tile of the HSA chain may use."
+)
+@click.option(
+    "-e",
+    "--executor",
+    default='process',
+    help="process (pool) or dask (local cluster)."
+)
+def main(date, hour, tile, workers, memory_budget, executor):
     if date == 'n':
         date = None
     if hour == 'n':
@@ -97,24 +121,23 @@ def main(date, hour):
     paths = ut.load_paths(dir)
     paths['output'] = os.path.abspath(paths['output'])
     paths['data_store'] = os.path.abspath(paths['data_store'])
+    region = Region.from_config('slp', dir)
     pull_gefs_files(date=date, hour=hour)
-    fmean, fsprd = run_fcsts(paths=paths)
+    fmean, fsprd = run_fcsts(paths=paths, region=region)
     date = pd.to_datetime(fmean['valid_time'][0].values)
     logging.info('mcli started')
-    mc_mean, mc_std = run_mcli()
+    cache = ClimatologyCache(f'{paths["data_store"]}/cache/climatology')
+    mc_mean, mc_std = run_mcli(region=region, cache=cache)
     mc_std = mc_std.dropna(dim='lat')
     mc_mean = mc_mean.dropna(dim='lat')
     fmean, fsprd = align_fmean_fsprd(fmean, fsprd, mc_mean)
     fmean.to_netcdf(f'{paths["output"]}/slp_mean_{date.year}{date.month:02}{date.day:02}_{date.hour:02}z.nc')
     fsprd.to_netcdf(f'{paths["output"]}/slp_sprd_{date.year}{date.month:02}{date.day:02}_{date.hour:02}z.nc')
     logging.info('fmean and spread saved, mcli finished')
-    logging.info('percentile started')
-    percentile = combine_fcast_and_mcli(fmean, mc_mean)
+    analogs = cache.analogs(mc_mean, mc_std)
     gc.collect()
-    logging.info('percentile complete')
-    subset_sprd = transforms.subset_sprd(percentile, mc_std)
-    logging.info('spread subset complete')
-    hsa_final, ssa_perc = transforms.hsa(fsprd, subset_sprd)
+    logging.info('hsa started')
+    hsa_final, ssa_perc = run_tiled(fmean, fsprd, analogs, tile, workers, memory_budget, executor)
     ssa_perc.to_netcdf(f'{paths["output"]}/ssa_perc_{date.year}{date.month:02}{date.day:02}_{date.hour:02}z.nc')
     hsa_final.to_netcdf(f'{paths["output"]}/hsa_{date.year}{date.month:02}{date.day:02}_{date.hour:02}z.nc')
     logging.info('hsa and ssa percentile file created')
@@ -48,7 +48,7 @@ def pull_gefs_files(date=None,hour=None):
     non_async=True,
     force_hour_value=hour,
     force_day_value=date)
-    _ = [retr.run(n) for n in stat]
+    retr.run(stat)
 
 @profile
 def run_fcsts(paths):
@@ -0,0 +1,80 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+from dask.distributed import Client
+
+import transforms
+
+
+# Peak memory of a worker per byte of its tile's AnalogClimatology,
+# measured with tracemalloc over hsa_tile for float32 and float64
+# climatologies: 1 for the pickled tile as it arrives, 1 for the unpickled
+# inputs and under 0.01 for the chain's temporaries (the analog band and
+# the counts walking it are all the size of the forecast grid), rounded up.
+TILE_OVERHEAD = 2.1
+
+def hsa_tile(fmean, fsprd, analogs, count):
+    '''HSA and spread percentile for one lat/lon tile from its analogs; count
+    is the whole domain's spread percentile denominator (see transforms.hsa).'''
+    return transforms.analog_hsa(fsprd, fmean, analogs), transforms.analog_spread_percentile(fsprd, fmean, analogs, count=count)
+
+def domain_count(fmean, fsprd, analogs):
+    '''The spread percentile denominator transforms.hsa uses for the whole
+    domain, from the analogs at its first gridpoint.'''
+    first = dict(lat=slice(0, 1), lon=slice(0, 1))
+    point = transforms.AnalogClimatology(analogs.data.isel(first))
+    return transforms.analog_spread_percentile(fsprd.isel(first), fmean.isel(first), point).attrs['count']
+
+def tile_size(analogs, memory_budget):
+    '''Largest square tile (in gridpoints per side) whose chain fits in memory_budget bytes.'''
+    points = len(analogs.data['lat']) * len(analogs.data['lon'])
+    per_point = TILE_OVERHEAD * analogs.data.nbytes / points
+    return max(1, int(np.sqrt(memory_budget / per_point)))
+
+def tile_slices(n_lat, n_lon, tile):
+    '''Rows of lat/lon isel dicts covering the domain in tile x tile blocks.'''
+    return [[dict(lat=slice(i, i+tile), lon=slice(j, j+tile)) for j in range(0, n_lon, tile)] for i in range(0, n_lat, tile)]
+
+def run_tiled(fmean, fsprd, analogs, tile=None, workers=None, memory_budget=2e9, executor='process'):
+    '''
+    Runs hsa_tile over lat/lon tiles of the domain in a process pool or a
+    local dask cluster and stitches the tiles back into the hsa and
+    spread percentile Datasets. Every gridpoint is independent and the
+    spread percentile denominator is taken from the whole domain, so the
+    result is the same as running the chain on the whole domain.
+    Parameters
+    ---------
+    tile : int
+        Gridpoints per tile side; by default, and at most, the largest
+        tile that fits memory_budget.
+    workers : int
+        Processes (or dask workers); default is one per cpu.
+    memory_budget : float
+        Bytes a tile's inputs and working arrays may use.
+    executor : str
+        process or dask.
+    '''
+    assert executor in ['process', 'dask'], 'executor must be process or dask'
+    fits = tile_size(analogs, memory_budget)
+    if tile and tile > fits:
+        logging.info(f'tile {tile} exceeds the memory budget, using {fits}')
+    tile = min(tile, fits) if tile else fits
+    count = domain_count(fmean, fsprd, analogs)
+    rows = tile_slices(len(analogs.data['lat']), len(analogs.data['lon']), tile)
+    jobs = [(fmean.isel(n), fsprd.isel(n), transforms.AnalogClimatology(analogs.data.isel(n)), count) for row in rows for n in row]
+    logging.info(f'{len(jobs)} tiles of {tile}x{tile} on {executor} workers')
+    if executor == 'dask':
+        client = Client(n_workers=workers, threads_per_worker=1, memory_limit=memory_budget)
+        try:
+            results = client.gather(client.map(hsa_tile, *zip(*jobs), pure=False))
+        finally:
+            client.close()
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(hsa_tile, *zip(*jobs)))
+    n_lon = len(rows[0])
+    hsa_final = xr.combine_nested([[n[0] for n in results[i:i+n_lon]] for i in range(0, len(results), n_lon)], concat_dim=['lat', 'lon'])
+    ssa_perc = xr.combine_nested([[n[1] for n in results[i:i+n_lon]] for i in range(0, len(results), n_lon)], concat_dim=['lat', 'lon'])
+    return hsa_final, ssa_perc
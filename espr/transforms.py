@@ -1,13 +1,15 @@
+import os
 import xarray as xr
 import numpy as np
 import bottleneck
 import cfgrib
 
-def hsa(gefs_sprd, subset, debug=False):
+def hsa(gefs_sprd, subset, debug=False, count=None):
     '''Standardizes, sets min and max between -1 and 1, and takes the arctanh to derive
     a "normal" distribution to ascribe more statistical relevance to the zscore values.
     
-    Known as historical spread anomaly, or HSA.'''
+    Known as historical spread anomaly, or HSA. count overrides the number the
+    spread percentile is divided by, e.g. the whole domain's when given a tile.'''
     try:
         gefs_sprd = gefs_sprd.rename({'time':'fhour'})
     except:
@@ -17,15 +19,21 @@ def hsa(gefs_sprd, subset, debug=False):
     except:
         pass
     subset_vals = (gefs_sprd['Pressure'] - subset.mean('time',skipna=True))/subset.std('time',skipna=True)
-    new_stacked = xr.concat([subset.drop('timestr').to_dataset(),gefs_sprd.expand_dims('time')],'time')
-    percentile = bottleneck.nanrankdata(new_stacked['Pressure'],axis=0)/np.count_nonzero(~np.isnan(new_stacked['Pressure'][:,0,0,0]))
+    subset = subset.transpose('time','fhour','lat','lon')
+    values = gefs_sprd['Pressure'].transpose('fhour','lat','lon').values
+    below, equal, _ = rank_of_value(subset.values, values)
+    # as a share of the number of reforecast values (plus the forecast) at the first gridpoint
+    if count is None:
+        count = first_point_count(subset, gefs_sprd)
+    percentile = (below + (equal + 2) / 2) / count
+    percentile = np.where(np.isnan(values), np.nan, percentile)
     perc_ds = xr.Dataset(
     data_vars=dict( 
-        spread_percentile=(["fhour","lat","lon"],percentile[-1])
+        spread_percentile=(["fhour","lat","lon"],percentile)
         ), coords=dict( 
-            lon=new_stacked.lon.values, 
-            lat=new_stacked.lat.values, 
-            fhour=new_stacked.fhour.values 
+            lon=subset.lon.values, 
+            lat=subset.lat.values, 
+            fhour=subset.fhour.values 
             ), 
             attrs=dict(
                 description="Spread percentile based on reforecast\
@@ -37,6 +45,11 @@ def hsa(gefs_sprd, subset, debug=False):
     # subset_vals = np.arctanh(subset_vals)
     return subset_vals, perc_ds
 
+def first_point_count(subset, gefs_sprd):
+    '''Non-NaN subset values plus the forecast at the first (fhour, lat, lon).'''
+    point = dict(fhour=0, lat=0, lon=0)
+    return int(np.count_nonzero(~np.isnan(subset.isel(point).values)) + ~np.isnan(gefs_sprd['Pressure'].isel(point).values))
+
 def xarr_interpolate(original, new):
     new_lat = [i for i in new.coords if 'lat' in i][0]
     new_lon = [i for i in new.coords if 'lon' in i][0]
@@ -47,14 +60,20 @@ def xarr_interpolate(original, new):
     interpolated_ds = original.interp({old_lat:new_lat_vals})
     return interpolated_ds
 
-def subset_sprd(percentile, mc_std, percentile_bounds=0.05):
-    mask = np.logical_and(percentile >= percentile[-1]-percentile_bounds, percentile <= percentile[-1]+percentile_bounds)
+def subset_sprd(percentile, mc_std, percentile_bounds=0.05, fcast_percentile=None):
+    '''Masks mc_std to the dates whose mean percentile is within
+    percentile_bounds of the forecast's. percentile is either the member
+    percentiles with fcast_percentile given separately, or both stacked
+    along time with the forecast last.'''
+    if fcast_percentile is None:
+        percentile, fcast_percentile = percentile[:-1], percentile[-1]
+    mask = np.logical_and(percentile >= fcast_percentile-percentile_bounds, percentile <= fcast_percentile+percentile_bounds)
     try:
         mc_std = mc_std[[n for n in mc_std][0]]
     except:
         pass
     # mc_std.rename({'fhour':'time','time':'fhour'})
-    mask_da=xr.DataArray(mask[:-1], coords={
+    mask_da=xr.DataArray(mask, coords={
         'fhour':mc_std.fhour.values, 
         'time':mc_std.time.values, 
         'lat':mc_std.lat.values, 
@@ -69,3 +88,238 @@ def subset_sprd(percentile, mc_std, percentile_bounds=0.05):
     )
     mc_std = mc_std.where(mask_da)
     return mc_std
+
+def rank_of_value(climatology, values, block=32):
+    '''Counts, at each point, the climatology values (along axis 0) below
+    and equal to the value there and the non-NaN climatology values, a
+    block of time steps at a time so memory stays O(climatology) without
+    concatenating the forecast on. Returns (below, equal, count).'''
+    values = np.asarray(values)
+    below = np.zeros(values.shape, dtype='int64')
+    equal = np.zeros(values.shape, dtype='int64')
+    count = np.zeros(values.shape, dtype='int64')
+    for start in range(0, climatology.shape[0], block):
+        chunk = np.asarray(climatology[start:start+block])
+        below += (chunk < values).sum(axis=0)
+        equal += (chunk == values).sum(axis=0)
+        count += (~np.isnan(chunk)).sum(axis=0)
+    return below, equal, count
+
+def rank_percentile(below, equal, n, values):
+    '''Average rank of values among n others (below of them smaller, equal
+    of them tied) and themselves, divided by n + 1; NaN where values are.'''
+    return np.where(np.isnan(values), np.nan, (below + (equal + 2) / 2) / (n + 1))
+
+def member_percentile(rank, below, equal):
+    '''Percentile of each climatology value, from its rank along axis 0,
+    once a forecast with below values under it and equal tied with it is
+    added: its rank moves up by 1 if the forecast is below it and by 0.5
+    if tied.'''
+    shift = np.where(rank > below + equal, 1., np.where(rank > below, 0.5, 0.))
+    return (rank + shift) / (rank.shape[0] + 1)
+
+def percentile_of_value(climatology, values, skipna=False, block=32):
+    '''Percentile of each value against the climatology (along axis 0) and
+    itself, as bottleneck.rankdata of the concatenation divided by its
+    length, or over the non-NaN climatology values (nanrankdata) if skipna.'''
+    below, equal, count = rank_of_value(climatology, values, block)
+    return rank_percentile(below, equal, count if skipna else climatology.shape[0], values)
+
+def sorted_search(sorted_values, values, side='left', key=None):
+    '''Vectorized binary search: the searchsorted index of each of values in
+    its own column of sorted_values (sorted along axis 0, NaNs last), in
+    log2(len(sorted_values)) passes over the grid. If given, key maps each
+    probed row to the (still ascending) values actually compared.'''
+    n = sorted_values.shape[0]
+    lo = np.zeros(values.shape, dtype='int64')
+    hi = np.full(values.shape, n, dtype='int64')
+    while (lo < hi).any():
+        mid = (lo + hi) // 2
+        probe = np.take_along_axis(sorted_values, np.minimum(mid, n-1)[None], axis=0)[0]
+        if key is not None:
+            probe = key(probe)
+        right = probe < values if side == 'left' else probe <= values
+        active = lo < hi
+        lo = np.where(active & right, mid + 1, lo)
+        hi = np.where(active & ~right, mid, hi)
+    return lo
+
+class PresortedClimatology:
+    '''Climatology sorted along time at every (fhour, lat, lon), with the
+    rank of each value and the NaN count per point, so the percentile of a
+    forecast against it is a binary search instead of concatenating the
+    forecast on and ranking everything again. Matches
+    bottleneck.rankdata of the concatenation divided by its length: ties
+    take their average rank and NaNs rank last.'''
+    def __init__(self, data, dim='time'):
+        self.data = data
+        self.dim = dim
+
+    @classmethod
+    def from_dataarray(cls, data, dim='time'):
+        data = data.transpose(dim, ...)
+        values = data.values
+        presorted = xr.Dataset(
+            data_vars=dict(
+                sorted=(['order'] + list(data.dims[1:]), np.sort(values, axis=0)),
+                rank=(list(data.dims), bottleneck.rankdata(values, axis=0).astype('float32')),
+                nan_count=(list(data.dims[1:]), np.isnan(values).sum(axis=0)),
+            ), coords={n: data[n] for n in data.dims})
+        return cls(presorted, dim)
+
+    @classmethod
+    def load(cls, path, dim='time'):
+        with xr.open_dataset(path) as data:
+            return cls(data.load(), dim)
+
+    def save(self, path):
+        self.data.to_netcdf(f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+
+    def _values(self, fcast):
+        if isinstance(fcast, xr.DataArray):
+            return fcast.transpose(*self.data['nan_count'].dims).values
+        return np.asarray(fcast)
+
+    def _search(self, values):
+        sorted_values = self.data['sorted'].values
+        below = sorted_search(sorted_values, values, 'left')
+        return below, sorted_search(sorted_values, values, 'right') - below
+
+    def percentile(self, fcast, skipna=False):
+        '''Percentile of each forecast value among the climatology and itself,
+        over the non-NaN climatology values if skipna.'''
+        values = self._values(fcast)
+        below, equal = self._search(values)
+        n = self.data['sorted'].shape[0]
+        if skipna:
+            n = n - self.data['nan_count'].values
+        return rank_percentile(below, equal, n, values)
+
+    def member_percentiles(self, fcast):
+        '''Percentile of every climatology value once the forecast is added.'''
+        below, equal = self._search(self._values(fcast))
+        return member_percentile(self.data['rank'].values, below, equal)
+
+    def percentiles(self, fcast):
+        '''Member percentiles with the forecast's last along time, the same
+        array as ranking the concatenation.'''
+        return np.concatenate([self.member_percentiles(fcast), self.percentile(fcast)[None]])
+
+class AnalogClimatology(PresortedClimatology):
+    '''Presorted mean climatology plus the spread climatology ordered by
+    mean, with prefix sums of spread, spread squared and non-NaN count
+    along that order. The analogs of a forecast (reforecast dates whose
+    mean percentile is within percentile_bounds of the forecast's, as in
+    subset_sprd) are a contiguous band in mean order, found by binary
+    search, so their spread mean and standard deviation are differences
+    of the prefix sums rather than a 4-D mask over the climatology. Dates
+    with a NaN mean are never analogs; subset_sprd would keep them or not
+    depending on the order bottleneck happens to rank NaNs in.'''
+    @classmethod
+    def from_dataarrays(cls, mc_mean, mc_std, dim='time'):
+        try:
+            mc_std = mc_std[[n for n in mc_std][0]]
+        except:
+            pass
+        analogs = super().from_dataarray(mc_mean, dim)
+        rank = analogs.data['rank'].values
+        order = np.argsort(rank, axis=0, kind='stable')
+        spread = np.take_along_axis(mc_std.transpose(*analogs.data['rank'].dims).values.astype('float64'), order, axis=0)
+        valid = ~np.isnan(spread)
+        spread = np.where(valid, spread, 0.)
+        edge_dims = ['edge'] + list(analogs.data['nan_count'].dims)
+        def prefix(x):
+            return np.concatenate([np.zeros((1,) + x.shape[1:], dtype=x.dtype), np.cumsum(x, axis=0)])
+        analogs.data['rank_sorted'] = (['order'] + list(analogs.data['nan_count'].dims), np.take_along_axis(rank, order, axis=0))
+        analogs.data['spread_sorted'] = (['order'] + list(analogs.data['nan_count'].dims), np.where(valid, spread, np.nan))
+        analogs.data['spread_sum'] = (edge_dims, prefix(spread))
+        analogs.data['spread_sq_sum'] = (edge_dims, prefix(spread**2))
+        analogs.data['spread_count'] = (edge_dims, prefix(valid.astype('int32')))
+        return analogs
+
+    def band(self, fmean, percentile_bounds=0.05):
+        '''Start and end (exclusive) in mean order of each point's analogs.'''
+        values = self._values(fmean)
+        below, equal = self._search(values)
+        rank_sorted = self.data['rank_sorted'].values
+        n = rank_sorted.shape[0]
+        percentile = self.percentile(values)
+        def concat_percentile(rank):
+            return (rank + np.where(rank > below + equal, 1., np.where(rank > below, 0.5, 0.))) / (n + 1)
+        start = sorted_search(rank_sorted, percentile - percentile_bounds, 'left', concat_percentile)
+        end = sorted_search(rank_sorted, percentile + percentile_bounds, 'right', concat_percentile)
+        end = np.minimum(end, n - self.data['nan_count'].values)
+        return np.minimum(start, end), end
+
+    def _band_sum(self, name, start, end):
+        prefix = self.data[name].values
+        return np.take_along_axis(prefix, end[None], axis=0)[0] - np.take_along_axis(prefix, start[None], axis=0)[0]
+
+    def stats(self, fmean, percentile_bounds=0.05):
+        '''Mean and (population) standard deviation of the analogs' spread.'''
+        start, end = self.band(fmean, percentile_bounds)
+        count = self._band_sum('spread_count', start, end)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._band_sum('spread_sum', start, end) / count
+            std = np.sqrt(np.maximum(self._band_sum('spread_sq_sum', start, end) / count - mean**2, 0.))
+        coords = {n: self.data[n] for n in self.data['nan_count'].dims}
+        dims = self.data['nan_count'].dims
+        return xr.DataArray(mean, coords=coords, dims=dims), xr.DataArray(std, coords=coords, dims=dims)
+
+    def spread_rank(self, fmean, fsprd, percentile_bounds=0.05):
+        '''Counts, at each point, the analogs' spread values below and equal
+        to fsprd and the non-NaN ones, visiting only the rows of each
+        point's band (about 2*percentile_bounds of the climatology) rather
+        than masking all of it. Returns (below, equal, count).'''
+        start, end = self.band(fmean, percentile_bounds)
+        values = self._values(fsprd)
+        spread = self.data['spread_sorted'].values
+        below = np.zeros(values.shape, dtype='int64')
+        equal = np.zeros(values.shape, dtype='int64')
+        for offset in range(int((end - start).max(initial=0))):
+            row = start + offset
+            inside = row < end
+            probe = np.take_along_axis(spread, np.minimum(row, spread.shape[0]-1)[None], axis=0)[0]
+            below += inside & (probe < values)
+            equal += inside & (probe == values)
+        return below, equal, self._band_sum('spread_count', start, end)
+
+def analog_spread_percentile(gefs_sprd, fmean, analogs, percentile_bounds=0.05, count=None):
+    '''Spread percentile (see hsa) from an AnalogClimatology: the rank of
+    the forecast spread among the spread on its analog dates, without the
+    4-D subset_sprd mask. count overrides the number it is divided by, by
+    default the analogs at the first gridpoint plus the forecast, and is
+    kept in the count attribute.'''
+    try:
+        gefs_sprd = gefs_sprd.rename({'time':'fhour'})
+    except:
+        pass
+    values = analogs._values(gefs_sprd['Pressure'])
+    below, equal, n = analogs.spread_rank(fmean['Pressure'], values, percentile_bounds)
+    if count is None:
+        first = (0,) * values.ndim
+        count = int(n[first]) + int(not np.isnan(values[first]))
+    percentile = np.where(np.isnan(values), np.nan, (below + (equal + 2) / 2) / count)
+    dims = analogs.data['nan_count'].dims
+    return xr.Dataset(
+        data_vars=dict(spread_percentile=(dims, percentile)),
+        coords={n: analogs.data[n].values for n in dims},
+        attrs=dict(description="Spread percentile based on reforecast\
+            of similar mean anomalies by gridpoint.", count=count),
+    )
+
+def analog_hsa(gefs_sprd, fmean, analogs, percentile_bounds=0.05):
+    '''HSA (see hsa) from an AnalogClimatology: the forecast spread
+    standardized by the mean and standard deviation of the spread on
+    reforecast dates with a similar mean percentile.'''
+    try:
+        gefs_sprd = gefs_sprd.rename({'time':'fhour'})
+    except:
+        pass
+    mean, std = analogs.stats(fmean['Pressure'], percentile_bounds)
+    try:
+        gefs_sprd = gefs_sprd.assign_coords(fhour=mean.fhour)
+    except:
+        pass
+    return (gefs_sprd['Pressure'] - mean)/std
@@ -9,6 +9,12 @@ import json
 import asyncio
 import requests
 import xarray as xr
+import logging
+import time
+import glob
+import fcntl
+import hashlib
+import contextlib
 
 def str_to_bool(s: str):
     s = s.lower()
@@ -18,6 +24,16 @@ def str_to_bool(s: str):
         return False
 
 async def gather_with_concurrency(n, *tasks):
+    """
+    Gathers tasks with at most n running at once. n is either an int
+    (fixed semaphore) or an AdaptiveLimiter, whose limit moves with the
+    latency and outcome of the tasks.
+    """
+    if isinstance(n, AdaptiveLimiter):
+        async def limited_task(task):
+            async with n.slot():
+                return await task
+        return await asyncio.gather(*(limited_task(task) for task in tasks))
     semaphore = asyncio.Semaphore(n)
 
     async def sem_task(task):
@@ -25,12 +41,190 @@ async def gather_with_concurrency(n, *tasks):
             return await task
     return await asyncio.gather(*(sem_task(task) for task in tasks))
 
+def is_throttle(exc):
+    """True for errors that mean the server wants less load: 429/503 or a timeout."""
+    return getattr(exc, 'status', None) in (429, 503) or isinstance(exc, asyncio.TimeoutError)
+
+class _LimiterSlot:
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    async def __aenter__(self):
+        await self.limiter.acquire()
+        self.start = time.perf_counter()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.limiter.release(time.perf_counter() - self.start, exc)
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter for requests against a shared host.
+    The limit grows by one after each full round (limit successes) of
+    healthy requests and is cut multiplicatively on a 429/503, a timeout
+    or a latency spike, pausing new requests for a cooldown so a
+    slowdown does not turn into a retry storm. Limit changes are logged.
+
+    Parameters
+    ---------
+    initial : int
+        Starting concurrency.
+    minimum : int
+        Lowest concurrency allowed. Default is 1.
+    maximum : int
+        Highest concurrency allowed. Default is 4x initial. Setting
+        minimum == maximum == initial gives a fixed limit.
+    decrease : float
+        Factor the limit is multiplied by on backoff. Default is 0.5.
+    latency_factor : float
+        A request slower than this multiple of the smoothed latency
+        counts as a latency spike. Default is 3.
+    cooldown : float
+        Seconds new requests wait after a throttle response.
+    """
+    def __init__(self,
+        initial: int=10,
+        minimum: int=1,
+        maximum: int=None,
+        decrease: float=0.5,
+        latency_factor: float=3.,
+        cooldown: float=5.):
+
+        self.minimum = minimum
+        self.maximum = maximum if maximum is not None else 4*initial
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.successes = 0
+        self.latency = None
+        self.paused_until = 0.
+        self.last_decrease = 0.
+        self._condition = None
+
+    def __str__(self):
+        return f'Adaptive limit {int(self.limit)} ({self.in_flight} in flight)'
+
+    @property
+    def condition(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def slot(self):
+        """Async context manager holding one unit of concurrency."""
+        return _LimiterSlot(self)
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        pause = self.paused_until - time.perf_counter()
+        if pause > 0:
+            await asyncio.sleep(pause)
+
+    async def release(self, latency, exc=None):
+        self.record(latency, exc)
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.minimum), self.maximum)
+        if int(limit) != int(self.limit):
+            logging.info(f'concurrency limit {int(self.limit)} -> {int(limit)} ({reason})')
+        self.limit = limit
+
+    def _back_off(self, reason):
+        now = time.perf_counter()
+        # one cut per round trip, not one per request that was already in flight
+        if now - self.last_decrease < (self.latency or 0.):
+            return
+        self.last_decrease = now
+        self.successes = 0
+        self._set_limit(self.limit*self.decrease, reason)
+
+    def record(self, latency, exc=None):
+        if exc is not None:
+            if is_throttle(exc):
+                self.paused_until = time.perf_counter() + self.cooldown
+                self._back_off(f'{type(exc).__name__} {getattr(exc, "status", "")}'.strip())
+            return
+        if self.latency is not None and latency > self.latency_factor*self.latency:
+            self._back_off(f'latency {latency:.2f}s vs {self.latency:.2f}s')
+        else:
+            self.successes += 1
+            if self.successes >= int(self.limit):
+                self.successes = 0
+                self._set_limit(self.limit + 1, 'healthy')
+        self.latency = latency if self.latency is None else 0.9*self.latency + 0.1*latency
+
+def link_filename(link):
+    "Returns the local file name for a grib_filter query or a direct file url."
+    return link.split('/')[-1].split('=')[-1]
+
+def grib_index_dir(data_store):
+    "Shared directory for cfgrib index files of the GRIB files in data_store."
+    return f'{data_store}/cache/cfgrib'
+
+def grib_index_name(path):
+    "File name and a short hash of the absolute path, naming path's index files."
+    return f'{os.path.basename(path)}.{hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]}'
+
+def grib_indexpath(path, index_dir):
+    """
+    cfgrib indexpath template for path in index_dir. The file's size and
+    mtime are part of the name, so a rewritten file never reuses an old
+    index; {short_hash} is filled in by cfgrib from its index keys.
+    """
+    stat = os.stat(path)
+    return f'{index_dir}/{grib_index_name(path)}.{stat.st_size}.{stat.st_mtime_ns}.{{short_hash}}.idx'
+
+@contextlib.contextmanager
+def grib_index_lock(path, index_dir):
+    """
+    Cross-process lock around opening path with its cached index. The lock
+    is exclusive while the index for the file's current size and mtime is
+    missing, so one process scans the file and the rest wait and read the
+    index, and shared once it exists. Indexes of older versions of the
+    file are removed when a new one is about to be built.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    current = grib_indexpath(path, index_dir).replace('{short_hash}', '*')
+    exists = len(glob.glob(current)) > 0
+    with open(f'{index_dir}/{grib_index_name(path)}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if exists else fcntl.LOCK_EX)
+        try:
+            if not exists:
+                stale = set(glob.glob(f'{index_dir}/{grib_index_name(path)}.*.idx')) - set(glob.glob(current))
+                for old in stale:
+                    os.remove(old)
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def evict_grib_indexes(index_dir, paths):
+    "Removes the cached indexes and lock files of paths, e.g. when their cycle is pruned."
+    removed = []
+    for path in paths:
+        for cached in glob.glob(f'{index_dir}/{grib_index_name(path)}.*'):
+            os.remove(cached)
+            removed.append(cached)
+    return removed
+
 def load_paths(dir):
     "Loads the json file with associated paths for program."
     with open(f'{dir}/paths.json',) as f:
         paths = json.load(f)
     return paths
 
+def load_config(dir):
+    "Loads the json file with per-variable domains and forecast hours."
+    with open(f'{dir}/config.json',) as f:
+        config = json.load(f)
+    return config
+
 def req_status_bool(link):
     page = requests.get(link)
     return page.ok
@@ -54,6 +248,15 @@ def replace_year(x, year):
     x_year = x_year - day_offset
     return x_year
 
+def day_of_year(times):
+    """
+    Day of year (0-365) of each time, counted in the leap year 2012 via
+    replace_year so that a month and day always map to the same value,
+    e.g. Mar 1 is 60 in every year.
+    """
+    x = replace_year(np.asarray(times).astype('datetime64[D]'), 2012)
+    return (x - x.astype('M8[Y]')).astype(int)
+
 def add_colorbar(im, aspect=20, pad_fraction=0.5, **kwargs):
     """Add a vertical color bar to an image plot."""
     divider = axes_grid1.make_axes_locatable(im.axes)
@@ -0,0 +1,19 @@
+import datetime
+
+from espr import catalog
+
+
+def test_parse_filename() -> None:
+    assert catalog.parse_filename('tmp_pres_mean_2005071500_f024.nc') == ('tmp_pres', 'mean', datetime.date(2005, 7, 15), 24)
+    assert catalog.parse_filename('sprd_20050715.nc') == (None, 'sprd', datetime.date(2005, 7, 15), None)
+    assert catalog.parse_filename('catalog.sqlite') is None
+
+def test_refresh(tmp_path) -> None:
+    (tmp_path / 'slp_mean_2005071500.nc').touch()
+    (tmp_path / 'slp_mean_2006071500.nc').touch()
+    cat = catalog.ReforecastCatalog(str(tmp_path))
+    assert cat.build() == (2, 0)
+    (tmp_path / 'slp_mean_2006071500.nc').unlink()
+    (tmp_path / 'slp_mean_2007071600.nc').touch()
+    assert cat.refresh() == (1, 1)
+    assert [f.split('/')[-1] for f in cat.files('mean', [196, 197])] == ['slp_mean_2005071500.nc', 'slp_mean_2007071600.nc']
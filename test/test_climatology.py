@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from espr import climatology
+from espr import mclimate
+
+
+def _write_reforecast(tmp_path):
+    times = np.arange('2010-06-01', '2012-09-01', dtype='datetime64[D]').astype('datetime64[ns]')
+    values = np.arange(len(times) * 4, dtype='float32').reshape(len(times), 2, 2)
+    ds = xr.Dataset({'Pressure': (('time', 'lat', 'lon'), values)}, coords={'time': times, 'lat': [25., 20.], 'lon': [180., 185.]})
+    ds.to_netcdf(tmp_path / 'slp_mean_jja_high.nc')
+
+def test_window_matches_generate(tmp_path) -> None:
+    _write_reforecast(tmp_path)
+    cache = climatology.ClimatologyCache(str(tmp_path / 'cache'))
+    mcli = mclimate.MClimate('2021-07-15', str(tmp_path), 'slp', period=2)
+    window = cache.window(mcli, 'mean')
+    expected = mcli.generate('mean')
+    np.testing.assert_array_equal(window.time.values, expected.time.values)
+    np.testing.assert_array_equal(window.Pressure.values, expected.Pressure.values)
+    assert len(os.listdir(tmp_path / 'cache')) == 5
+
+def test_window_moves_by_one_slab(tmp_path, monkeypatch) -> None:
+    _write_reforecast(tmp_path)
+    cache = climatology.ClimatologyCache(str(tmp_path / 'cache'))
+    cache.window(mclimate.MClimate('2021-07-15', str(tmp_path), 'slp', period=2), 'mean')
+    generated = []
+    generate = mclimate.MClimate.generate
+    monkeypatch.setattr(mclimate.MClimate, 'generate', lambda self, *args, **kwargs: generated.append(kwargs['days']) or generate(self, *args, **kwargs))
+    window = cache.window(mclimate.MClimate('2021-07-16', str(tmp_path), 'slp', period=2), 'mean')
+    assert generated == [[199]]
+    assert len(window.time) == 15
+
+def test_evicts_least_recently_used(tmp_path) -> None:
+    _write_reforecast(tmp_path)
+    cache = climatology.ClimatologyCache(str(tmp_path / 'cache'))
+    cache.window(mclimate.MClimate('2021-07-15', str(tmp_path), 'slp', period=0), 'mean')
+    cache.budget = cache.size()
+    cache.window(mclimate.MClimate('2021-07-20', str(tmp_path), 'slp', period=0), 'mean')
+    assert [n.split('_')[2] for n in os.listdir(tmp_path / 'cache')] == ['201']
+
+def test_analogs_reused(tmp_path) -> None:
+    _write_reforecast(tmp_path)
+    cache = climatology.ClimatologyCache(str(tmp_path / 'cache'))
+    window = cache.window(mclimate.MClimate('2021-07-15', str(tmp_path), 'slp', period=2), 'mean')
+    first = cache.analogs(window.dropna(dim='lat'), window)
+    assert len([n for n in os.listdir(tmp_path / 'cache') if n.endswith('.analogs.nc')]) == 1
+    second = cache.analogs(window, window)
+    np.testing.assert_array_equal(first.data['spread_sorted'].values, second.data['spread_sorted'].values)
+    np.testing.assert_array_equal(second.data['sorted'].values, np.sort(window.Pressure.values, axis=0))
@@ -0,0 +1,56 @@
+import os
+from datetime import datetime
+
+import numpy as np
+
+from espr import ens_store
+from espr import manifest
+from bench.nomads_standin import grib2_message
+
+
+def _write_member(tmp_path, m, filename, fhour):
+    lats, lons = np.arange(60., 19., -5.), np.arange(180., 311., 5.)
+    values = np.full((len(lats), len(lons)), 101325. + fhour, dtype='float32')
+    data = grib2_message(values, lats, lons, datetime(2021, 7, 15, 12), fhour, 0, 3, 1, 101, 0)
+    os.makedirs(m.cycle_dir, exist_ok=True)
+    open(m.file_path(filename), 'wb').write(data)
+    m.record(filename, f'https://example?file={filename}', len(data), 'x')
+
+def test_member_fhour() -> None:
+    assert ens_store.member_fhour('gep05.t12z.pgrb2s.0p25.f012') == (5, 12)
+
+def test_ingest_removes_grib(tmp_path) -> None:
+    m = manifest.DownloadManifest(str(tmp_path), 'gefs.20210715/', '12/', 'ens')
+    store = ens_store.EnsembleStore(m, ['gec00', 'gep01'], [0, 3])
+    for filename, fhour in [('gec00.t12z.pgrb2s.0p25.f003', 3), ('gep01.t12z.pgrb2s.0p25.f000', 0)]:
+        _write_member(tmp_path, m, filename, fhour)
+        store.ingest(filename)
+    assert not os.path.exists(m.file_path('gec00.t12z.pgrb2s.0p25.f003'))
+    assert m.pending(['https://example?file=gec00.t12z.pgrb2s.0p25.f003']) == []
+    ds = store.open()
+    assert ds.prmsl.shape == (2, 2, 9, 27)
+    assert float(ds.prmsl.sel(member='gec00', fhour=3).mean()) == 101328.
+    assert np.isnan(ds.prmsl.sel(member='gec00', fhour=0)).all()
+
+def test_field_names() -> None:
+    names = ens_store.field_names(['PRMSL', 'TMP', 'UGRD'], ['mean_sea_level', '850_mb', '10_m_above_ground'])
+    # grib_filter selects every variable at every level
+    assert names == ['prmsl', 't850', 'u10', 'u850']
+    assert ens_store.field_names(['PRMSL'], None) == []
+
+def test_schema_from_configuration(tmp_path) -> None:
+    m = manifest.DownloadManifest(str(tmp_path), 'gefs.20210715/', '12/', 'ens')
+    store = ens_store.EnsembleStore(m, ['gec00', 'gep01'], [0, 3], names=ens_store.field_names(['PRMSL', 'TMP'], ['mean_sea_level', '850_mb']))
+    _write_member(tmp_path, m, 'gec00.t12z.pgrb2s.0p25.f000', 0)
+    store.ingest('gec00.t12z.pgrb2s.0p25.f000')
+    assert set(store.open().data_vars) == {'prmsl', 't850'}
+    lats, lons = np.arange(60., 19., -5.), np.arange(180., 311., 5.)
+    values = np.full((len(lats), len(lons)), 5., dtype='float32')
+    data = grib2_message(values, lats, lons, datetime(2021, 7, 15, 12), 3, 0, 2, 2, 103, 10)
+    open(m.file_path('gep01.t12z.pgrb2s.0p25.f003'), 'wb').write(data)
+    m.record('gep01.t12z.pgrb2s.0p25.f003', 'https://example?file=gep01.t12z.pgrb2s.0p25.f003', len(data), 'x')
+    store.ingest('gep01.t12z.pgrb2s.0p25.f003')
+    ds = store.open()
+    assert set(ds.data_vars) == {'prmsl', 't850', 'u10'}
+    assert float(ds.u10.sel(member='gep01', fhour=3).mean()) == 5.
+    np.testing.assert_allclose(float(ds.prmsl.sel(member='gec00', fhour=0).mean()), 101325.)
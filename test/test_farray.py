@@ -1,4 +1,17 @@
+import os
+import re
+import asyncio
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pytest
+
 from espr import farray
+from espr import gefs_retrieve
+from espr import region
+from espr import manifest
+from bench.nomads_standin import grib2_message, NomadsStandIn
 
 
 def test_farray_slp() -> None:
@@ -22,3 +35,95 @@ def test_farray_temp_height() -> None:
 def test_farray_pwat() -> None:
     forecast_array_class = farray.ForecastArray()
 
+
+def _write_mean_files(tmp_path, fhours):
+    lats, lons = np.arange(60., 19., -5.), np.arange(180., 311., 5.)
+    for fhour in fhours:
+        values = (101325. + fhour + np.add.outer(lats, lons)).astype('float32')
+        data = grib2_message(values, lats, lons, datetime(2021, 7, 15, 12), fhour, 0, 3, 1, 101, 0)
+        (tmp_path / f'geavg.t12z.pgrb2s.0p25.f{fhour:03}').write_bytes(data)
+
+def test_load_forecast_cache(tmp_path) -> None:
+    _write_mean_files(tmp_path, [0, 3, 6])
+    forecast = farray.ForecastArray('mean', 'slp', paths={'data_store': str(tmp_path)})
+    first = forecast.load_forecast()
+    assert os.path.exists(forecast.cache_path())
+    assert forecast.read_cache(forecast.file_list()) is not None
+    _write_mean_files(tmp_path, [9])
+    assert forecast.read_cache(forecast.file_list()) is None
+    second = forecast.load_forecast()
+    assert first['Pressure'].shape == (3, 9, 27)
+    assert second['Pressure'].shape == (4, 9, 27)
+
+def test_process_decoder_matches_cfgrib(tmp_path) -> None:
+    _write_mean_files(tmp_path, [0, 3, 6])
+    paths = {'data_store': str(tmp_path)}
+    expected = farray.ForecastArray('mean', 'slp', paths=paths, cache=False).load_forecast()
+    result = farray.ForecastArray('mean', 'slp', paths=paths, cache=False, decoder='process', workers=2).load_forecast()
+    np.testing.assert_array_equal(result['Pressure'].values, expected['Pressure'].values)
+    np.testing.assert_array_equal(result['step'].values, expected['step'].values)
+
+def test_eccodes_decoder_matches_cfgrib(tmp_path) -> None:
+    _write_mean_files(tmp_path, [0, 3, 6])
+    paths = {'data_store': str(tmp_path)}
+    expected = farray.ForecastArray('mean', 'slp', paths=paths, cache=False).load_forecast()
+    result = farray.ForecastArray('mean', 'slp', paths=paths, cache=False, decoder='eccodes').load_forecast()
+    np.testing.assert_array_equal(result['Pressure'].values, expected['Pressure'].values)
+    np.testing.assert_array_equal(result['valid_time'].values, expected['valid_time'].values)
+    np.testing.assert_array_equal(result['lat'].values, expected['lat'].values)
+
+def test_region_pushdown(tmp_path) -> None:
+    _write_mean_files(tmp_path, [0, 3, 6])
+    r = region.Region((30, 45), (200, 220), fhours=(3, 6, 3))
+    for decoder in ['cfgrib', 'process', 'eccodes']:
+        forecast = farray.ForecastArray('mean', 'slp', paths={'data_store': str(tmp_path)}, cache=False, decoder=decoder, workers=1, region=r)
+        assert forecast.load_forecast()['Pressure'].shape == (2, 4, 5)
+
+def test_load_all_single_pass(tmp_path) -> None:
+    standin = NomadsStandIn(resolution=5.)
+    for fhour in [3, 6]:
+        messages = standin._messages(f'geavg.t12z.pgrb2s.0p25.f{fhour:03}', '2021071512', (20., 60., 180., 310.))
+        (tmp_path / f'geavg.t12z.pgrb2s.0p25.f{fhour:03}').write_bytes(b''.join(n[2] for n in messages))
+    forecast = farray.ForecastArray('mean', 'slp', paths={'data_store': str(tmp_path)}, group=True)
+    assert {'prmsl', 'tmp850', 'tmp925', 'wnd'} <= set(forecast.grouped)
+    assert forecast.grouped['tmp850'].shape == (2, 9, 27)
+    assert not np.allclose(forecast.grouped['tmp850'], forecast.grouped['tmp925'])
+    assert (forecast.grouped['wnd'] >= 0).all()
+
+def test_load_all_no_files(tmp_path) -> None:
+    with pytest.raises(FileNotFoundError, match=re.escape(f'no sprd (gespr) files in {tmp_path}')):
+        farray.ForecastArray('sprd', 'slp', paths={'data_store': str(tmp_path)}, group=True)
+
+def test_aiter_forecast_waits_for_lead_time(tmp_path) -> None:
+    # the previous day's 12z files, complete, must not stand in for this cycle's
+    stale = manifest.DownloadManifest(str(tmp_path), 'gefs.20210714/', '12/', 'mean')
+    m = manifest.DownloadManifest(str(tmp_path), 'gefs.20210715/', '12/', 'mean')
+    for cycle_dir in [stale.cycle_dir, m.cycle_dir]:
+        os.makedirs(cycle_dir)
+        _write_mean_files(Path(cycle_dir), [0, 3])
+    sizes = {n: os.path.getsize(m.file_path(n)) for n in os.listdir(m.cycle_dir)}
+    for name, size in sizes.items():
+        stale.record(name, 'u', size, 'x')
+    m.record('geavg.t12z.pgrb2s.0p25.f000', 'u', sizes['geavg.t12z.pgrb2s.0p25.f000'], 'x')
+    retr = gefs_retrieve.GEFSRetrieve(['PRMSL'], hour_end=3, download_dir=str(tmp_path))
+    retr.date_value, retr.hour_value = 'gefs.20210715/', '12/'
+    forecast = farray.ForecastArray('mean', 'slp', paths={'data_store': str(tmp_path)})
+    published = []
+
+    async def publish_later():
+        await asyncio.sleep(0.05)
+        published.append(len(slices))
+        m.record('geavg.t12z.pgrb2s.0p25.f003', 'u', sizes['geavg.t12z.pgrb2s.0p25.f003'], 'x')
+
+    slices = []
+    async def collect():
+        publisher = asyncio.ensure_future(publish_later())
+        async for n in forecast.aiter_forecast(retr, poll_interval=0.01):
+            slices.append(n)
+        await publisher
+
+    asyncio.new_event_loop().run_until_complete(collect())
+    assert published == [1]
+    assert forecast.manifest.cycle == '2021071512'
+    assert [int(n['step'].values.astype('timedelta64[h]').astype(int)) for n in slices] == [0, 3]
+    assert slices[0]['Pressure'].dims == ('lat', 'lon')
@@ -1 +1,126 @@
-from espr import gefs_retrieve
\ No newline at end of file
+import os
+import asyncio
+
+import aiohttp
+import pytest
+import requests
+
+from espr import gefs_retrieve
+from espr import grib_idx
+from espr import utils
+from bench.nomads_standin import NomadsStandIn
+
+
+IDX = """1:0:d=2021071512:PRMSL:mean sea level:3 hour fcst:ENS=mean
+2:100:d=2021071512:TMP:850 mb:3 hour fcst:ENS=mean
+3:250:d=2021071512:TMP:925 mb:3 hour fcst:ENS=mean
+4:400:d=2021071512:PWAT:entire atmosphere (considered as a single layer):3 hour fcst:ENS=mean
+"""
+
+def test_parse_idx_ends() -> None:
+    messages = grib_idx.parse_idx(IDX)
+    assert [n['end'] for n in messages] == [99, 249, 399, None]
+
+def test_select_by_level() -> None:
+    messages = grib_idx.select_messages(grib_idx.parse_idx(IDX), ['TMP'], ['850_mb'])
+    assert [n['num'] for n in messages] == ['2']
+
+def test_byte_ranges_merge_adjacent() -> None:
+    messages = grib_idx.select_messages(grib_idx.parse_idx(IDX), ['PRMSL', 'TMP', 'PWAT'], ['mean_sea_level', '925_mb', 'entire_atmosphere_(considered_as_a_single_layer)'])
+    assert grib_idx.byte_ranges(messages) == [(0, 99), (250, None)]
+    assert grib_idx.range_header(250) == 'bytes=250-'
+
+def _standin_retrieval(url, tmp_path, **kwargs):
+    retr = gefs_retrieve.GEFSRetrieve(['PRMSL', 'TMP'], levels=['mean_sea_level', '850_mb'], hour_end=12, download_dir=str(tmp_path), nomads_url=url, **kwargs)
+    retr.date_value = 'gefs.20210715/'
+    retr.hour_value = '06/'
+    retr.link_builder()
+    return retr
+
+def test_download_files_standin(tmp_path) -> None:
+    with NomadsStandIn(resolution=5.) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path)
+        retr.download_files(retr.mean_fhour_links[:2])
+    assert sorted(os.listdir(retr.cycle_dir())) == ['geavg.t06z.pgrb2s.0p25.f000', 'geavg.t06z.pgrb2s.0p25.f003']
+
+def test_download_files_standin_gzip(tmp_path) -> None:
+    with NomadsStandIn(resolution=5., compress=True) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path)
+        retr.download_files(retr.mean_fhour_links[:1])
+    with open(f'{retr.cycle_dir()}/geavg.t06z.pgrb2s.0p25.f000', 'rb') as f:
+        assert f.read(4) == b'GRIB'
+
+def test_idx_backend_standin_throttled(tmp_path) -> None:
+    with NomadsStandIn(resolution=5., throttle_rate=0.5) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path, backend='idx')
+        retr.limiter = utils.AdaptiveLimiter(4, cooldown=0.)
+        retr.download_files_async(retr.mean_fhour_links)
+        assert standin.stats['throttled'] > 0
+    assert len(os.listdir(retr.cycle_dir())) == 5
+
+def test_download_file_idx_standin(tmp_path) -> None:
+    with NomadsStandIn(resolution=5.) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path, backend='idx')
+        retr.download_file_idx(retr.mean_fhour_links[0])
+    assert os.listdir(retr.cycle_dir()) == ['geavg.t06z.pgrb2s.0p25.f000']
+
+def test_download_file_idx_no_messages(tmp_path) -> None:
+    with NomadsStandIn(resolution=5.) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path, backend='idx')
+        retr.variables = ['HGT']
+        with pytest.raises(ValueError):
+            retr.download_file_idx(retr.mean_fhour_links[0])
+
+def test_download_file_idx_range_ignored(tmp_path, monkeypatch) -> None:
+    get = requests.get
+    monkeypatch.setattr(requests, 'get', lambda url, headers=None, **kwargs: get(url, **kwargs))
+    with NomadsStandIn(resolution=5.) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path, backend='idx')
+        with pytest.raises(requests.exceptions.RequestException):
+            retr.download_file_idx(retr.mean_fhour_links[0])
+    assert 'geavg.t06z.pgrb2s.0p25.f000' not in os.listdir(retr.cycle_dir())
+
+def test_select_cycle_standin(tmp_path) -> None:
+    with NomadsStandIn(resolution=5., cycles=['2021071500', '2021071506'], publish_interval=60) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path)
+        retr.select_cycle(['mean'])
+    assert (retr.date_value, retr.hour_value) == ('gefs.20210715/', '00/')
+
+def test_cycle_completeness_standin_throttled(tmp_path) -> None:
+    with NomadsStandIn(resolution=5., cycles=['2021071500', '2021071506'], throttle_rate=0.5) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path)
+        retr.limiter = utils.AdaptiveLimiter(4, cooldown=0.)
+        completeness = asyncio.get_event_loop().run_until_complete(retr.cycle_completeness(retr.candidate_cycles(), ['mean']))
+        assert standin.stats['throttled'] > 0
+    assert all(all(files.values()) for files in completeness.values())
+
+def test_most_recent_links_previous_cycle(tmp_path) -> None:
+    cycles = []
+    def download_stat(stat):
+        cycles.append((retr.date_value, retr.hour_value))
+        if len(cycles) == 1:
+            raise aiohttp.ClientResponseError(None, (), status=404)
+    with NomadsStandIn(resolution=5., cycles=['2021071500', '2021071506']) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path, download=True)
+        retr.download_stat = download_stat
+        retr.most_recent_links('mean')
+    assert cycles == [('gefs.20210715/', '06/'), ('gefs.20210715/', '00/')]
+
+def test_most_recent_links_one_cycle_for_all_stats(tmp_path) -> None:
+    downloads, selected = [], []
+    select_cycle = gefs_retrieve.GEFSRetrieve.select_cycle
+    with NomadsStandIn(resolution=5., cycles=['2021071500', '2021071506']) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path, download=True)
+        retr.select_cycle = lambda stats: selected.append(stats) or select_cycle(retr, stats)
+        retr.download_stat = lambda stat: downloads.append((stat, retr.date_value, retr.hour_value))
+        retr.most_recent_links(['mean', 'sprd'])
+    assert selected == [['mean', 'sprd']]
+    assert downloads == [('mean', 'gefs.20210715/', '06/'), ('sprd', 'gefs.20210715/', '06/')]
+
+def test_previous_cycle_oldest(tmp_path) -> None:
+    with NomadsStandIn(resolution=5., cycles=['2021071500', '2021071506']) as standin:
+        retr = _standin_retrieval(standin.url, tmp_path)
+        retr.cycles = retr.candidate_cycles()
+    retr.date_value, retr.hour_value = retr.cycles[0]
+    with pytest.raises(ValueError):
+        retr.previous_cycle()
@@ -0,0 +1,30 @@
+from espr import listing
+from bench.nomads_standin import NomadsStandIn
+
+
+PAGE = """<html><body><h1>Index of /pub/data/nccf/com/gens/prod</h1>
+<a href="?C=N;O=D">Name</a>
+<a href="/pub/data/nccf/com/gens/">Parent Directory</a>
+<a href="gefs.20210714/">gefs.20210714/</a>
+<a HREF='gefs.20210715/'>gefs.20210715/</a>
+</body></html>"""
+
+def test_extract_hrefs() -> None:
+    assert listing.extract_hrefs(PAGE) == {'?C=N;O=D', '/pub/data/nccf/com/gens/', 'gefs.20210714/', 'gefs.20210715/'}
+
+def test_extract_hrefs_newest() -> None:
+    assert max(listing.extract_hrefs(PAGE)) == 'gefs.20210715/'
+
+def test_unchanged_listing_served_from_cache() -> None:
+    with NomadsStandIn(resolution=5., cycles=['2021071400', '2021071500']) as standin:
+        url = f'{standin.url}/pub/data/nccf/com/gens/prod/'
+        dirs = listing.DirectoryListing()
+        first = dirs.links(url)
+        second = dirs.links(url)
+        assert standin.stats['not_modified'] == 1
+        standin.cycles.append('2021071600')
+        third = dirs.links(url)
+    assert {'gefs.20210714/', 'gefs.20210715/'} <= first
+    assert second == first
+    assert third - first == {'gefs.20210716/'}
+    assert dirs.stats == {'requests': 3, 'not_modified': 1}
@@ -0,0 +1,40 @@
+import os
+
+from espr import manifest
+
+
+def _write(tmp_path, cycle, filename, content=b'grib'):
+    m = manifest.DownloadManifest(str(tmp_path), f'gefs.{cycle[:-2]}/', f'{cycle[-2:]}/', 'mean')
+    os.makedirs(m.cycle_dir, exist_ok=True)
+    open(m.file_path(filename), 'wb').write(content)
+    m.record(filename, f'https://example?file={filename}', len(content), 'x')
+    return m
+
+def test_cycle_key() -> None:
+    assert manifest.cycle_key('gefs.20210715/', '12/') == '2021071512'
+
+def test_manifest_pending(tmp_path) -> None:
+    _write(tmp_path, '2021071512', 'geavg.t12z.pgrb2s.0p25.f000')
+    m = manifest.DownloadManifest.latest(str(tmp_path), 'mean')
+    links = [f'https://example?file=geavg.t12z.pgrb2s.0p25.f{n:03}' for n in [0, 3]]
+    assert m.pending(links) == links[1:]
+
+def test_manifest_partial_file_is_pending(tmp_path) -> None:
+    m = _write(tmp_path, '2021071512', 'geavg.t12z.pgrb2s.0p25.f000')
+    open(m.file_path('geavg.t12z.pgrb2s.0p25.f000'), 'wb').write(b'gr')
+    assert not m.is_complete('geavg.t12z.pgrb2s.0p25.f000')
+
+def test_manifest_prune(tmp_path) -> None:
+    _write(tmp_path, '2021071412', 'old')
+    _write(tmp_path, '2021071512', 'new')
+    assert manifest.DownloadManifest.prune(str(tmp_path), 'mean', keep=1) == ['old']
+    assert manifest.DownloadManifest.cycles(str(tmp_path), 'mean') == ['2021071512']
+
+def test_manifest_same_hour_cycles(tmp_path) -> None:
+    old = _write(tmp_path, '2021071412', 'geavg.t12z.pgrb2s.0p25.f000', b'old')
+    new = _write(tmp_path, '2021071512', 'geavg.t12z.pgrb2s.0p25.f000', b'newer')
+    assert old.is_complete('geavg.t12z.pgrb2s.0p25.f000')
+    assert new.is_complete('geavg.t12z.pgrb2s.0p25.f000')
+    manifest.DownloadManifest.prune(str(tmp_path), 'mean', keep=1)
+    assert open(new.file_path('geavg.t12z.pgrb2s.0p25.f000'), 'rb').read() == b'newer'
+    assert not os.path.exists(old.cycle_dir)
@@ -1 +1,58 @@
-from espr import mclimate
\ No newline at end of file
+import numpy as np
+import pytest
+import xarray as xr
+
+from espr import catalog
+from espr import mclimate
+
+
+def test_window_selection_matches_dates(tmp_path) -> None:
+    times = np.arange('2010-06-01', '2012-09-01', dtype='datetime64[D]').astype('datetime64[ns]')
+    ds = xr.Dataset({'Pressure': ('time', np.arange(len(times), dtype='float32'))}, coords={'time': times})
+    ds.to_netcdf(tmp_path / 'slp_mean_jja_high.nc')
+    mcli = mclimate.MClimate('2021-07-15', str(tmp_path), 'slp', period=2)
+    result = mcli.generate('mean')
+    days = np.datetime_as_string(result.time.values, unit='D')
+    assert sorted(set(n[5:] for n in days)) == ['07-13', '07-14', '07-15', '07-16', '07-17']
+    assert len(days) == 15
+    assert set(result.timestr.values) == {'0713', '0714', '0715', '0716', '0717'}
+    assert (tmp_path / 'slp_mean_jja_high.nc.doy.npz').exists()
+
+def test_v12_files_from_catalog(tmp_path) -> None:
+    archive = tmp_path / 'reforecast'
+    archive.mkdir()
+    for date in ['2005011000', '2005070900', '2005071500', '2019072000', '2020071500']:
+        for stat in ['mean', 'sprd']:
+            (archive / f'slp_{stat}_{date}.nc').touch()
+            (archive / f'pwat_{stat}_{date}.nc').touch()
+    db_path = str(tmp_path / 'catalog.sqlite')
+    mcli = mclimate.MClimate('2021-07-15', str(archive), 'slp', period=6, v12=True, catalog_path=db_path)
+    with pytest.raises(FileNotFoundError):
+        mcli.set_data_path('sprd')
+    catalog.ReforecastCatalog(str(archive), db_path).build()
+    files = mcli.set_data_path('sprd')
+    assert [f.split('/')[-1] for f in files] == ['slp_sprd_2005070900.nc', 'slp_sprd_2005071500.nc', 'slp_sprd_2019072000.nc']
+    assert not (archive / 'catalog.sqlite').exists()
+
+def test_v12_files_of_fhour(tmp_path) -> None:
+    for name in ['pres_msl_mean_2005071500_f024.nc', 'pres_msl_mean_2005071500_f048.nc', 'slp_mean_2005071600.nc']:
+        (tmp_path / name).touch()
+    catalog.ReforecastCatalog(str(tmp_path)).build()
+    mcli = mclimate.MClimate('2021-07-15', str(tmp_path), 'slp', period=2, v12=True)
+    files = mcli.set_data_path('mean', fhour=24)
+    assert [f.split('/')[-1] for f in files] == ['pres_msl_mean_2005071500_f024.nc', 'slp_mean_2005071600.nc']
+
+def test_prefers_rechunked_store(tmp_path) -> None:
+    from espr import rechunk
+    times = np.arange('2010-07-01', '2010-08-01', dtype='datetime64[D]').astype('datetime64[ns]')
+    values = np.random.default_rng(0).random((len(times), 2, 3, 4)).astype('float32')
+    ds = xr.Dataset({'Pressure': (('time', 'fhour', 'lat', 'lon'), values)},
+        coords={'time': times, 'fhour': [24, 48], 'lat': [30., 25., 20.], 'lon': [180., 185., 190., 195.]})
+    data_path = str(tmp_path / 'slp_mean_jja_high.nc')
+    ds.to_netcdf(data_path)
+    store = rechunk.rechunk(data_path, tile=2)
+    assert xr.open_zarr(store).Pressure.encoding['chunks'] == (31, 1, 2, 2)
+    mcli = mclimate.MClimate('2021-07-15', str(tmp_path), 'slp', period=2)
+    opened = mcli.open_xr_dataset(data_path, {})
+    assert opened.Pressure.chunks is not None
+    np.testing.assert_array_equal(mcli.generate('mean').Pressure.values, values[12:17])
@@ -0,0 +1,31 @@
+import os
+import asyncio
+
+from espr import gefs_retrieve
+from espr import monitor
+from espr import utils
+from bench.nomads_standin import NomadsStandIn
+
+
+def test_link_fhour_filter_link() -> None:
+    link = 'https://nomads.ncep.noaa.gov/cgi-bin/filter_gefs_atmos_0p25s.pl?var_PRMSL=on&file=geavg.t12z.pgrb2s.0p25.f009'
+    assert monitor.link_fhour(link) == 9
+
+def test_link_fhour_direct_link() -> None:
+    link = 'https://nomads.ncep.noaa.gov/pub/data/nccf/com/gens/prod/gefs.20210715/12/atmos/pgrb2sp25/gep01.t12z.pgrb2s.0p25.f168'
+    assert monitor.link_fhour(link) == 168
+
+def test_ready_paths_exist_standin(tmp_path) -> None:
+    ready = []
+    with NomadsStandIn(resolution=5.) as standin:
+        retr = gefs_retrieve.GEFSRetrieve(['PRMSL'], levels=['mean_sea_level'], hour_end=3, download_dir=str(tmp_path), nomads_url=standin.url, backend='idx')
+        retr.date_value = 'gefs.20210715/'
+        retr.hour_value = '06/'
+        retr.link_builder()
+        retr.limiter = utils.AdaptiveLimiter(8, cooldown=0.)
+        watcher = monitor.LeadTimeMonitor(retr, stats=('mean', 'ens'), poll_interval=0.01)
+        watcher.subscribe(lambda event: ready.append((event, [os.path.exists(n) for n in event.paths])))
+        asyncio.get_event_loop().run_until_complete(watcher.run())
+    assert sorted((event.stat, event.fhour) for event, _ in ready) == [('ens', 0), ('ens', 3), ('mean', 0), ('mean', 3)]
+    assert all(all(exists) for _, exists in ready)
+    assert [event.paths for event, _ in ready if event.stat == 'ens'][0] == [retr.manifest('ens').store_path]
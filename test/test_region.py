@@ -0,0 +1,28 @@
+import numpy as np
+import xarray as xr
+
+from espr import region
+
+
+def test_lat_slice_descending() -> None:
+    r = region.Region((20, 65), (180, 310))
+    lats = np.arange(90, -90.25, -0.25)
+    lat_slice = r.lat_slice(lats)
+    assert (lats[lat_slice][0], lats[lat_slice][-1]) == (65, 20)
+
+def test_lon_slice_negative_longitudes() -> None:
+    r = region.Region((20, 65), (180, 310))
+    lons = np.arange(-180, 180, 1.)
+    lon_slice = r.lon_slice(lons)
+    assert (lons[lon_slice][0], lons[lon_slice][-1]) == (-180, -50)
+
+def test_isel_fhour_timedelta() -> None:
+    r = region.Region((20, 65), (180, 310), fhours=(6, 12, 6))
+    ds = xr.Dataset({'x': ('fhour', np.arange(5))}, coords={'fhour': np.arange(0, 15, 3).astype('timedelta64[h]')})
+    assert list(r.isel_fhour(ds).x.values) == [2, 4]
+
+def test_from_config() -> None:
+    r = region.Region.from_config('slp')
+    assert r.latitude_bounds == (20, 65)
+    assert r.includes_file('geavg.t00z.pgrb2s.0p25.f003')
+    assert not r.includes_file('geavg.t00z.pgrb2s.0p25.f000')
@@ -0,0 +1,40 @@
+import numpy as np
+import xarray as xr
+import bottleneck
+
+from espr import tiling
+from espr import transforms
+
+
+def _domain():
+    rng = np.random.default_rng(0)
+    dims = ['time', 'fhour', 'lat', 'lon']
+    coords = {'time': np.arange(50), 'fhour': [3, 6], 'lat': [30., 25., 20., 15., 10.], 'lon': [180., 185., 190.]}
+    shape = (50, 2, 5, 3)
+    mc_mean = xr.DataArray(rng.normal(size=shape), dims=dims, coords=coords)
+    mc_std = xr.Dataset({'Pressure': xr.DataArray(rng.random(shape), dims=dims, coords=coords)})
+    grid = {n: coords[n] for n in dims[1:]}
+    fmean = xr.Dataset({'Pressure': xr.DataArray(rng.normal(size=shape[1:]), dims=dims[1:], coords=grid)})
+    fsprd = xr.Dataset({'Pressure': xr.DataArray(rng.random(shape[1:]), dims=dims[1:], coords=grid)})
+    return mc_mean, mc_std, fmean, fsprd
+
+def test_tile_slices() -> None:
+    rows = tiling.tile_slices(5, 3, 2)
+    assert [len(n) for n in rows] == [2, 2, 2]
+    assert rows[2][1] == dict(lat=slice(4, 6), lon=slice(2, 4))
+
+def test_run_tiled_matches_whole_domain() -> None:
+    mc_mean, mc_std, fmean, fsprd = _domain()
+    analogs = transforms.AnalogClimatology.from_dataarrays(mc_mean, mc_std)
+    expected_hsa, expected_perc = tiling.hsa_tile(fmean, fsprd, analogs, None)
+    hsa_final, ssa_perc = tiling.run_tiled(fmean, fsprd, analogs, tile=2, workers=2)
+    np.testing.assert_allclose(hsa_final.transpose(*expected_hsa.dims).values, expected_hsa.values)
+    np.testing.assert_allclose(ssa_perc['spread_percentile'].transpose('fhour', 'lat', 'lon').values,
+        expected_perc['spread_percentile'].values)
+    # baseline: the masked spread ranked with the forecast appended, over the first gridpoint's count
+    percentile = bottleneck.rankdata(np.concatenate([mc_mean.values, fmean['Pressure'].values[None]]), axis=0) / 51
+    subset = transforms.subset_sprd(percentile, mc_std).where(~np.isnan(mc_mean))
+    stacked = np.concatenate([subset.values, fsprd['Pressure'].values[None]])
+    baseline = bottleneck.nanrankdata(stacked, axis=0)[-1] / np.count_nonzero(~np.isnan(stacked[:, 0, 0, 0]))
+    np.testing.assert_allclose(ssa_perc['spread_percentile'].transpose('fhour', 'lat', 'lon').values, baseline)
+    assert float(ssa_perc['spread_percentile'].max()) <= 1
@@ -0,0 +1,94 @@
+import numpy as np
+import xarray as xr
+import bottleneck
+
+from espr import transforms
+
+
+def _climatology(seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 6, (40, 3, 4, 5)).astype(float)
+    values[rng.random(values.shape) < 0.05] = np.nan
+    fcast = rng.integers(0, 7, (3, 4, 5)).astype(float)
+    data = xr.DataArray(values, dims=['time', 'fhour', 'lat', 'lon'],
+        coords={'time': np.arange(40), 'fhour': [3, 6, 9], 'lat': np.arange(4.), 'lon': np.arange(5.)})
+    return data, fcast
+
+def test_sorted_search() -> None:
+    sorted_values = np.sort(np.random.default_rng(1).integers(0, 10, (30, 7)).astype(float), axis=0)
+    values = np.arange(7.)
+    for side in ['left', 'right']:
+        expected = [np.searchsorted(sorted_values[:, i], values[i], side) for i in range(7)]
+        assert list(transforms.sorted_search(sorted_values, values, side)) == expected
+
+def test_presorted_matches_rankdata(tmp_path) -> None:
+    data, fcast = _climatology()
+    transforms.PresortedClimatology.from_dataarray(data).save(str(tmp_path / 'sorted.nc'))
+    presorted = transforms.PresortedClimatology.load(str(tmp_path / 'sorted.nc'))
+    expected = bottleneck.rankdata(np.concatenate([data.values, fcast[None]]), axis=0) / 41
+    np.testing.assert_allclose(presorted.percentile(fcast), expected[-1])
+    # NaNs rank last in both, but bottleneck orders them arbitrarily among themselves
+    valid = ~np.isnan(np.concatenate([data.values, fcast[None]]))
+    np.testing.assert_allclose(presorted.percentiles(fcast)[valid], expected[valid])
+
+def test_analog_hsa_matches_subset_sprd() -> None:
+    data, fcast = _climatology()
+    rng = np.random.default_rng(2)
+    mc_std = xr.Dataset({'Pressure': data.copy(data=rng.random(data.shape))})
+    coords = {n: data[n] for n in ['fhour', 'lat', 'lon']}
+    fmean = xr.Dataset({'Pressure': xr.DataArray(fcast, coords=coords, dims=['fhour', 'lat', 'lon'])})
+    fsprd = xr.Dataset({'Pressure': xr.DataArray(rng.random(fcast.shape), coords=coords, dims=['fhour', 'lat', 'lon'])})
+    percentile = bottleneck.rankdata(np.concatenate([data.values, fcast[None]]), axis=0) / 41
+    subset = transforms.subset_sprd(percentile, mc_std)
+    subset = subset.where(~np.isnan(data))
+    expected = (fsprd['Pressure'] - subset.mean('time', skipna=True)) / subset.std('time', skipna=True)
+    analogs = transforms.AnalogClimatology.from_dataarrays(data, mc_std)
+    result = transforms.analog_hsa(fsprd, fmean, analogs)
+    np.testing.assert_allclose(result.values, expected.transpose(*result.dims).values)
+
+def test_analog_spread_percentile_matches_hsa() -> None:
+    data, fcast = _climatology()
+    rng = np.random.default_rng(4)
+    mc_std = xr.Dataset({'Pressure': data.copy(data=rng.random(data.shape))})
+    coords = {n: data[n] for n in ['fhour', 'lat', 'lon']}
+    fmean = xr.Dataset({'Pressure': xr.DataArray(fcast, coords=coords, dims=['fhour', 'lat', 'lon'])})
+    fsprd = xr.Dataset({'Pressure': xr.DataArray(rng.random(fcast.shape), coords=coords, dims=['fhour', 'lat', 'lon'])})
+    percentile = bottleneck.rankdata(np.concatenate([data.values, fcast[None]]), axis=0) / 41
+    subset = transforms.subset_sprd(percentile, mc_std).where(~np.isnan(data))
+    _, expected = transforms.hsa(fsprd, subset)
+    analogs = transforms.AnalogClimatology.from_dataarrays(data, mc_std)
+    result = transforms.analog_spread_percentile(fsprd, fmean, analogs)
+    np.testing.assert_allclose(result['spread_percentile'].values,
+        expected['spread_percentile'].transpose(*result['spread_percentile'].dims).values)
+    override = transforms.analog_spread_percentile(fsprd, fmean, analogs, count=7)
+    np.testing.assert_allclose(override['spread_percentile'].values * 7, result['spread_percentile'].values * (int(subset.isel(fhour=0, lat=0, lon=0).count()) + 1))
+
+def test_percentile_of_value_matches_rankdata() -> None:
+    data, fcast = _climatology()
+    stacked = np.concatenate([data.values, fcast[None]])
+    np.testing.assert_allclose(transforms.percentile_of_value(data.values, fcast, block=7),
+        bottleneck.rankdata(stacked, axis=0)[-1] / 41)
+    np.testing.assert_allclose(transforms.percentile_of_value(data.values, fcast, skipna=True, block=7),
+        bottleneck.nanrankdata(stacked, axis=0)[-1] / (~np.isnan(stacked)).sum(axis=0))
+
+def test_subset_sprd_separate_fcast_percentile() -> None:
+    data, fcast = _climatology()
+    mc_std = xr.Dataset({'Pressure': data.copy(data=np.random.default_rng(3).random(data.shape))})
+    stacked = bottleneck.rankdata(np.concatenate([data.values, fcast[None]]), axis=0) / 41
+    presorted = transforms.PresortedClimatology.from_dataarray(data)
+    separate = transforms.subset_sprd(presorted.member_percentiles(fcast), mc_std, fcast_percentile=presorted.percentile(fcast))
+    valid = ~np.isnan(data.values)
+    np.testing.assert_array_equal(separate.values[valid], transforms.subset_sprd(stacked, mc_std).values[valid])
+
+def test_hsa_matches_nanrankdata() -> None:
+    data, _ = _climatology()
+    rng = np.random.default_rng(4)
+    subset = data.copy(data=rng.random(data.shape)).where(rng.random(data.shape) > 0.6)
+    coords = {n: data[n] for n in ['fhour', 'lat', 'lon']}
+    fsprd = xr.Dataset({'Pressure': xr.DataArray(rng.random((3, 4, 5)), coords=coords, dims=['fhour', 'lat', 'lon'])})
+    stacked = np.concatenate([subset.values, fsprd['Pressure'].values[None]])
+    expected = bottleneck.nanrankdata(stacked, axis=0)[-1] / np.count_nonzero(~np.isnan(stacked[:, 0, 0, 0]))
+    _, perc_ds = transforms.hsa(fsprd, subset)
+    np.testing.assert_allclose(perc_ds['spread_percentile'].values, expected)
+    _, perc_ds = transforms.hsa(fsprd, subset, count=7)
+    np.testing.assert_allclose(perc_ds['spread_percentile'].values, expected * np.count_nonzero(~np.isnan(stacked[:, 0, 0, 0])) / 7)
@@ -1 +1,46 @@
-from espr import utils
\ No newline at end of file
+import os
+
+import numpy as np
+
+from espr import utils
+
+class _Throttled(Exception):
+    status = 429
+
+def test_adaptive_limiter_increases_when_healthy() -> None:
+    limiter = utils.AdaptiveLimiter(2, maximum=8)
+    for _ in range(2):
+        limiter.record(0.1)
+    assert int(limiter.limit) == 3
+
+def test_adaptive_limiter_backs_off_on_throttle() -> None:
+    limiter = utils.AdaptiveLimiter(8, maximum=8)
+    limiter.record(0.1, _Throttled())
+    assert int(limiter.limit) == 4
+    assert limiter.paused_until > 0
+
+def test_adaptive_limiter_fixed() -> None:
+    limiter = utils.AdaptiveLimiter(5, minimum=5, maximum=5)
+    limiter.record(0.1, _Throttled())
+    for _ in range(10):
+        limiter.record(0.1)
+    assert int(limiter.limit) == 5
+
+def test_grib_index_cache(tmp_path) -> None:
+    grib = tmp_path / 'geavg.t12z.pgrb2s.0p25.f003'
+    grib.write_bytes(b'GRIB')
+    index_dir = utils.grib_index_dir(str(tmp_path))
+    indexpath = utils.grib_indexpath(str(grib), index_dir)
+    with utils.grib_index_lock(str(grib), index_dir):
+        open(indexpath.format(short_hash='abcde'), 'w').close()
+    grib.write_bytes(b'GRIB2')
+    assert utils.grib_indexpath(str(grib), index_dir) != indexpath
+    with utils.grib_index_lock(str(grib), index_dir):
+        pass
+    assert not os.path.exists(indexpath.format(short_hash='abcde'))
+    utils.evict_grib_indexes(index_dir, [str(grib)])
+    assert os.listdir(index_dir) == []
+
+def test_day_of_year_ignores_leap_years() -> None:
+    times = np.array(['2011-03-01', '2012-03-01', '2011-12-31'], dtype='datetime64[D]')
+    assert list(utils.day_of_year(times)) == [60, 60, 365]